@@ -0,0 +1,311 @@
+"""
+    Benchmarks the /findtaps request path without live Yelp, Datastore or Slack.
+
+    The app is started under gunicorn the same way boot.sh does, pointed at:
+
+    - a local fake Yelp search API with configurable latency and error rate
+    - the Datastore emulator, through DATASTORE_EMULATOR_HOST
+    - a local sink standing in for Slack's response_url
+
+    and driven with synthetic Pub/Sub push payloads.  Requests are a mix of
+    cache hits (locations warmed before the run), cache misses (locations never
+    seen before) and errors (locations the fake Yelp always fails for).
+    Throughput and p50/p95/p99 latency are reported per kind for every
+    combination of taps store, gunicorn workers and threads.
+
+    Start the emulator first, e.g.
+
+        gcloud beta emulators datastore start --no-store-on-disk
+        $(gcloud beta emulators datastore env-init)
+        python benchmark_findtaps.py --workers 1,2 --threads 4,8,16
+        python benchmark_findtaps.py --mix 0.8,0.15,0.05 --yelp-latency-ms 300
+        python benchmark_findtaps.py --stores datastore,sqlite,memory
+
+    The emulator is needed whichever store holds the business lists, the
+    leases, quota and dedupe records stay in Datastore.
+
+    Anything else the app reads from the environment can be set with --env,
+    e.g. --env STALE_GRACE_HOURS=0.  The Yelp rate limiter is opened up by
+    default so it doesn't cap the miss path.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from uuid import uuid4
+
+import requests
+
+KINDS = ("hit", "miss", "error")
+
+# Environment for the app under test, --env entries override these
+APP_ENV = {
+    "YELP_API_KEY": "benchmark",
+    "CLOUD_TRACE_ENABLED": "false",
+    "YELP_MAX_QPS": "100000",
+    "YELP_BURST": "100000",
+    "YELP_DAILY_LIMIT": "1000000000",
+    "POPULARITY_FLUSH_SECONDS": "3600",
+    "SLACK_WARMUP_URL": "",
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fake_businesses(location, count):
+    # Deterministic per location so repeated searches return the same bars
+    rng = random.Random(location)
+    latitude, longitude = rng.uniform(40.6, 40.8), rng.uniform(-74.0, -73.9)
+    return [
+        {
+            "id": location+"-"+str(i),
+            "name": "Bar "+str(i)+" near "+location,
+            "url": "https://www.yelp.com/biz/"+location.replace(" ", "-")+"-"+str(i),
+            "image_url": "https://s3-media1.fl.yelpcdn.com/bphoto/"+str(i)+"/o.jpg",
+            "rating": rng.choice([3.5, 4.0, 4.5]),
+            "review_count": rng.randrange(10, 900),
+            "coordinates": {
+                "latitude": latitude + rng.uniform(-0.005, 0.005),
+                "longitude": longitude + rng.uniform(-0.005, 0.005),
+            },
+            "location": {"display_address": [str(i)+" Main St", location]},
+        }
+        for i in range(count)
+    ], {"latitude": latitude, "longitude": longitude}
+
+
+def start_fake_yelp(latency_ms, jitter_ms, error_rate, businesses):
+    class YelpHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = parse_qs(urlparse(self.path).query)
+            location = params.get("location", [""])[0]
+            limit = int(params.get("limit", ["20"])[0])
+            offset = int(params.get("offset", ["0"])[0])
+            time.sleep(max(0.0, random.gauss(latency_ms, jitter_ms)) / 1000)
+
+            if location.startswith("error-") or random.random() < error_rate:
+                self._send(503, {"error": {"code": "SERVICE_UNAVAILABLE", "description": "benchmark error"}})
+                return
+            page, center = fake_businesses(location, businesses)
+            self._send(200, {
+                "businesses": page[offset:offset + limit],
+                "total": len(page),
+                "region": {"center": center},
+            })
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return serve(YelpHandler)
+
+
+def start_slack_sink(counter):
+    class SlackHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with counter["lock"]:
+                counter["posts"] += 1
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    return serve(SlackHandler)
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_app(mode, workers, threads, env):
+    port = free_port()
+    if mode == "async":
+        command = ["gunicorn", "--bind", "127.0.0.1:"+str(port), "--workers", str(workers),
+                   "--worker-class", "aiohttp.GunicornWebWorker", "--timeout", "0", "happytaps-findtaps-async:app"]
+    else:
+        command = ["gunicorn", "--bind", "127.0.0.1:"+str(port), "--workers", str(workers),
+                   "--threads", str(threads), "--timeout", "0", "happytaps-findtaps:app"]
+    process = subprocess.Popen(
+        command,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, GUNICORN_THREADS=str(threads), **env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    # Wait for every worker to import the app
+    url = "http://127.0.0.1:"+str(port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("findtaps exited with "+str(process.returncode)+", is DATASTORE_EMULATOR_HOST set?")
+        try:
+            if requests.get(url+"/cachestats", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("findtaps didn't start within 60 seconds")
+
+
+def push_payload(location, response_url):
+    return {
+        "message": {
+            "attributes": {
+                "location": location,
+                "response_url": response_url,
+                "requested_at": str(time.time()),
+            },
+            "data": "",
+            "messageId": str(uuid4()),
+        },
+        "subscription": "projects/benchmark/subscriptions/findtaps",
+    }
+
+
+def plan_requests(requests_count, mix, hit_locations, run_id):
+    kinds = random.choices(KINDS, weights=mix, k=requests_count)
+    plan = []
+    for index, kind in enumerate(kinds):
+        if kind == "hit":
+            plan.append((kind, random.choice(hit_locations)))
+        elif kind == "miss":
+            plan.append((kind, "miss-"+run_id+"-"+str(index)))
+        else:
+            plan.append((kind, "error-"+run_id+"-"+str(index)))
+    return plan
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_load(url, response_url, plan, concurrency):
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    results = {kind: [] for kind in KINDS}
+    failures = {kind: 0 for kind in KINDS}
+    lock = threading.Lock()
+
+    def send(item):
+        kind, location = item
+        start = time.perf_counter()
+        try:
+            ok = session.post(url+"/findtaps", json=push_payload(location, response_url), timeout=120).status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with lock:
+            if ok:
+                results[kind].append(elapsed_ms)
+            else:
+                failures[kind] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, plan))
+    return results, failures, time.perf_counter() - start
+
+
+def report(store, workers, threads, results, failures, elapsed):
+    total = sum(len(latencies) for latencies in results.values())
+    print(f"store={store} workers={workers} threads={threads}  {total} ok in {elapsed:.1f}s, {total / elapsed:.1f} req/s")
+    rows = list(results.items()) + [("all", [latency for latencies in results.values() for latency in latencies])]
+    print(f"  {'kind':<6} {'count':>6} {'failed':>6} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8}  (ms)")
+    for kind, latencies in rows:
+        failed = sum(failures.values()) if kind == "all" else failures[kind]
+        if not latencies:
+            print(f"  {kind:<6} {0:>6} {failed:>6}")
+            continue
+        print(f"  {kind:<6} {len(latencies):>6} {failed:>6} {statistics.mean(latencies):>8.1f} "
+              f"{percentile(latencies, 0.50):>8.1f} {percentile(latencies, 0.95):>8.1f} {percentile(latencies, 0.99):>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync", help="which findtaps entrypoint to run")
+    parser.add_argument("--stores", default="datastore", help="comma separated taps stores: datastore, sqlite, memory")
+    parser.add_argument("--workers", default="1", help="comma separated gunicorn worker counts")
+    parser.add_argument("--threads", default="8", help="comma separated gunicorn thread counts")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per combination")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    parser.add_argument("--mix", default="0.8,0.15,0.05", help="weights of hit,miss,error requests")
+    parser.add_argument("--hit-locations", type=int, default=50, help="distinct warmed locations")
+    parser.add_argument("--yelp-latency-ms", type=float, default=150, help="mean fake Yelp latency")
+    parser.add_argument("--yelp-jitter-ms", type=float, default=50, help="standard deviation of fake Yelp latency")
+    parser.add_argument("--yelp-error-rate", type=float, default=0.0, help="fraction of any Yelp call that fails")
+    parser.add_argument("--yelp-businesses", type=int, default=20, help="businesses per fake location")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the app")
+    args = parser.parse_args()
+
+    if "DATASTORE_EMULATOR_HOST" not in os.environ:
+        sys.exit("DATASTORE_EMULATOR_HOST isn't set, start the Datastore emulator first")
+
+    mix = [float(weight) for weight in args.mix.split(",")]
+    slack_posts = {"posts": 0, "lock": threading.Lock()}
+    yelp = start_fake_yelp(args.yelp_latency_ms, args.yelp_jitter_ms, args.yelp_error_rate, args.yelp_businesses)
+    slack = start_slack_sink(slack_posts)
+    response_url = "http://127.0.0.1:"+str(slack.server_address[1])+"/respond"
+    env = dict(APP_ENV, YELP_URL="http://127.0.0.1:"+str(yelp.server_address[1])+"/v3/businesses/search")
+    env.update(entry.split("=", 1) for entry in args.env)
+
+    store_dir = tempfile.TemporaryDirectory(prefix="happytaps-benchmark-")
+    for store in args.stores.split(","):
+        for workers in [int(value) for value in args.workers.split(",")]:
+            for threads in [int(value) for value in args.threads.split(",")]:
+                # Fresh locations for every combination, the emulator keeps earlier runs
+                run_id = uuid4().hex[:8]
+                hit_locations = ["hit-"+run_id+"-"+str(i) for i in range(args.hit_locations)]
+                store_env = dict(env, TAPS_STORE=store, TAPS_STORE_PATH=os.path.join(store_dir.name, run_id+".db"))
+                process, url = start_app(args.mode, workers, threads, store_env)
+                try:
+                    # Warm the hit locations, once per worker so most local caches have them
+                    for _ in range(workers):
+                        run_load(url, response_url, [("hit", location) for location in hit_locations], args.concurrency)
+
+                    plan = plan_requests(args.requests, mix, hit_locations, run_id)
+                    results, failures, elapsed = run_load(url, response_url, plan, args.concurrency)
+                    report(store, workers, threads, results, failures, elapsed)
+                finally:
+                    process.terminate()
+                    process.wait()
+
+    print(f"slack posts received: {slack_posts['posts']}")
+    yelp.shutdown()
+    slack.shutdown()
+    store_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
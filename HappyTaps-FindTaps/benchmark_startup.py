@@ -0,0 +1,237 @@
+"""
+    Measures where cold-start time goes for a HappyTaps service.
+
+    --imports loads a service's app module once in a fresh interpreter with
+    python -X importtime and reports the slowest imports, grouped by package,
+    then the time spent building each lazily built client and warming up.
+    Works for any of the services, e.g.
+
+        python benchmark_startup.py --imports
+        python benchmark_startup.py --imports --app ../HappyTaps-FrontEnd/happytaps-frontend.py
+
+    --cold-starts starts findtaps under gunicorn the way boot.sh does, against
+    the Datastore emulator and the fake Yelp and Slack from benchmark_findtaps.py,
+    and for each start times how long until the port is open, until /ready
+    answers 200, and the first and second /findtaps requests, for locations
+    stored in datastore but not in the new process's cache.  A run stops with
+    an error if /ready or either request fails rather than report its timing.
+
+        gcloud beta emulators datastore start --no-store-on-disk
+        $(gcloud beta emulators datastore env-init)
+        python benchmark_startup.py --cold-starts 5
+        python benchmark_startup.py --cold-starts 5 --no-wait-ready
+
+    Run it on an older commit to compare.
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from uuid import uuid4
+
+import requests
+
+from benchmark_findtaps import APP_ENV, free_port, push_payload, run_load, start_fake_yelp, start_slack_sink
+
+# Runs in the child interpreter, loads the app without running its __main__
+# block and reports import time, lazy client builds and the warm-up
+LOADER = """
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("app_under_test", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+import_seconds = time.perf_counter() - start
+
+from lazy_clients import LazyClient
+warmup = getattr(module, "warmup", None)
+if warmup is not None:
+    warmup.wait(float(sys.argv[2]))
+# The findtaps entrypoints build their clients in taps_pipeline.py
+modules = [module] + [sys.modules[name] for name in ("taps_pipeline",) if name in sys.modules]
+clients = {name: value for loaded in modules for name, value in vars(loaded).items() if isinstance(value, LazyClient)}
+print(json.dumps({
+    "import_seconds": import_seconds,
+    "clients": {name: client.build_seconds for name, client in clients.items()},
+    "warmup": warmup.stats() if warmup is not None else None,
+}))
+"""
+
+IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def package_of(module):
+    # google.* and opentelemetry.* are namespaces, group by the library within them
+    parts = module.split(".")
+    if parts[0] == "google" and len(parts) > 1 and parts[1] == "cloud":
+        return ".".join(parts[:3])
+    if parts[0] in ("google", "opentelemetry"):
+        return ".".join(parts[:2])
+    return parts[0]
+
+
+def measure_imports(app, env, timeout, top):
+    app = os.path.abspath(app)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", LOADER, app, str(timeout)],
+        cwd=os.path.dirname(app),
+        env=dict(os.environ, **env),
+        capture_output=True,
+        text=True,
+        timeout=timeout + 120,
+    )
+    if result.returncode != 0:
+        sys.exit("loading "+app+" failed:\n"+result.stderr[-2000:])
+
+    by_package = defaultdict(int)
+    direct = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = int(match[1]), int(match[2]), len(match[3]), match[4]
+        by_package[package_of(module)] += self_us
+        # One space of indent is a top-level import, mostly ones the app made itself
+        if indent == 1:
+            direct.append((cumulative_us, module))
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f"{os.path.basename(app)}: module loaded in {report['import_seconds'] * 1000:.0f} ms")
+    print("  slowest packages, own import time")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        print(f"    {package:<40} {self_us / 1000:>8.1f} ms")
+    print("  slowest top-level imports, including what they import")
+    for cumulative_us, module in sorted(direct, reverse=True)[:top]:
+        print(f"    {module:<40} {cumulative_us / 1000:>8.1f} ms")
+    print("  lazy clients, build time")
+    for name, seconds in report["clients"].items():
+        built = f"{seconds * 1000:>8.1f} ms" if seconds is not None else "     not built"
+        print(f"    {name:<40} {built}")
+    if report["warmup"] is not None:
+        print(f"  warm-up {json.dumps(report['warmup'])}")
+
+
+def wait_for_port(port, process, deadline):
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("findtaps exited with "+str(process.returncode)+", is DATASTORE_EMULATOR_HOST set?")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError("findtaps didn't open its port within 60 seconds")
+
+
+def cold_start(mode, env, response_url, locations, wait_ready):
+    port = free_port()
+    if mode == "async":
+        command = ["gunicorn", "--bind", "127.0.0.1:"+str(port), "--workers", "1",
+                   "--worker-class", "aiohttp.GunicornWebWorker", "--timeout", "0", "happytaps-findtaps-async:app"]
+    else:
+        command = ["gunicorn", "--bind", "127.0.0.1:"+str(port), "--workers", "1",
+                   "--threads", "8", "--timeout", "0", "happytaps-findtaps:app"]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, **env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        url = "http://127.0.0.1:"+str(port)
+        wait_for_port(port, process, time.monotonic() + 60)
+        timings = {"listen_ms": (time.perf_counter() - start) * 1000}
+
+        # gunicorn's master opens the port before the worker has loaded the app,
+        # so without /ready the first request also waits for the import
+        if wait_ready:
+            requests.get(url+"/ready", timeout=60).raise_for_status()
+            timings["ready_ms"] = (time.perf_counter() - start) * 1000
+
+        for name, location in zip(("first_ms", "second_ms"), locations):
+            request_start = time.perf_counter()
+            requests.post(url+"/findtaps", json=push_payload(location, response_url), timeout=120).raise_for_status()
+            timings[name] = (time.perf_counter() - request_start) * 1000
+            if name == "first_ms":
+                timings["first_answer_ms"] = (time.perf_counter() - start) * 1000
+        return timings
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def measure_cold_starts(mode, runs, wait_ready, overrides):
+    if "DATASTORE_EMULATOR_HOST" not in os.environ:
+        sys.exit("DATASTORE_EMULATOR_HOST isn't set, start the Datastore emulator first")
+
+    slack_posts = {"posts": 0, "lock": threading.Lock()}
+    yelp = start_fake_yelp(150, 0, 0.0, 20)
+    slack = start_slack_sink(slack_posts)
+    response_url = "http://127.0.0.1:"+str(slack.server_address[1])+"/respond"
+    env = dict(APP_ENV, YELP_URL="http://127.0.0.1:"+str(yelp.server_address[1])+"/v3/businesses/search")
+    env.update(overrides)
+
+    # Store two locations per run in datastore through a throwaway instance
+    run_id = uuid4().hex[:8]
+    locations = [("cold-"+run_id+"-"+str(i), "cold-"+run_id+"-"+str(i)+"-next") for i in range(runs)]
+    port = free_port()
+    seeder = subprocess.Popen(
+        ["gunicorn", "--bind", "127.0.0.1:"+str(port), "--threads", "8", "--timeout", "0", "happytaps-findtaps:app"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, **env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port, seeder, time.monotonic() + 60)
+        plan = [("hit", location) for pair in locations for location in pair]
+        run_load("http://127.0.0.1:"+str(port), response_url, plan, 8)
+    finally:
+        seeder.terminate()
+        seeder.wait()
+
+    results = [cold_start(mode, env, response_url, pair, wait_ready) for pair in locations]
+    print(f"mode={mode} runs={runs} wait_ready={wait_ready}")
+    for name in results[0]:
+        values = [result[name] for result in results]
+        print(f"  {name:<16} median {statistics.median(values):>8.1f}  min {min(values):>8.1f}  max {max(values):>8.1f}  (ms)")
+    yelp.shutdown()
+    slack.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--imports", action="store_true", help="break down import and client build time")
+    parser.add_argument("--app", default="happytaps-findtaps.py", help="app module to load with --imports")
+    parser.add_argument("--top", type=int, default=15, help="rows per table with --imports")
+    parser.add_argument("--cold-starts", type=int, default=0, help="number of cold starts of findtaps to time")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync", help="which findtaps entrypoint to start")
+    parser.add_argument("--no-wait-ready", dest="wait_ready", action="store_false", help="send the first request without waiting for /ready")
+    parser.add_argument("--ready-timeout", type=float, default=30, help="seconds to wait for the warm-up")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the app")
+    args = parser.parse_args()
+
+    env = {"CLOUD_TRACE_ENABLED": "false", "SLACK_WARMUP_URL": ""}
+    env.update(entry.split("=", 1) for entry in args.env)
+
+    if not args.imports and not args.cold_starts:
+        parser.error("pass --imports and/or --cold-starts N")
+    if args.imports:
+        measure_imports(args.app, dict(APP_ENV, **env), args.ready_timeout, args.top)
+    if args.cold_starts:
+        measure_cold_starts(args.mode, args.cold_starts, args.wait_ready, env)
+
+
+if __name__ == "__main__":
+    main()
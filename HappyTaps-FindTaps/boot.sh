@@ -1,3 +1,9 @@
 #!/bin/sh
 source venv/bin/activate
-exec gunicorn --bind :3000 --workers 1 --threads 8 --timeout 0 happytaps-findtaps:app
+export GUNICORN_THREADS=${GUNICORN_THREADS:-8}
+
+# FINDTAPS_MODE=async serves /findtaps from a single asyncio event loop
+if [ "$FINDTAPS_MODE" = "async" ]; then
+    exec gunicorn --bind :3000 --workers 1 --worker-class aiohttp.GunicornWebWorker --timeout 0 happytaps-findtaps-async:app
+fi
+exec gunicorn --bind :3000 --workers 1 --threads $GUNICORN_THREADS --timeout 0 happytaps-findtaps:app
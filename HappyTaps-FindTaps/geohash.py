@@ -0,0 +1,68 @@
+"""
+    Minimal geohash encoding and neighbour lookup for the HappyTaps spatial index.
+"""
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def encode(latitude: float, longitude: float, precision: int) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    cell = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(cell) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits = bits << 1
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            cell.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(cell)
+
+
+def decode(cell: str):
+    """ Returns the (latitude, longitude, latitude_error, longitude_error) of a cell's centre. """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in cell:
+        bits = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    latitude = (lat_range[0] + lat_range[1]) / 2
+    longitude = (lon_range[0] + lon_range[1]) / 2
+    return latitude, longitude, (lat_range[1] - lat_range[0]) / 2, (lon_range[1] - lon_range[0]) / 2
+
+
+def neighbours(cell: str) -> list:
+    """ Returns the eight cells surrounding a cell at the same precision. """
+    latitude, longitude, lat_error, lon_error = decode(cell)
+    result = []
+    for d_lat in (-1, 0, 1):
+        for d_lon in (-1, 0, 1):
+            if d_lat == 0 and d_lon == 0:
+                continue
+            neighbour_lat = latitude + d_lat * 2 * lat_error
+            neighbour_lon = longitude + d_lon * 2 * lon_error
+            # Wrap around the antimeridian, cells past the poles don't exist
+            neighbour_lon = (neighbour_lon + 180) % 360 - 180
+            if -90 <= neighbour_lat <= 90:
+                result.append(encode(neighbour_lat, neighbour_lon, len(cell)))
+    return result
@@ -0,0 +1,488 @@
+import os
+import asyncio
+import contextvars
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, ClientError, ClientConnectorError, ServerTimeoutError
+from single_flight import AsyncSingleFlight
+from taps_messages import yelp_unavailable_message, multi_taps_message
+from yelp_limiter import INTERACTIVE, BACKGROUND
+from taps_telemetry import extract_message_context
+from lazy_clients import Warmup
+from taps_pipeline import (
+    tracer, telemetry, location_cache, popularity, push_deduplicator, yelp_limiter, yelp_breaker,
+    YELP_URL, YELP_LIMIT, YELP_PAGE_WORKERS, YELP_LEASE_POLL_SECONDS,
+    READY_TIMEOUT_SECONDS, SLACK_WARMUP_URL, yelp_headers, yelp_lease,
+    YelpUnavailable, YelpRateLimited, check_datastore, suggestion_message, pick_bar,
+    cached_answer, fallback_answer, parse_locations, record_time_to_answer,
+    get_local_taps, get_stored_taps, get_many_taps, get_nearby_taps, index_taps, log_refresh_failure,
+    acquire_lease, release_lease, get_lease_result, admit_yelp_call, record_yelp_response,
+    yelp_search_params, store_yelp_page, pool_pages, store_pool,
+    refresh_options, hot_locations_to_refresh, refresh_outcome, refresh_summary, breaker_stats as collect_breaker_stats,
+)
+
+# Tracing
+from opentelemetry import trace
+from opentelemetry.trace import Link, SpanKind
+from opentelemetry.propagate import extract
+
+# Define logger and set log level
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Outbound connection limits and retries for Yelp and Slack, a single event
+# loop can hold far more requests in flight than a gunicorn thread pool
+HTTP_POOL_SIZE = int(os.environ.get("ASYNC_HTTP_POOL_SIZE", 100))
+HTTP_TIMEOUT = ClientTimeout(sock_connect=3.05, sock_read=10)
+HTTP_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.3
+HTTP_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# The datastore client is blocking, so its calls run on a thread pool
+# sized separately from the number of requests in flight
+DATASTORE_WORKERS = int(os.environ.get("ASYNC_DATASTORE_WORKERS", 32))
+datastore_executor = ThreadPoolExecutor(max_workers=DATASTORE_WORKERS)
+
+# Coalesce concurrent Yelp refreshes for the same location within this
+# process, taps_pipeline.py coalesces them across instances
+yelp_flight = AsyncSingleFlight()
+
+# Background refresh tasks for stale business lists, keyed by location so
+# only one is scheduled per location
+refresh_tasks = {}
+
+# Spatial indexing and pool fill tasks, referenced until they finish
+pool_tasks = set()
+
+# Warm the datastore client as soon as the app is loaded, and the Yelp and Slack
+# connection pools once the sessions exist.  GET /ready waits on both so a
+# startup probe holds traffic back until then.
+warmup = Warmup(checks={"datastore": check_datastore}, logger=logger).start()
+
+
+# Function to run a blocking call on the datastore executor, keeping the
+# current tracing context so spans created there nest correctly
+async def run_blocking(fn, *args):
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(datastore_executor, partial(ctx.run, fn, *args))
+
+
+# Function to handle a pubsub push, once per message
+async def find_taps(request):
+    # Save attributes from pubsub push subscription message
+    data = await request.json()
+    message = data['message']
+    attributes = message['attributes']
+
+    # Continue the trace from the push request, same as the Flask instrumentation
+    with tracer.start_as_current_span("/findtaps", context=extract(request.headers), kind=SpanKind.SERVER) as current_span:
+        current_span.set_attribute("http.method", request.method)
+        current_span.set_attribute("http.route", "/findtaps")
+
+        # Continue the slash command's trace, the frontend carries it in the message
+        # attributes, and link back to the push request's own span
+        with tracer.start_as_current_span(
+            "process_findtaps",
+            context=extract_message_context(attributes),
+            kind=SpanKind.CONSUMER,
+            links=[Link(current_span.get_span_context())],
+        ) as message_span:
+            telemetry.record_queue_age(message.get('publishTime'), "findtaps")
+
+            # Ack redeliveries of a message that's done or in progress, here or on
+            # another instance, without doing the work again
+            message_id = message.get('messageId') or message.get('message_id')
+            if not await run_blocking(push_deduplicator.claim, message_id):
+                message_span.set_attribute("duplicate_delivery", True)
+                logger.info("Suppressed duplicate delivery of message "+message_id)
+                return web.Response(text='Ok', status=200)
+
+            # Let a failed message be handled again when pubsub redelivers it
+            try:
+                response = await suggest_taps(request.app, attributes)
+            except Exception:
+                await run_blocking(push_deduplicator.release, message_id)
+                raise
+            await run_blocking(push_deduplicator.complete, message_id)
+            return response
+
+
+# Function to generate bar suggestion for Slack
+async def suggest_taps(app, attributes):
+    # Create respond function, a message with several locations gets one
+    # combined answer
+    respond = partial(send_response, app['slack_session'], attributes['response_url'])
+    if 'locations' in attributes:
+        return await suggest_many_taps(app, attributes, respond)
+
+    # Set yelp_location from pubsub message
+    yelp_location = attributes['location'].lower()
+    popularity.increment(yelp_location)
+
+    # Attempt to get data from the local cache or datastore for this location,
+    # then from the spatial index or Yelp if it's missing or expired
+    try:
+        yelp_businesses = await resolve_taps(app, yelp_location, await get_taps(yelp_location))
+    except YelpUnavailable:
+        await respond(yelp_unavailable_message(yelp_location))
+        record_time_to_answer(attributes)
+        return web.Response(text='Ok', status=200)
+
+    # Pull bar at random, or say there are no bars nearby, and send reponse to Slack
+    await respond(suggestion_message(yelp_location, yelp_businesses))
+    record_time_to_answer(attributes)
+    return web.Response(text='Ok', status=200)
+
+
+# Function to get business list, checking the local cache on the event loop
+# before reading the taps store on the executor
+async def get_taps(yelp_location):
+    data_response = get_local_taps(yelp_location)
+    if data_response is not None:
+        return data_response
+    return await run_blocking(get_stored_taps, yelp_location)
+
+
+# Function to decide which business list answers a location given what the
+# cache or datastore returned for it.  Returns an empty list when there are no
+# bars nearby, raises YelpUnavailable when nothing at all can be served.
+async def resolve_taps(app, yelp_location, data_response):
+    yelp_businesses = cached_answer(yelp_location, data_response, partial(schedule_refresh, app))
+    if yelp_businesses is not None:
+        return yelp_businesses
+
+    # Otherwise try nearby cells of the spatial index before pulling a new
+    # business list from Yelp
+    yelp_businesses = await run_blocking(get_nearby_taps, yelp_location)
+    try:
+        if yelp_businesses is None:
+            yelp_businesses = await refresh_taps(app, yelp_location)
+    except YelpUnavailable as error:
+        return fallback_answer(data_response, error)
+    return yelp_businesses or []
+
+
+# Function to answer a message carrying several locations with one Slack
+# message.  Cached lists come from one batched datastore read, the rest are
+# resolved concurrently so the answer takes about as long as the slowest area.
+async def suggest_many_taps(app, attributes, respond):
+    yelp_locations = parse_locations(attributes['locations'])
+    for yelp_location in yelp_locations:
+        popularity.increment(yelp_location)
+    trace.get_current_span().set_attribute("num_locations", len(yelp_locations))
+
+    data_responses = await run_blocking(get_many_taps, yelp_locations)
+    suggestions = await asyncio.gather(*(
+        resolve_area(app, yelp_location, data_responses[yelp_location]) for yelp_location in yelp_locations
+    ))
+    await respond(multi_taps_message(suggestions))
+    record_time_to_answer(attributes)
+    return web.Response(text='Ok', status=200)
+
+
+# Function to pick a bar for one area of a multi-location request, returns
+# (yelp_location, bar or None, whether Yelp was unavailable)
+async def resolve_area(app, yelp_location, data_response):
+    with tracer.start_as_current_span("resolve_area") as area_span:
+        area_span.set_attribute("location", yelp_location)
+        try:
+            yelp_businesses = await resolve_taps(app, yelp_location, data_response)
+        except YelpUnavailable:
+            return yelp_location, None, True
+        if not yelp_businesses:
+            return yelp_location, None, False
+        return yelp_location, pick_bar(yelp_businesses), False
+
+
+# Function exposing in-process cache counters
+async def cache_stats(request):
+    return web.json_response(location_cache.stats(), status=200)
+
+
+# Function exposing Yelp rate limiter and quota counters
+async def yelp_stats(request):
+    return web.json_response(await run_blocking(yelp_limiter.stats), status=200)
+
+
+# Function exposing counts of claimed and duplicate push deliveries
+async def push_stats(request):
+    return web.json_response(push_deduplicator.stats(), status=200)
+
+
+# Function exposing circuit breaker and hedging counters
+async def breaker_stats(request):
+    return web.json_response(collect_breaker_stats(), status=200)
+
+
+# Function for the readiness probe, answers once clients and connections are
+# warm.  Connections that failed to open are tried again on the next probe.
+async def ready(request):
+    try:
+        failed_hosts = await asyncio.wait_for(asyncio.shield(request.app['http_warmup']), READY_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        return web.json_response(warmup.stats(), status=503)
+    ready = await run_blocking(warmup.wait, READY_TIMEOUT_SECONDS)
+    stats = warmup.stats()
+    if failed_hosts:
+        start_http_warmup(request.app, failed_hosts)
+        stats["ready"] = False
+        stats["failed"] = stats["failed"] + failed_hosts
+    return web.json_response(stats, status=200 if ready and not failed_hosts else 503)
+
+
+# Function for the scheduled job that pre-warms the hottest locations.
+# Refreshes the top_n most requested locations that are missing or expire within
+# refresh_within_minutes, making at most max_yelp_calls refreshes, concurrency at a time.
+async def refresh_hot_taps(request):
+    try:
+        params = await request.json() if request.can_read_body else None
+    except ValueError:
+        params = None
+    top_n, max_yelp_calls, concurrency, refresh_within = refresh_options(params)
+    hot_locations, to_refresh = await run_blocking(hot_locations_to_refresh, top_n, max_yelp_calls, refresh_within)
+
+    # Refresh them with bounded concurrency, sharing in-flight refreshes
+    semaphore = asyncio.Semaphore(concurrency)
+    async def bounded_refresh(location):
+        async with semaphore:
+            return await refresh_taps_safely(request.app, location)
+    outcomes = await asyncio.gather(*[bounded_refresh(location) for location in to_refresh])
+    return web.json_response(refresh_summary(hot_locations, to_refresh, outcomes), status=200)
+
+
+# Function to refresh a location for the pre-warm job, a failed refresh
+# shouldn't stop the others
+async def refresh_taps_safely(app, yelp_location):
+    try:
+        return refresh_outcome(await refresh_taps(app, yelp_location, BACKGROUND))
+    except Exception as error:
+        log_refresh_failure("Pre-warm refresh", yelp_location, error)
+        return "failed"
+
+
+# Function to refresh business list from Yelp, only one refresh per location
+# runs at a time and concurrent requests share its result
+async def refresh_taps(app, yelp_location, priority=INTERACTIVE):
+    current_span = trace.get_current_span()
+    flight = await yelp_flight.do(yelp_location, lambda: refresh_taps_leased(app, yelp_location, priority))
+    current_span.set_attribute("coalesced", flight.shared)
+    current_span.set_attribute("coalesced_waiters", flight.waiters)
+    return flight.value
+
+
+# Function to schedule a background refresh for a stale location, returns
+# False if a refresh for this location is already pending
+def schedule_refresh(app, yelp_location):
+    if yelp_location in refresh_tasks:
+        return False
+
+    task = asyncio.create_task(background_refresh(app, yelp_location))
+    refresh_tasks[yelp_location] = task
+    task.add_done_callback(lambda _: refresh_tasks.pop(yelp_location, None))
+    return True
+
+
+# Function run as a task to update a stale location
+async def background_refresh(app, yelp_location):
+    try:
+        with tracer.start_as_current_span("background_refresh") as refresh_span:
+            refresh_span.set_attribute("location", yelp_location)
+            await refresh_taps(app, yelp_location, BACKGROUND)
+    except Exception as error:
+        log_refresh_failure("Background refresh", yelp_location, error)
+
+
+# Function to refresh business list while holding the datastore lease, if
+# another instance holds it we wait for that instance to store its result.
+# If there is no lease to wait on we fetch without it.
+async def refresh_taps_leased(app, yelp_location, priority):
+    leased = await run_blocking(acquire_lease, yelp_location)
+    if leased is None:
+        return await fetch_taps(app, yelp_location, priority)
+    if leased:
+        try:
+            return await fetch_taps(app, yelp_location, priority)
+        finally:
+            await run_blocking(release_lease, yelp_location)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + yelp_lease.lease_seconds
+    with tracer.start_span("wait_for_lease") as lease_span:
+        while loop.time() < deadline:
+            await asyncio.sleep(YELP_LEASE_POLL_SECONDS)
+            try:
+                data_response = await run_blocking(get_lease_result, yelp_location)
+            except Exception as error:
+                # The lease holder's result can't be seen, fetch it ourselves
+                logger.warning("Stopped waiting for lease on "+yelp_location+": "+str(error))
+                lease_span.set_attribute("lease_result", "unavailable")
+                break
+            if data_response is not None:
+                lease_span.set_attribute("lease_result", "shared")
+                return data_response['businesses'] or None
+
+        else:
+            # Lease holder didn't finish in time, fetch it ourselves
+            lease_span.set_attribute("lease_result", "timeout")
+    return await fetch_taps(app, yelp_location, priority)
+
+
+# Function to pull new business list from Yelp and store it
+async def fetch_taps(app, yelp_location, priority):
+    # Format and make request to Yelp API
+    with tracer.start_span("yelp_api_call") as yelp_span:
+        yelp_span.set_attribute("priority", priority)
+        yelp_data = await fetch_yelp_page(app, yelp_location, 0, YELP_LIMIT, priority)
+
+    # Store the businesses, or that there are none, and use them for the response
+    yelp_businesses = await run_blocking(store_yelp_page, yelp_location, yelp_data)
+    if yelp_businesses is None:
+        return None
+
+    # File the businesses under their cells and fill in the rest of the
+    # candidate pool without holding up the response
+    background_tasks = [run_blocking(index_taps, yelp_location, yelp_data.get('region', {}).get('center'), yelp_businesses)]
+    pages = pool_pages(yelp_data)
+    if pages:
+        background_tasks.append(fill_pool(app, yelp_location, yelp_businesses, pages))
+    for coro in background_tasks:
+        task = asyncio.create_task(coro)
+        pool_tasks.add(task)
+        task.add_done_callback(pool_tasks.discard)
+    return yelp_businesses
+
+
+# Function to request one page of bars from the Yelp API, within the rate limit.
+# Waiting for a token blocks, so it runs on the executor.
+async def fetch_yelp_page(app, yelp_location, offset, limit, priority):
+    await run_blocking(admit_yelp_call, priority)
+    try:
+        with telemetry.dependency_call("yelp", "search", offset=offset, priority=priority):
+            status, headers, yelp_data = await request_with_retries(app['yelp_session'], 'GET', YELP_URL, with_response=True, retry_sent=False, params=yelp_search_params(yelp_location, offset, limit))
+    except Exception as error:
+        yelp_breaker.record_failure()
+        raise YelpUnavailable(504) from error
+    record_yelp_response(priority, status, headers, yelp_data)
+    return yelp_data
+
+
+# Function to fetch the deeper pages of a location's candidate pool concurrently,
+# then store the first page merged with whatever pages came back
+async def fill_pool(app, yelp_location, first_page, pages):
+    semaphore = asyncio.Semaphore(YELP_PAGE_WORKERS)
+
+    async def fetch_page(offset, limit):
+        async with semaphore:
+            try:
+                yelp_data = await fetch_yelp_page(app, yelp_location, offset, limit, BACKGROUND)
+                return yelp_data.get('businesses', [])
+            except YelpRateLimited:
+                return []
+            except Exception:
+                logger.exception("Failed to fetch Yelp page at offset "+str(offset)+" for "+yelp_location)
+                return []
+
+    with tracer.start_as_current_span("fill_pool"):
+        fetched = await asyncio.gather(*[fetch_page(offset, limit) for offset, limit in pages])
+        await run_blocking(store_pool, yelp_location, first_page, fetched)
+
+
+# Function to tell whether a request failed before it could be sent, the
+# connection couldn't be opened or timed out opening.  aiohttp only tells a
+# connect timeout from a read timeout by its message before 3.10.
+def failed_to_connect(error):
+    if isinstance(error, ClientConnectorError):
+        return True
+    return isinstance(error, ServerTimeoutError) and str(error).startswith("Connection timeout")
+
+
+# Function to make an http request with retries and exponential backoff, the
+# same policy as the urllib3 Retry in http_sessions.py.  Only GET is retried on
+# 5xx responses.  Idempotent methods are retried on any client error, others
+# like the Slack POST only when the connection failed, as nothing was sent yet.
+# With retry_sent=False, as for Yelp, only failed connections are retried.
+async def request_with_retries(session, method, url, with_response=False, retry_sent=True, **kwargs):
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                if retry_sent and method == 'GET' and r.status >= 500 and attempt < HTTP_RETRIES:
+                    pass
+                elif r.content_type == 'application/json':
+                    body = await r.json()
+                    return (r.status, r.headers, body) if with_response else body
+                else:
+                    body = {'status': r.status, 'text': await r.text()}
+                    return (r.status, r.headers, body) if with_response else body
+        except ClientError as error:
+            if attempt == HTTP_RETRIES or not (failed_to_connect(error) or (retry_sent and method in HTTP_IDEMPOTENT_METHODS)):
+                raise
+        await asyncio.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+
+
+# Function to post a message to the Slack response_url over the shared session
+async def send_response(session, response_url, message):
+    with telemetry.dependency_call("slack", "respond"):
+        r = await request_with_retries(session, 'POST', response_url, json=message)
+    if r.get('status', 200) != 200:
+        logger.warning("Slack response_url returned "+str(r['status'])+": "+r['text'])
+    return r
+
+
+# Function to open a keep-alive connection to a host ahead of the first request,
+# returns False if it couldn't
+async def warm_connection(session, url):
+    try:
+        async with session.head(url):
+            return True
+    except (ClientError, asyncio.TimeoutError) as error:
+        logger.warning("Warm-up of "+url+" failed: "+str(error))
+        return False
+
+
+# Function to start warming connections to the named hosts, app['http_warmup']
+# resolves to the names of the ones that failed
+def start_http_warmup(app, names):
+    targets = {"yelp": ('yelp_session', YELP_URL), "slack": ('slack_session', SLACK_WARMUP_URL)}
+
+    async def run():
+        warmed = await asyncio.gather(*[warm_connection(app[targets[name][0]], targets[name][1]) for name in names])
+        return [name for name, ok in zip(names, warmed) if not ok]
+
+    app['http_warmup'] = asyncio.ensure_future(run())
+
+
+# Create and close the shared Yelp and Slack sessions with the app, and start
+# warming their connections
+async def http_sessions(app):
+    app['yelp_session'] = ClientSession(
+        connector=TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=30),
+        timeout=HTTP_TIMEOUT,
+        headers=yelp_headers,
+    )
+    app['slack_session'] = ClientSession(
+        connector=TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=30),
+        timeout=HTTP_TIMEOUT,
+    )
+    start_http_warmup(app, ["yelp", "slack"] if SLACK_WARMUP_URL else ["yelp"])
+    yield
+    app['http_warmup'].cancel()
+    await app['yelp_session'].close()
+    await app['slack_session'].close()
+
+
+# Intitialize aiohttp app that exposes endpoint for pubsub FindTaps subscription
+app = web.Application()
+app.cleanup_ctx.append(http_sessions)
+app.router.add_post('/findtaps', find_taps)
+app.router.add_get('/cachestats', cache_stats)
+app.router.add_get('/yelpstats', yelp_stats)
+app.router.add_get('/pushstats', push_stats)
+app.router.add_get('/breakerstats', breaker_stats)
+app.router.add_get('/ready', ready)
+app.router.add_post('/refreshtaps', refresh_hot_taps)
+
+# Start your app
+if __name__ == "__main__":
+    web.run_app(app, port=int(os.environ.get("PORT", 3000)))
@@ -1,37 +1,33 @@
 import os
-from slack_bolt.context.respond.respond import Respond
-import requests
-import random
-import json
+import time
 import logging
-from google.cloud import datastore
-from datetime import datetime, timedelta, timezone
-from flask import Flask, request, abort
+import threading
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify
+from single_flight import SingleFlight
+from http_sessions import build_session
+from taps_messages import yelp_unavailable_message, multi_taps_message
+from yelp_limiter import INTERACTIVE, BACKGROUND
+from taps_telemetry import extract_message_context
+from lazy_clients import Warmup
+from taps_pipeline import (
+    tracer, telemetry, location_cache, popularity, push_deduplicator, yelp_limiter, yelp_breaker,
+    YELP_URL, YELP_LIMIT, YELP_PAGE_WORKERS, YELP_LEASE_POLL_SECONDS, MAX_LOCATIONS,
+    READY_TIMEOUT_SECONDS, SLACK_WARMUP_URL, yelp_headers, yelp_lease,
+    YelpUnavailable, YelpRateLimited, check_datastore, suggestion_message, pick_bar,
+    cached_answer, fallback_answer, parse_locations, record_time_to_answer,
+    get_taps, get_many_taps, get_nearby_taps, index_taps, log_refresh_failure,
+    acquire_lease, release_lease, get_lease_result, admit_yelp_call, record_yelp_response,
+    yelp_search_params, store_yelp_page, pool_pages, store_pool,
+    refresh_options, hot_locations_to_refresh, refresh_outcome, refresh_summary, breaker_stats as collect_breaker_stats,
+)
 
 # Tracing
 from opentelemetry import trace
-from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.trace import Link, SpanKind
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.propagate import set_global_textmap
-from opentelemetry.propagators.cloud_trace_propagator import (
-    CloudTraceFormatPropagator,
-)
-
-set_global_textmap(CloudTraceFormatPropagator())
-    
-tracer_provider = TracerProvider()
-cloud_trace_exporter = CloudTraceSpanExporter()
-tracer_provider.add_span_processor(
-    # BatchSpanProcessor buffers spans and sends them in batches in a
-    # background thread. The default parameters are sensible, but can be
-    # tweaked to optimize your performance
-    BatchSpanProcessor(cloud_trace_exporter)
-)
-trace.set_tracer_provider(tracer_provider)
-
-tracer = trace.get_tracer(__name__)
 
 # Intitialize Flask app that exposes endpoint for pubsub FindTaps subscription
 app = Flask(__name__)
@@ -43,142 +39,360 @@ FlaskInstrumentor().instrument_app(app)
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Define values to be used with Yelp Fusion API calls
-YELP_URL = "https://api.yelp.com/v3/businesses/search"
-YELP_LIMIT = 20
-yelp_api_key = os.environ.get("YELP_API_KEY")
-yelp_headers = {'Authorization':'Bearer '+yelp_api_key}
+# Shared keep-alive sessions for Yelp and Slack, pools sized to the number of
+# gunicorn threads plus background refresh workers that may use them at once.
+# Every Yelp call takes a rate limit token and counts toward the daily quota,
+# so Yelp requests are only retried when they couldn't be sent.
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", 8))
+BACKGROUND_REFRESH_WORKERS = int(os.environ.get("BACKGROUND_REFRESH_WORKERS", 2))
+yelp_session = build_session(
+    pool_size=GUNICORN_THREADS + BACKGROUND_REFRESH_WORKERS,
+    connect_timeout=3.05,
+    read_timeout=10,
+    retries=2,
+    backoff_factor=0.3,
+    headers=yelp_headers,
+    retry_sent=False,
+)
+slack_session = build_session(
+    pool_size=GUNICORN_THREADS,
+    connect_timeout=3.05,
+    read_timeout=10,
+    retries=2,
+    backoff_factor=0.3,
+)
+
+# Coalesce concurrent Yelp refreshes for the same location within this
+# process, taps_pipeline.py coalesces them across instances
+yelp_flight = SingleFlight()
+
+# Background refreshes for stale business lists, only one scheduled per location.
+# Requires CPU to stay allocated after the response is sent on Cloud Run.
+refresh_executor = ThreadPoolExecutor(max_workers=BACKGROUND_REFRESH_WORKERS)
+refresh_scheduled = set()
+refresh_scheduled_lock = threading.Lock()
 
-# Instantiates a Google datastore client
-datastore_client = datastore.Client()
+# Workers fetching deeper Yelp pages when filling a location's candidate pool
+page_executor = ThreadPoolExecutor(max_workers=YELP_PAGE_WORKERS)
+
+# Areas of a multi-location command are resolved concurrently
+fanout_executor = ThreadPoolExecutor(max_workers=GUNICORN_THREADS * MAX_LOCATIONS)
+
+# Warm the datastore client and the Yelp and Slack connection pools in parallel
+# as soon as the app is loaded, GET /ready waits on it so a startup probe holds
+# traffic back until then.
+warmup_checks = {
+    "datastore": check_datastore,
+    "yelp": lambda: yelp_session.head(YELP_URL),
+}
+if SLACK_WARMUP_URL:
+    warmup_checks["slack"] = lambda: slack_session.head(SLACK_WARMUP_URL)
+warmup = Warmup(checks=warmup_checks, logger=logger).start()
 
 # Route decorator specifying path for API call
 @app.route('/findtaps', methods=['POST'])
-# Function to generate bar suggestion for Slack
+# Function to handle a pubsub push, once per message
 def find_taps():
     # Save attributes from pubsub push subscription message
     data = request.json
-    attributes = data['message']['attributes']
+    message = data['message']
+    attributes = message['attributes']
 
-    # Create respond object and set yelp_location from pubsub message
-    respond = Respond(response_url=attributes['response_url'])
-    yelp_location = attributes['location'].lower()
+    # Continue the slash command's trace, the frontend carries it in the message
+    # attributes, and link back to the push request's own span
+    push_span = trace.get_current_span()
+    with tracer.start_as_current_span(
+        "process_findtaps",
+        context=extract_message_context(attributes),
+        kind=SpanKind.CONSUMER,
+        links=[Link(push_span.get_span_context())],
+    ) as message_span:
+        telemetry.record_queue_age(message.get('publishTime'), "findtaps")
 
-    # Attempt to get data from datastore for this location
-    data_key = datastore_client.key("HappyTaps",yelp_location)
-    data_response = datastore_client.get(data_key)
-
-    # If data is up to date in datastore, use this for response
-    if data_response is not None and (data_response['timestamp'] > datetime.now(tz=timezone.utc) + timedelta(days = -1)):
-        yelp_businesses = data_response['businesses']
-
-    # Otherwise we need to pull new business list from Yelp
-    else:
-        # Format and make request to Yelp API
-        yelp_params = {'location':yelp_location,'term':'bar','limit':YELP_LIMIT,'price':'1,2,3',}
-        with tracer.start_span("yelp_api_call") as yelp_span:
-            r = requests.get(url = YELP_URL, headers=yelp_headers, params=yelp_params)
-        yelp_data = r.json()
-
-        # Respond with error message if no businesses come back from Yelp
-        if 'businesses' not in yelp_data:
-            respond(
-                {
-                    "response_type": "in_channel",
-                    "blocks": [
-                        {
-                            "type": "header",
-                            "text": {
-                                "type": "plain_text",
-                                "text": "No Happy Hour!!!!",
-                            }
-                        },
-                        {
-                            "type": "context",
-                            "elements": [
-                                {
-                                    "type": "mrkdwn",
-                                    "text": "No bars are available near *"+yelp_location+"*! LAME!"
-                                }
-                            ]
-                        }
-                        ]
-                }
-            )
+        # Ack redeliveries of a message that's done or in progress, here or on
+        # another instance, without doing the work again
+        message_id = message.get('messageId') or message.get('message_id')
+        if not push_deduplicator.claim(message_id):
+            message_span.set_attribute("duplicate_delivery", True)
+            logger.info("Suppressed duplicate delivery of message "+message_id)
             return 'Ok', 200
-        # If there are businesses, update in datastore and use for reponse
-        else:
-            yelp_businesses = yelp_data['businesses']
-            with tracer.start_span("update_taps") as update_taps_span:
-                update_taps(yelp_location, yelp_data['businesses'])
-                update_taps_span.set_attribute("num_businesses",len(yelp_data['businesses']))
-            
-    
-    # Ensure we don't exceed size of array when getting random bar
-    num_businesses = len(yelp_businesses)
-    random_choice = random.randint(0,num_businesses-1)
-
-    # Pull bar at random and send reponse to Slack
-    bar = yelp_businesses[random_choice]
-    bar_name = bar['name']
-    bar_url = bar['url']
-    bar_pic = bar['image_url']
-    bar_pretext = "Let's get some drinks near *"+yelp_location+"*, what do you think about this?"
-    respond(
-        {
-            "response_type": "in_channel",
-            "blocks": [
-                {
-                    "type": "header",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Happy Hour!!!!",
-                    }
-                },
-                {
-                    "type": "context",
-                    "elements": [
-                        {
-                            "type": "mrkdwn",
-                            "text": bar_pretext
-                        }
-                    ]
-                },
-                {
-                    "type": "image",
-                    "image_url": bar_pic,
-                    "alt_text": "happy hour pic"
-                },
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": "<"+bar_url+"|"+bar_name+">"
-                    }
-                }
-            ]
-        }
-    )
+
+        # Let a failed message be handled again when pubsub redelivers it
+        try:
+            response = suggest_taps(attributes)
+        except Exception:
+            push_deduplicator.release(message_id)
+            raise
+        push_deduplicator.complete(message_id)
+        return response
+
+
+# Function to generate bar suggestion for Slack
+def suggest_taps(attributes):
+    # Create respond function, a message with several locations gets one
+    # combined answer
+    respond = partial(send_response, attributes['response_url'])
+    if 'locations' in attributes:
+        return suggest_many_taps(attributes, respond)
+
+    # Set yelp_location from pubsub message
+    yelp_location = attributes['location'].lower()
+    popularity.increment(yelp_location)
+
+    # Attempt to get data from the local cache or datastore for this location,
+    # then from the spatial index or Yelp if it's missing or expired
+    try:
+        yelp_businesses = resolve_taps(yelp_location, get_taps(yelp_location))
+    except YelpUnavailable:
+        respond(yelp_unavailable_message(yelp_location))
+        record_time_to_answer(attributes)
+        return 'Ok', 200
+
+    # Pull bar at random, or say there are no bars nearby, and send reponse to Slack
+    respond(suggestion_message(yelp_location, yelp_businesses))
+    record_time_to_answer(attributes)
     return 'Ok', 200
 
 
-# Function to update business list in Cloud Datastore
-def update_taps(yelp_location, updated_businesses):
-    # Define key for datastore
-    data_key = datastore_client.key("HappyTaps",yelp_location)
+# Function to decide which business list answers a location given what the
+# cache or datastore returned for it.  Returns an empty list when there are no
+# bars nearby, raises YelpUnavailable when nothing at all can be served.
+def resolve_taps(yelp_location, data_response):
+    yelp_businesses = cached_answer(yelp_location, data_response, schedule_refresh)
+    if yelp_businesses is not None:
+        return yelp_businesses
+
+    # Otherwise try nearby cells of the spatial index before pulling a new
+    # business list from Yelp
+    yelp_businesses = get_nearby_taps(yelp_location)
+    try:
+        if yelp_businesses is None:
+            yelp_businesses = refresh_taps(yelp_location)
+    except YelpUnavailable as error:
+        return fallback_answer(data_response, error)
+    return yelp_businesses or []
+
+
+# Function to answer a message carrying several locations with one Slack
+# message.  Cached lists come from one batched datastore read, the rest are
+# resolved concurrently so the answer takes about as long as the slowest area.
+def suggest_many_taps(attributes, respond):
+    yelp_locations = parse_locations(attributes['locations'])
+    for yelp_location in yelp_locations:
+        popularity.increment(yelp_location)
+    trace.get_current_span().set_attribute("num_locations", len(yelp_locations))
+
+    data_responses = get_many_taps(yelp_locations)
+    futures = [
+        fanout_executor.submit(contextvars.copy_context().run, resolve_area, yelp_location, data_responses[yelp_location])
+        for yelp_location in yelp_locations
+    ]
+    respond(multi_taps_message([future.result() for future in futures]))
+    record_time_to_answer(attributes)
+    return 'Ok', 200
+
+
+# Function to pick a bar for one area of a multi-location request, returns
+# (yelp_location, bar or None, whether Yelp was unavailable)
+def resolve_area(yelp_location, data_response):
+    with tracer.start_as_current_span("resolve_area") as area_span:
+        area_span.set_attribute("location", yelp_location)
+        try:
+            yelp_businesses = resolve_taps(yelp_location, data_response)
+        except YelpUnavailable:
+            return yelp_location, None, True
+        if not yelp_businesses:
+            return yelp_location, None, False
+        return yelp_location, pick_bar(yelp_businesses), False
+
+
+# Route decorator exposing in-process cache counters
+@app.route('/cachestats', methods=['GET'])
+def cache_stats():
+    return jsonify(location_cache.stats()), 200
+
+
+# Route decorator exposing counts of claimed and duplicate push deliveries
+@app.route('/pushstats', methods=['GET'])
+def push_stats():
+    return jsonify(push_deduplicator.stats()), 200
+
+
+# Route decorator exposing Yelp rate limiter and quota counters
+@app.route('/yelpstats', methods=['GET'])
+def yelp_stats():
+    return jsonify(yelp_limiter.stats()), 200
+
+
+# Route decorator exposing circuit breaker and hedging counters
+@app.route('/breakerstats', methods=['GET'])
+def breaker_stats():
+    return jsonify(collect_breaker_stats()), 200
+
+
+# Route decorator for the readiness probe, answers once clients and connections are warm
+@app.route('/ready', methods=['GET'])
+def ready():
+    if not warmup.wait(READY_TIMEOUT_SECONDS):
+        return jsonify(warmup.stats()), 503
+    return jsonify(warmup.stats()), 200
+
+
+# Route decorator for the scheduled job that pre-warms the hottest locations.
+# Refreshes the top_n most requested locations that are missing or expire within
+# refresh_within_minutes, making at most max_yelp_calls refreshes, concurrency at a time.
+@app.route('/refreshtaps', methods=['POST'])
+def refresh_hot_taps():
+    top_n, max_yelp_calls, concurrency, refresh_within = refresh_options(request.get_json(silent=True))
+    hot_locations, to_refresh = hot_locations_to_refresh(top_n, max_yelp_calls, refresh_within)
+
+    # Refresh them with bounded concurrency, sharing in-flight refreshes
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(refresh_taps_safely, to_refresh))
+    return jsonify(refresh_summary(hot_locations, to_refresh, outcomes)), 200
+
+
+# Function to refresh a location for the pre-warm job, a failed refresh
+# shouldn't stop the others
+def refresh_taps_safely(yelp_location):
+    try:
+        return refresh_outcome(refresh_taps(yelp_location, BACKGROUND))
+    except Exception as error:
+        log_refresh_failure("Pre-warm refresh", yelp_location, error)
+        return "failed"
+
+
+# Function to refresh business list from Yelp, only one refresh per location
+# runs at a time and concurrent requests share its result
+def refresh_taps(yelp_location, priority=INTERACTIVE):
+    current_span = trace.get_current_span()
+    flight = yelp_flight.do(yelp_location, lambda: refresh_taps_leased(yelp_location, priority))
+    current_span.set_attribute("coalesced", flight.shared)
+    current_span.set_attribute("coalesced_waiters", flight.waiters)
+    return flight.value
+
+
+# Function to schedule a background refresh for a stale location, returns
+# False if a refresh for this location is already pending
+def schedule_refresh(yelp_location):
+    with refresh_scheduled_lock:
+        if yelp_location in refresh_scheduled:
+            return False
+        refresh_scheduled.add(yelp_location)
+
+    refresh_executor.submit(background_refresh, yelp_location)
+    return True
+
+
+# Function run on the refresh executor to update a stale location
+def background_refresh(yelp_location):
+    try:
+        with tracer.start_as_current_span("background_refresh") as refresh_span:
+            refresh_span.set_attribute("location", yelp_location)
+            refresh_taps(yelp_location, BACKGROUND)
+    except Exception as error:
+        log_refresh_failure("Background refresh", yelp_location, error)
+    finally:
+        with refresh_scheduled_lock:
+            refresh_scheduled.discard(yelp_location)
+
+
+# Function to refresh business list while holding the datastore lease, if
+# another instance holds it we wait for that instance to store its result.
+# If there is no lease to wait on we fetch without it.
+def refresh_taps_leased(yelp_location, priority):
+    leased = acquire_lease(yelp_location)
+    if leased is None:
+        return fetch_taps(yelp_location, priority)
+    if leased:
+        try:
+            return fetch_taps(yelp_location, priority)
+        finally:
+            release_lease(yelp_location)
+
+    deadline = time.monotonic() + yelp_lease.lease_seconds
+    with tracer.start_span("wait_for_lease") as lease_span:
+        while time.monotonic() < deadline:
+            time.sleep(YELP_LEASE_POLL_SECONDS)
+            try:
+                data_response = get_lease_result(yelp_location)
+            except Exception as error:
+                # The lease holder's result can't be seen, fetch it ourselves
+                logger.warning("Stopped waiting for lease on "+yelp_location+": "+str(error))
+                lease_span.set_attribute("lease_result", "unavailable")
+                break
+            if data_response is not None:
+                lease_span.set_attribute("lease_result", "shared")
+                return data_response['businesses'] or None
+
+        else:
+            # Lease holder didn't finish in time, fetch it ourselves
+            lease_span.set_attribute("lease_result", "timeout")
+    return fetch_taps(yelp_location, priority)
+
+
+# Function to pull new business list from Yelp and store it
+def fetch_taps(yelp_location, priority):
+    # Format and make request to Yelp API
+    with tracer.start_span("yelp_api_call") as yelp_span:
+        yelp_span.set_attribute("priority", priority)
+        yelp_data = fetch_yelp_page(yelp_location, 0, YELP_LIMIT, priority)
+
+    # Store the businesses, or that there are none, and use them for the response
+    yelp_businesses = store_yelp_page(yelp_location, yelp_data)
+    if yelp_businesses is None:
+        return None
+
+    # File the businesses under their cells and fill in the rest of the
+    # candidate pool without holding up the response
+    refresh_executor.submit(index_taps, yelp_location, yelp_data.get('region', {}).get('center'), yelp_businesses)
+    pages = pool_pages(yelp_data)
+    if pages:
+        refresh_executor.submit(fill_pool, yelp_location, yelp_businesses, pages)
+    return yelp_businesses
+
+
+# Function to request one page of bars from the Yelp API, within the rate limit
+def fetch_yelp_page(yelp_location, offset, limit, priority):
+    admit_yelp_call(priority)
+    try:
+        with telemetry.dependency_call("yelp", "search", offset=offset, priority=priority):
+            r = yelp_session.get(url = YELP_URL, params=yelp_search_params(yelp_location, offset, limit))
+    except Exception as error:
+        yelp_breaker.record_failure()
+        raise YelpUnavailable(504) from error
+    yelp_data = r.json() if r.headers.get('Content-Type', '').startswith('application/json') else {}
+    record_yelp_response(priority, r.status_code, r.headers, yelp_data)
+    return yelp_data
+
+
+# Function to fetch the deeper pages of a location's candidate pool concurrently,
+# then store the first page merged with whatever pages came back
+def fill_pool(yelp_location, first_page, pages):
+
+    def fetch_page(page):
+        offset, limit = page
+        try:
+            return fetch_yelp_page(yelp_location, offset, limit, BACKGROUND).get('businesses', [])
+        except YelpRateLimited:
+            return []
+        except Exception:
+            logger.exception("Failed to fetch Yelp page at offset "+str(offset)+" for "+yelp_location)
+            return []
+
+    with tracer.start_as_current_span("fill_pool"):
+        store_pool(yelp_location, first_page, list(page_executor.map(fetch_page, pages)))
+
 
-    # Define element to be updated in datastore
-    # Must exclude 'businesses' from indexes as values are too long
-    data_element = datastore.Entity(key=data_key, exclude_from_indexes=(['businesses']))
-    data_element.update({
-        "businesses":updated_businesses,
-        "timestamp":datetime.now(tz=timezone.utc)
-    })
+# Function to post a message to the Slack response_url over the shared session
+def send_response(response_url, message):
+    with telemetry.dependency_call("slack", "respond"):
+        r = slack_session.post(response_url, json=message)
+    if r.status_code != 200:
+        logger.warning("Slack response_url returned "+str(r.status_code)+": "+r.text)
+    return r
 
-    # Saves the entity to datastore
-    datastore_client.put(data_element)
 
-    
 
 # Start your app
 if __name__ == "__main__":
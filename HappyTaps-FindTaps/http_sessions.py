@@ -0,0 +1,64 @@
+"""
+    Shared HTTP sessions for HappyTaps-FindTaps.
+
+    requests.Session keeps connections alive, so reusing one session per upstream
+    host avoids a new TCP and TLS handshake on every request.  Each session gets a
+    connection pool sized to the number of threads that may use it at once,
+    default connect/read timeouts and retries with exponential backoff.
+    Sessions to metered upstreams like Yelp only retry requests that were never
+    sent, so each request that reaches them has been through the rate limiter.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class TimeoutSession(requests.Session):
+    timeout: tuple
+
+    def __init__(self, timeout: tuple):
+        super().__init__()
+        self.timeout = timeout
+
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+
+def build_session(
+    *,
+    pool_size: int,
+    connect_timeout: float,
+    read_timeout: float,
+    retries: int,
+    backoff_factor: float,
+    headers: dict = None,
+    retry_sent: bool = True,
+) -> requests.Session:
+    # Only idempotent methods are retried on read errors and 5xx responses,
+    # connection errors are retried for every method as nothing was sent yet.
+    # With retry_sent=False only connection errors are retried, for upstreams
+    # that meter every request reaching them.
+    retry = Retry(
+        total=retries,
+        read=None if retry_sent else 0,
+        other=None if retry_sent else 0,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504) if retry_sent else (),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = TimeoutSession(timeout=(connect_timeout, read_timeout))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
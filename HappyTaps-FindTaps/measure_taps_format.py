@@ -0,0 +1,92 @@
+"""
+    Compares the version 1 and version 2 storage formats for cached business
+    lists on a sample of real locations from the HappyTaps kind.
+
+    For each location both formats are written to a scratch kind, then entity
+    size, datastore read latency and decode time are reported for each.  The
+    scratch entities are deleted afterwards.  Run it before switching writers
+    to version 2, locations already stored as version 2 only have the projected
+    fields left to compare.
+
+        python measure_taps_format.py greenpoint nyc williamsburg
+        python measure_taps_format.py --sample 20 --reads 10
+"""
+
+import argparse
+import statistics
+import time
+from google.cloud import datastore
+from google.cloud.datastore.helpers import entity_to_protobuf
+from taps_format import taps_properties, decode_businesses
+
+SCRATCH_KIND = "HappyTaps-FormatBench"
+
+
+def entity_size(entity):
+    return entity_to_protobuf(entity)._pb.ByteSize()
+
+
+def timed_reads(datastore_client, key, reads):
+    latencies = []
+    decode_times = []
+    for _ in range(reads):
+        start = time.perf_counter()
+        entity = datastore_client.get(key)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        decode_businesses(entity)
+        decode_times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies), statistics.median(decode_times)
+
+
+def measure_location(datastore_client, location, reads):
+    source = datastore_client.get(datastore_client.key("HappyTaps", location))
+    if source is None:
+        return None
+    businesses = decode_businesses(source)
+
+    results = {}
+    keys = []
+    for format_version in (1, 2):
+        key = datastore_client.key(SCRATCH_KIND, location+":v"+str(format_version))
+        properties, exclude_from_indexes = taps_properties(businesses, format_version)
+        entity = datastore.Entity(key=key, exclude_from_indexes=exclude_from_indexes)
+        entity.update(properties)
+        entity.update({"timestamp": source["timestamp"]})
+        datastore_client.put(entity)
+        keys.append(key)
+
+        read_ms, decode_ms = timed_reads(datastore_client, key, reads)
+        results[format_version] = (entity_size(entity), read_ms, decode_ms)
+
+    datastore_client.delete_multi(keys)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("locations", nargs="*", help="locations to measure, defaults to a sample of the HappyTaps kind")
+    parser.add_argument("--sample", type=int, default=10, help="number of locations to sample when none are given")
+    parser.add_argument("--reads", type=int, default=5, help="reads per location and format")
+    args = parser.parse_args()
+
+    datastore_client = datastore.Client()
+    locations = args.locations
+    if not locations:
+        query = datastore_client.query(kind="HappyTaps")
+        query.keys_only()
+        locations = [entity.key.name for entity in query.fetch(limit=args.sample)]
+
+    print(f"{'location':<30} {'v1 bytes':>10} {'v2 bytes':>10} {'v1 read ms':>11} {'v2 read ms':>11} {'v1 decode ms':>13} {'v2 decode ms':>13}")
+    for location in locations:
+        results = measure_location(datastore_client, location, args.reads)
+        if results is None:
+            print(f"{location:<30} not cached")
+            continue
+        v1, v2 = results[1], results[2]
+        print(f"{location:<30} {v1[0]:>10} {v2[0]:>10} {v1[1]:>11.1f} {v2[1]:>11.1f} {v1[2]:>13.3f} {v2[2]:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+    Suppresses duplicate Pub/Sub push deliveries for HappyTaps-FindTaps.
+
+    Push delivery is at-least-once, a message whose handler runs past the ack
+    deadline is delivered again, possibly to another instance.  Each message is
+    claimed by its messageId before any work is done, first in an in-process
+    table and then with a short-lived marker entity in Datastore:
+
+    - <message id>    {state, owner_id, expire_at}
+
+    A marker is "in_progress" while a handler works on the message and "done"
+    once it has answered Slack.  Redeliveries that find either are acked without
+    doing anything.  In-progress markers expire quickly so a message whose
+    instance died is picked up again by its next delivery, done markers live
+    long enough to outlast Pub/Sub's redelivery backoff.  A TTL policy on
+    expire_at can clean up old markers.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from google.cloud import datastore
+from google.cloud.datastore import Client
+
+IN_PROGRESS = "in_progress"
+DONE = "done"
+
+
+class PushDeduplicator:
+    datastore_client: Client
+    _datastore_marker_kind: str
+
+    def __init__(
+        self,
+        *,
+        datastore_client: Client,
+        datastore_marker_kind: str,
+        in_progress_seconds: int = 120,
+        done_seconds: int = 3600,
+        max_local_messages: int = 4096,
+        logger: logging.Logger = None,
+    ):
+        self.datastore_client = datastore_client
+        self.in_progress_seconds = in_progress_seconds
+        self.done_seconds = done_seconds
+        self.max_local_messages = max_local_messages
+        self.owner_id = str(uuid4())
+        self._datastore_marker_kind = datastore_marker_kind
+        self._logger = logger or logging.getLogger(__name__)
+        self._messages = OrderedDict()
+        self._lock = threading.Lock()
+        self.claimed = 0
+        self.duplicates = 0
+
+
+    @property
+    def datastore_marker_kind(self) -> str:
+        return self._datastore_marker_kind
+
+
+    def claim(self, message_id: str) -> bool:
+        """ Returns True if this delivery should be handled, False for a duplicate. """
+        if not message_id:
+            return True
+
+        # Redeliveries to this instance never reach Datastore
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            local = self._messages.get(message_id)
+            if local is not None and local[1] > now:
+                self.duplicates += 1
+                return False
+            self._remember(message_id, IN_PROGRESS, now + timedelta(seconds=self.in_progress_seconds))
+
+        try:
+            claimed = self._claim_marker(message_id, now)
+        except Exception:
+            # Handling a message twice beats dropping it
+            self._logger.exception("Failed to claim push message "+message_id)
+            claimed = True
+
+        with self._lock:
+            if claimed:
+                self.claimed += 1
+            else:
+                self.duplicates += 1
+        return claimed
+
+
+    def complete(self, message_id: str):
+        """ Marks a message as answered, later deliveries of it are acked as duplicates. """
+        if not message_id:
+            return
+        expire_at = datetime.now(timezone.utc) + timedelta(seconds=self.done_seconds)
+        with self._lock:
+            self._remember(message_id, DONE, expire_at)
+
+        entity = datastore.Entity(key=self.datastore_client.key(self.datastore_marker_kind, message_id))
+        entity.update({
+            'state': DONE,
+            'owner_id': self.owner_id,
+            'expire_at': expire_at,
+        })
+        try:
+            self.datastore_client.put(entity)
+        except Exception:
+            self._logger.exception("Failed to mark push message "+message_id+" done")
+
+
+    def release(self, message_id: str):
+        """ Drops the claim on a message that failed, so its redelivery is handled. """
+        if not message_id:
+            return
+        with self._lock:
+            self._messages.pop(message_id, None)
+
+        key = self.datastore_client.key(self.datastore_marker_kind, message_id)
+        try:
+            with self.datastore_client.transaction():
+                entity = self.datastore_client.get(key)
+                if entity is not None and entity['owner_id'] == self.owner_id and entity['state'] == IN_PROGRESS:
+                    self.datastore_client.delete(key)
+        except Exception:
+            self._logger.exception("Failed to release push message "+message_id)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tracked": len(self._messages),
+                "claimed": self.claimed,
+                "duplicates": self.duplicates,
+            }
+
+
+    def _claim_marker(self, message_id: str, now: datetime) -> bool:
+        key = self.datastore_client.key(self.datastore_marker_kind, message_id)
+        with self.datastore_client.transaction():
+            entity = self.datastore_client.get(key)
+            if entity is not None and entity['expire_at'] > now and entity['owner_id'] != self.owner_id:
+                # Keep a done message so local redeliveries stop here too, but
+                # not one in progress elsewhere, its handler may still release it
+                with self._lock:
+                    if entity['state'] == DONE:
+                        self._remember(message_id, DONE, entity['expire_at'])
+                    else:
+                        self._messages.pop(message_id, None)
+                return False
+
+            entity = datastore.Entity(key=key)
+            entity.update({
+                'state': IN_PROGRESS,
+                'owner_id': self.owner_id,
+                'expire_at': now + timedelta(seconds=self.in_progress_seconds),
+            })
+            self.datastore_client.put(entity)
+        return True
+
+
+    def _remember(self, message_id: str, state: str, expire_at: datetime):
+        self._messages[message_id] = (state, expire_at)
+        self._messages.move_to_end(message_id)
+        while len(self._messages) > self.max_local_messages:
+            self._messages.popitem(last=False)
@@ -0,0 +1,122 @@
+"""
+    Replays a log of real /happytaps queries and reports the cache hit ratio
+    with and without the geohash spatial index.
+
+    Each line of the query log is a location, optionally preceded by an ISO
+    timestamp and a tab so entries can expire during the replay:
+
+        2022-06-01T17:02:11+00:00<TAB>greenpoint
+
+    Queries are resolved to cells through the HappyTaps-Alias kind, and the
+    businesses a Yelp call would have filed are taken from the HappyTaps kind,
+    so the replay makes no Yelp calls and writes nothing.  Queries whose text
+    has never been resolved are counted as misses for both policies.
+
+        python replay_geo_hit_ratio.py queries.log
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from google.cloud import datastore
+
+import geohash
+from spatial_index import normalize_location
+from taps_format import decode_businesses
+
+TAPS_TTL = timedelta(days = 1)
+
+
+def read_queries(path):
+    queries = []
+    with open(path) as query_log:
+        for line in query_log:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            if "\t" in line:
+                timestamp, location = line.split("\t", 1)
+                queries.append((datetime.fromisoformat(timestamp), location.lower()))
+            else:
+                queries.append((None, line.lower()))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("query_log", help="file with one query per line")
+    parser.add_argument("--precision", type=int, default=6, help="geohash precision of the index")
+    parser.add_argument("--min-businesses", type=int, default=5, help="businesses needed to answer from cells")
+    args = parser.parse_args()
+
+    datastore_client = datastore.Client()
+    queries = read_queries(args.query_log)
+    distinct = sorted({location for _, location in queries})
+
+    # Resolve every distinct query to a cell and to the cells its businesses fall in
+    aliases = {}
+    business_cells = {}
+    for start in range(0, len(distinct), 500):
+        batch = distinct[start:start + 500]
+        alias_keys = [datastore_client.key("HappyTaps-Alias", normalize_location(location)) for location in batch]
+        resolved = {entity.key.name: entity["cell"] for entity in datastore_client.get_multi(alias_keys)}
+        taps_keys = [datastore_client.key("HappyTaps", location) for location in batch]
+        for entity in datastore_client.get_multi(taps_keys):
+            cells = {}
+            for business in decode_businesses(entity):
+                coordinates = business.get("coordinates") or {}
+                if coordinates.get("latitude") is not None and coordinates.get("longitude") is not None:
+                    cell = geohash.encode(coordinates["latitude"], coordinates["longitude"], args.precision)
+                    cells.setdefault(cell, set()).add(business.get("id"))
+            business_cells[entity.key.name] = cells
+        for location in batch:
+            cell = resolved.get(normalize_location(location))
+            if cell is not None:
+                aliases[location] = cell[:args.precision]
+
+    # Replay, a Yelp call fills the location's key and the cells of its businesses
+    keyed_fetched = {}
+    geo_fetched = {}
+    cell_fetched = {}
+    keyed_hits = 0
+    geo_hits = 0
+    unresolved = 0
+    for index, (timestamp, location) in enumerate(queries):
+        now = timestamp or datetime.min + timedelta(seconds=index)
+
+        def fresh(fetched_at):
+            return fetched_at is not None and (timestamp is None or fetched_at > now - TAPS_TTL)
+
+        if location not in aliases:
+            unresolved += 1
+
+        if fresh(keyed_fetched.get(location)):
+            keyed_hits += 1
+        else:
+            keyed_fetched[location] = now
+
+        cell = aliases.get(location)
+        nearby = set()
+        if cell is not None:
+            for name in [cell] + geohash.neighbours(cell):
+                for business_id, fetched_at in cell_fetched.get(name, {}).items():
+                    if fresh(fetched_at):
+                        nearby.add(business_id)
+
+        if fresh(geo_fetched.get(location)) or len(nearby) >= args.min_businesses:
+            geo_hits += 1
+        else:
+            geo_fetched[location] = now
+            for name, business_ids in business_cells.get(location, {}).items():
+                for business_id in business_ids:
+                    cell_fetched.setdefault(name, {})[business_id] = now
+
+    total = len(queries) or 1
+    print(f"queries:                 {len(queries)}")
+    print(f"distinct locations:      {len(distinct)}")
+    print(f"unresolved locations:    {unresolved} queries")
+    print(f"keyed cache hit ratio:   {keyed_hits / total:.1%} ({len(queries) - keyed_hits} Yelp calls)")
+    print(f"geo index hit ratio:     {geo_hits / total:.1%} ({len(queries) - geo_hits} Yelp calls)")
+
+
+if __name__ == "__main__":
+    main()
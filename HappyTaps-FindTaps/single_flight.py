@@ -0,0 +1,162 @@
+"""
+    Single-flight coalescing for HappyTaps-FindTaps.
+
+    SingleFlight makes sure only one thread in the process runs the work for a
+    given key at a time, any other threads asking for the same key wait for that
+    call and share its result.  AsyncSingleFlight does the same for coroutines
+    running on one event loop.
+
+    DatastoreLease extends this across Cloud Run instances.  The instance holding
+    the lease entity for a key does the work, the others wait for its result to
+    show up in Datastore.  Leases expire on their own so a crashed instance can't
+    block a key forever.
+"""
+
+import asyncio
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from google.cloud import datastore
+from google.cloud.datastore import Client, Entity
+
+
+FlightResult = namedtuple("FlightResult", ["value", "shared", "waiters"])
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+
+    def do(self, key: str, fn) -> FlightResult:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        # Someone else is already doing the work, wait for their result
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return FlightResult(call.value, True, call.waiters)
+
+        try:
+            call.value = fn()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return FlightResult(call.value, False, call.waiters)
+
+
+
+class _AsyncCall:
+    def __init__(self, future):
+        self.future = future
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+
+
+    async def do(self, key: str, coro_fn) -> FlightResult:
+        call = self._calls.get(key)
+
+        # Someone else is already doing the work, wait for their result
+        if call is not None:
+            call.waiters += 1
+            value = await asyncio.shield(call.future)
+            return FlightResult(value, True, call.waiters)
+
+        call = _AsyncCall(asyncio.get_running_loop().create_future())
+        self._calls[key] = call
+        try:
+            value = await coro_fn()
+        except asyncio.CancelledError:
+            call.future.cancel()
+            raise
+        except Exception as error:
+            call.future.set_exception(error)
+            # Nobody else will retrieve the exception if there were no waiters
+            if call.waiters == 0:
+                call.future.exception()
+            raise
+        else:
+            call.future.set_result(value)
+        finally:
+            del self._calls[key]
+
+        return FlightResult(value, False, call.waiters)
+
+
+
+class DatastoreLease:
+    datastore_client: Client
+    _datastore_lease_kind: str
+
+    def __init__(
+        self,
+        *,
+        datastore_client: Client,
+        datastore_lease_kind: str,
+        lease_seconds: int,
+    ):
+        self.datastore_client = datastore_client
+        self.lease_seconds = lease_seconds
+        self.owner_id = str(uuid4())
+        self._datastore_lease_kind = datastore_lease_kind
+
+
+    @property
+    def datastore_lease_kind(self) -> str:
+        return self._datastore_lease_kind
+
+
+    def acquire(self, name: str) -> bool:
+        key = self.datastore_client.key(self.datastore_lease_kind, name)
+        now = datetime.now(timezone.utc)
+        with self.datastore_client.transaction():
+            entity = self.datastore_client.get(key)
+            if entity is not None and entity['expire_at'] > now and entity['owner_id'] != self.owner_id:
+                return False
+
+            entity: Entity = datastore.Entity(key=key)
+            entity.update({
+                'owner_id': self.owner_id,
+                'expire_at': now + timedelta(seconds=self.lease_seconds),
+            })
+            self.datastore_client.put(entity)
+        return True
+
+
+    def release(self, name: str):
+        key = self.datastore_client.key(self.datastore_lease_kind, name)
+        with self.datastore_client.transaction():
+            entity = self.datastore_client.get(key)
+            if entity is not None and entity['owner_id'] == self.owner_id:
+                self.datastore_client.delete(key)
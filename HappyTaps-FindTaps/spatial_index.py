@@ -0,0 +1,184 @@
+"""
+    Geohash spatial index for cached businesses.
+
+    Businesses returned by Yelp are stored per geohash cell using their
+    coordinates, and the location text of each query is recorded in an alias
+    table pointing at the cell of the region Yelp resolved it to:
+
+    - <cell kind>  / <geohash>            businesses in the cell + timestamp
+    - <alias kind> / <normalized text>    {cell}
+
+    A query whose alias is known is answered from its cell and the eight cells
+    around it, so "greenpoint", "greenpoint brooklyn" and "11222" share the same
+    businesses no matter which of them last went to Yelp.  Aliases are cached in
+    memory, cells are read with a single get_multi.  Indexing merges into the
+    stored cells in a transaction, so instances indexing the same cell at once
+    don't drop each other's businesses.
+"""
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from google.api_core.exceptions import Aborted, Conflict
+from google.cloud import datastore
+from google.cloud.datastore import Client
+
+import geohash
+from taps_format import taps_properties, decode_businesses, project_businesses
+
+
+def normalize_location(location: str) -> str:
+    """ Lowercases and strips punctuation and extra whitespace from location text. """
+    return " ".join(re.sub(r"[^\w\s]", " ", location.lower()).split())
+
+
+class SpatialIndex:
+    datastore_client: Client
+    _datastore_cell_kind: str
+    _datastore_alias_kind: str
+
+    def __init__(
+        self,
+        *,
+        datastore_client: Client,
+        datastore_cell_kind: str,
+        datastore_alias_kind: str,
+        precision: int = 6,
+        max_cell_businesses: int = 200,
+        alias_cache_size: int = 4096,
+        max_attempts: int = 3,
+        logger: logging.Logger = None,
+    ):
+        self.datastore_client = datastore_client
+        self.precision = precision
+        self.max_cell_businesses = max_cell_businesses
+        self.alias_cache_size = alias_cache_size
+        self.max_attempts = max_attempts
+        self._datastore_cell_kind = datastore_cell_kind
+        self._datastore_alias_kind = datastore_alias_kind
+        self._logger = logger or logging.getLogger(__name__)
+        self._aliases = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    @property
+    def datastore_cell_kind(self) -> str:
+        return self._datastore_cell_kind
+
+
+    @property
+    def datastore_alias_kind(self) -> str:
+        return self._datastore_alias_kind
+
+
+    def resolve(self, location: str) -> Optional[str]:
+        """ Returns the cell a location's text was last resolved to, if any. """
+        alias = normalize_location(location)
+        with self._lock:
+            if alias in self._aliases:
+                self._aliases.move_to_end(alias)
+                return self._aliases[alias]
+
+        entity = self.datastore_client.get(self.datastore_client.key(self.datastore_alias_kind, alias))
+        if entity is None:
+            return None
+        self._remember_alias(alias, entity["cell"])
+        return entity["cell"]
+
+
+    def lookup(self, location: str, max_age: timedelta):
+        """ Returns (businesses, oldest timestamp) near a location, or (None, None). """
+        cell = self.resolve(location)
+        if cell is None:
+            return None, None
+
+        cells = [cell] + geohash.neighbours(cell)
+        keys = [self.datastore_client.key(self.datastore_cell_kind, name) for name in cells]
+        oldest_allowed = datetime.now(tz=timezone.utc) - max_age
+
+        # Businesses in the query's own cell come first
+        entities = sorted(
+            self.datastore_client.get_multi(keys),
+            key=lambda entity: cells.index(entity.key.name),
+        )
+        businesses = []
+        seen = set()
+        oldest = None
+        for entity in entities:
+            if entity["timestamp"] <= oldest_allowed:
+                continue
+            oldest = entity["timestamp"] if oldest is None else min(oldest, entity["timestamp"])
+            for business in decode_businesses(entity):
+                if business.get("id") not in seen:
+                    seen.add(business.get("id"))
+                    businesses.append(business)
+
+        if not businesses:
+            return None, None
+        return businesses, oldest
+
+
+    def index(self, location: str, region_center: Optional[dict], businesses: list):
+        """ Records a location's alias and files its businesses under their cells. """
+        timestamp = datetime.now(tz=timezone.utc)
+
+        if region_center and region_center.get("latitude") is not None:
+            alias = normalize_location(location)
+            cell = geohash.encode(region_center["latitude"], region_center["longitude"], self.precision)
+            alias_entity = datastore.Entity(key=self.datastore_client.key(self.datastore_alias_kind, alias))
+            alias_entity.update({"cell": cell, "timestamp": timestamp})
+            self.datastore_client.put(alias_entity)
+            self._remember_alias(alias, cell)
+
+        # Group businesses by the cell they fall in
+        by_cell = {}
+        for business in project_businesses(businesses):
+            coordinates = business.get("coordinates") or {}
+            if coordinates.get("latitude") is None or coordinates.get("longitude") is None:
+                continue
+            cell = geohash.encode(coordinates["latitude"], coordinates["longitude"], self.precision)
+            by_cell.setdefault(cell, {})[business.get("id")] = business
+
+        # Transactions are limited to 500 mutations
+        cells = list(by_cell)
+        for start in range(0, len(cells), 500):
+            self._merge_cells({cell: by_cell[cell] for cell in cells[start:start + 500]}, timestamp)
+
+
+    def _merge_cells(self, by_cell: dict, timestamp: datetime):
+        """ Merges businesses by id into their stored cells, retrying when another instance commits first. """
+        keys = [self.datastore_client.key(self.datastore_cell_kind, cell) for cell in by_cell]
+        for attempt in range(self.max_attempts):
+            try:
+                with self.datastore_client.transaction():
+                    # The newest copy of a business wins
+                    merged = {cell: dict(cell_businesses) for cell, cell_businesses in by_cell.items()}
+                    for existing in self.datastore_client.get_multi(keys):
+                        for business in decode_businesses(existing):
+                            merged[existing.key.name].setdefault(business.get("id"), business)
+
+                    entities = []
+                    for key in keys:
+                        properties, exclude_from_indexes = taps_properties(list(merged[key.name].values())[:self.max_cell_businesses])
+                        cell_entity = datastore.Entity(key=key, exclude_from_indexes=exclude_from_indexes)
+                        cell_entity.update(properties)
+                        cell_entity.update({"timestamp": timestamp})
+                        entities.append(cell_entity)
+                    self.datastore_client.put_multi(entities)
+                return
+            except (Aborted, Conflict):
+                if attempt == self.max_attempts - 1:
+                    raise
+                self._logger.info("Retrying contended spatial index write")
+
+
+    def _remember_alias(self, alias: str, cell: str):
+        with self._lock:
+            self._aliases[alias] = cell
+            self._aliases.move_to_end(alias)
+            while len(self._aliases) > self.alias_cache_size:
+                self._aliases.popitem(last=False)
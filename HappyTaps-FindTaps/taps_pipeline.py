@@ -0,0 +1,642 @@
+"""
+    The resolve and refresh pipeline of HappyTaps-FindTaps, shared by the Flask
+    entrypoint (happytaps-findtaps.py) and the asyncio one
+    (happytaps-findtaps-async.py).
+
+    A location is answered from the in-process cache, then the taps store, then
+    the spatial index and finally Yelp.  Stale lists within the grace window
+    are served while they are refreshed in the background, and when Yelp can't
+    answer the last list we have is served however old it is.  Yelp refreshes
+    go through the rate limiter and circuit breaker, and the instance holding
+    a location's Datastore lease makes the call for everyone.
+
+    The functions here don't block or only block on Datastore.  Calling Yelp
+    and Slack and scheduling concurrent work is left to the entrypoints, the
+    asyncio one runs the blocking functions on its executor.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import datastore
+
+from taps_cache import LocationCache
+from single_flight import DatastoreLease
+from taps_messages import no_taps_message, taps_message
+from taps_format import FORMAT_VERSION, project_businesses
+from taps_store import build_taps_store
+from popularity import PopularityCounter
+from spatial_index import SpatialIndex
+from yelp_limiter import YelpRateLimiter
+from push_dedupe import PushDeduplicator
+from circuit_breaker import CircuitBreaker, Hedger
+from taps_telemetry import TapsTelemetry, LazySpanExporter
+from lazy_clients import LazyClient
+
+# Tracing
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.propagate import set_global_textmap
+from opentelemetry.propagators.cloud_trace_propagator import (
+    CloudTraceFormatPropagator,
+)
+
+set_global_textmap(CloudTraceFormatPropagator())
+
+tracer_provider = TracerProvider()
+
+# Function to build the Cloud Trace exporter, imported here as it is only
+# needed once the first batch of spans goes out
+def build_cloud_trace_exporter():
+    from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+    return CloudTraceSpanExporter()
+
+
+# Export spans to Cloud Trace, can be turned off to run without GCP credentials
+# e.g. under benchmark_findtaps.py.  The exporter is built in the background.
+if os.environ.get("CLOUD_TRACE_ENABLED", "true") == "true":
+    cloud_trace_exporter = LazySpanExporter(LazyClient(name="cloud_trace", factory=build_cloud_trace_exporter).start())
+    tracer_provider.add_span_processor(
+        # BatchSpanProcessor buffers spans and sends them in batches in a
+        # background thread. The default parameters are sensible, but can be
+        # tweaked to optimize your performance
+        BatchSpanProcessor(cloud_trace_exporter)
+    )
+trace.set_tracer_provider(tracer_provider)
+
+tracer = trace.get_tracer(__name__)
+
+# Dependency latency, cache and Yelp call metrics, see taps_telemetry.py
+telemetry = TapsTelemetry(service_name="happytaps-findtaps")
+
+logger = logging.getLogger(__name__)
+
+# Define values to be used with Yelp Fusion API calls
+YELP_URL = os.environ.get("YELP_URL", "https://api.yelp.com/v3/businesses/search")
+YELP_LIMIT = 20
+
+# Candidate pool per location, the first YELP_LIMIT businesses are stored and
+# served right away while deeper pages of up to YELP_PAGE_SIZE are fetched
+# concurrently in the background.  Yelp caps offset + limit at 1000.
+YELP_PAGE_SIZE = 50
+YELP_POOL_DEPTH = min(int(os.environ.get("YELP_POOL_DEPTH", YELP_LIMIT)), 1000)
+YELP_PAGE_WORKERS = int(os.environ.get("YELP_PAGE_WORKERS", 4))
+yelp_api_key = os.environ.get("YELP_API_KEY")
+yelp_headers = {'Authorization':'Bearer '+yelp_api_key}
+
+# Business lists are considered fresh for one day after they are pulled from Yelp
+TAPS_TTL = timedelta(days = 1)
+
+# Past that, stale business lists are still served for a grace window while
+# they are refreshed in the background, set to 0 to disable
+TAPS_STALE_GRACE = timedelta(hours = float(os.environ.get("STALE_GRACE_HOURS", 12)))
+TAPS_MAX_AGE = TAPS_TTL + TAPS_STALE_GRACE
+
+# Locations Yelp has no bars for are remembered for a short while, stored as
+# an empty business list.  Transient Yelp errors (429/5xx) are never cached.
+TAPS_NEGATIVE_TTL = timedelta(minutes = float(os.environ.get("NEGATIVE_CACHE_MINUTES", 30)))
+
+# Storage format written for business lists, readers handle every version
+TAPS_FORMAT_VERSION = int(os.environ.get("TAPS_FORMAT_VERSION", FORMAT_VERSION))
+
+# A single command may ask for up to MAX_LOCATIONS areas, resolved concurrently
+MAX_LOCATIONS = int(os.environ.get("MAX_LOCATIONS", 5))
+
+# Google datastore client, built in the background while the app loads and on
+# first use at the latest
+datastore_client = LazyClient(name="datastore", factory=datastore.Client, logger=logger).start()
+
+# Store for business lists, TAPS_STORE=sqlite or memory keeps them on this
+# instance instead of in datastore, e.g. to run without the network
+TAPS_STORE = os.environ.get("TAPS_STORE", "datastore")
+taps_store = build_taps_store(
+    TAPS_STORE,
+    datastore_client=datastore_client,
+    sqlite_path=os.environ.get("TAPS_STORE_PATH", "happytaps.db"),
+    format_version=TAPS_FORMAT_VERSION,
+)
+
+# In-process cache of business lists, sits in front of datastore
+location_cache = LocationCache(
+    max_size=int(os.environ.get("LOCATION_CACHE_SIZE", 512)),
+    ttl=TAPS_MAX_AGE,
+)
+
+# Coalesce concurrent Yelp refreshes for the same location across instances
+# through a lease entity in datastore, the entrypoints coalesce them within
+# the process
+yelp_lease = DatastoreLease(
+    datastore_client=datastore_client,
+    datastore_lease_kind="HappyTaps-Lease",
+    lease_seconds=int(os.environ.get("YELP_LEASE_SECONDS", 10)),
+)
+YELP_LEASE_POLL_SECONDS = 0.25
+
+# Lease waiters poll the taps store for the holder's result, which only works
+# when every instance shares the store, so the lease is off by default for the
+# sqlite and memory stores and can't be turned on for them
+YELP_LEASE_ENABLED = os.environ.get("YELP_LEASE_ENABLED", "true" if taps_store.shared else "false") == "true"
+if YELP_LEASE_ENABLED and not taps_store.shared:
+    raise ValueError("YELP_LEASE_ENABLED needs a taps store shared by all instances, TAPS_STORE="+TAPS_STORE+" is not")
+
+# Client-side limits on Yelp calls.  The token bucket is per instance, the daily
+# quota is shared by all instances through datastore.  Interactive misses wait up
+# to YELP_MAX_WAIT_SECONDS for a token, background refreshes don't wait.
+yelp_limiter = YelpRateLimiter(
+    datastore_client=datastore_client,
+    datastore_quota_kind="HappyTaps-YelpQuota",
+    max_qps=float(os.environ.get("YELP_MAX_QPS", 5)),
+    burst=int(os.environ.get("YELP_BURST", 10)),
+    daily_limit=int(os.environ.get("YELP_DAILY_LIMIT", 5000)),
+    max_wait_seconds=float(os.environ.get("YELP_MAX_WAIT_SECONDS", 2)),
+    logger=logger,
+)
+
+
+# Function to record circuit breaker state changes on the current span
+def record_breaker_state(name, old_state, new_state):
+    trace.get_current_span().add_event("circuit_state_change", {"breaker": name, "from_state": old_state, "to_state": new_state})
+
+
+# Circuit breakers around Yelp and datastore, while one is open calls fail
+# fast and requests are answered from whatever is cached
+DATASTORE_TIMEOUT = float(os.environ.get("DATASTORE_TIMEOUT_SECONDS", 5))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", 30))
+yelp_breaker = CircuitBreaker(
+    name="yelp",
+    failure_threshold=BREAKER_FAILURES,
+    reset_seconds=BREAKER_RESET_SECONDS,
+    on_state_change=record_breaker_state,
+    logger=logger,
+)
+datastore_breaker = CircuitBreaker(
+    name="datastore",
+    failure_threshold=BREAKER_FAILURES,
+    reset_seconds=BREAKER_RESET_SECONDS,
+    on_state_change=record_breaker_state,
+    logger=logger,
+)
+
+# Hedged datastore reads, a backup get is sent once the first one has taken
+# longer than the recent p95 of datastore reads.  DATASTORE_HEDGE_WORKERS
+# bounds the reads in flight, primaries and backups together.
+DATASTORE_HEDGING = os.environ.get("DATASTORE_HEDGING", "false") == "true"
+datastore_hedger = Hedger(
+    executor=ThreadPoolExecutor(max_workers=int(os.environ.get("DATASTORE_HEDGE_WORKERS", 32))),
+    percentile=0.95,
+) if DATASTORE_HEDGING else None
+
+# Spatial index of businesses by geohash cell, lets nearby queries with
+# different location text share results.  Only used when a cell and its
+# neighbours hold at least GEO_MIN_BUSINESSES fresh businesses.
+GEO_INDEX_ENABLED = os.environ.get("GEO_INDEX_ENABLED", "true") == "true"
+GEO_MIN_BUSINESSES = int(os.environ.get("GEO_MIN_BUSINESSES", 5))
+spatial_index = SpatialIndex(
+    datastore_client=datastore_client,
+    datastore_cell_kind="HappyTaps-Cell",
+    datastore_alias_kind="HappyTaps-Alias",
+    precision=int(os.environ.get("GEO_PRECISION", 6)),
+    logger=logger,
+) if GEO_INDEX_ENABLED else None
+
+# Per-location request counters, flushed to datastore in batches and used to
+# pre-warm the hottest locations before they expire
+popularity = PopularityCounter(
+    datastore_client=datastore_client,
+    datastore_counter_kind="HappyTaps-Popularity",
+    flush_interval_seconds=float(os.environ.get("POPULARITY_FLUSH_SECONDS", 30)),
+    logger=logger,
+)
+
+# Pub/Sub push is at-least-once, deliveries are claimed by messageId so a
+# redelivered message is acked without a second Yelp call or Slack post
+push_deduplicator = PushDeduplicator(
+    datastore_client=datastore_client,
+    datastore_marker_kind="HappyTaps-Push",
+    in_progress_seconds=int(os.environ.get("PUSH_IN_PROGRESS_SECONDS", 120)),
+    done_seconds=int(os.environ.get("PUSH_DONE_SECONDS", 3600)),
+    logger=logger,
+)
+
+# GET /ready waits up to READY_TIMEOUT_SECONDS for the warm-up checks.  Set
+# SLACK_WARMUP_URL empty to skip warming the Slack connection pool.
+READY_TIMEOUT_SECONDS = float(os.environ.get("READY_TIMEOUT_SECONDS", 10))
+SLACK_WARMUP_URL = os.environ.get("SLACK_WARMUP_URL", "https://hooks.slack.com")
+
+
+# Raised when Yelp can't answer right now, as opposed to having no bars for a location
+class YelpUnavailable(Exception):
+    def __init__(self, status_code):
+        super().__init__("Yelp returned "+str(status_code))
+        self.status_code = status_code
+
+
+# Raised when our own rate limit or daily Yelp budget won't allow a call right now
+class YelpRateLimited(YelpUnavailable):
+    def __init__(self):
+        super().__init__(429)
+
+
+# Function for the datastore warm-up check, builds the client and opens its channel
+def check_datastore():
+    datastore_client.get(datastore_client.key("HappyTaps-Warmup", "warmup"), timeout=DATASTORE_TIMEOUT)
+
+
+# Function to choose the bar to suggest for a location, and the Slack message
+# suggesting it or saying there are no bars nearby
+def suggestion_message(yelp_location, yelp_businesses):
+    if not yelp_businesses:
+        return no_taps_message(yelp_location)
+    return taps_message(yelp_location, pick_bar(yelp_businesses))
+
+
+# Function to pick a bar at random from a non-empty business list
+def pick_bar(yelp_businesses):
+    return yelp_businesses[random.randint(0,len(yelp_businesses)-1)]
+
+
+# Function to answer a location from what the cache or store returned for it,
+# without going to Yelp.  Returns the business list to serve, or None if the
+# location has to be looked up nearby or refreshed.  Stale lists within the
+# grace window are served and handed to schedule_refresh.
+def cached_answer(yelp_location, data_response, schedule_refresh):
+    now = datetime.now(tz=timezone.utc)
+    current_span = trace.get_current_span()
+    if data_response is None:
+        return None
+
+    # If Yelp recently told us there are no bars here, say so right away
+    if not data_response['businesses']:
+        if data_response['timestamp'] > now - TAPS_NEGATIVE_TTL:
+            current_span.set_attribute("negative_hit", True)
+            return []
+        return None
+
+    # If data is up to date in cache, use this for response
+    if data_response['timestamp'] > now - TAPS_TTL:
+        return data_response['businesses']
+
+    # If data is stale but within the grace window, respond with it right away
+    # and refresh from Yelp in the background
+    if data_response['timestamp'] > now - TAPS_MAX_AGE:
+        current_span.set_attribute("stale_hit", True)
+        current_span.set_attribute("background_refresh", schedule_refresh(yelp_location))
+        return data_response['businesses']
+    return None
+
+
+# Function to answer a location when Yelp couldn't, with the last business
+# list we have for it however old it is.  Raises the error if there is none.
+def fallback_answer(data_response, error):
+    current_span = trace.get_current_span()
+    current_span.set_attribute("yelp_unavailable", error.status_code)
+    if data_response is None or not data_response['businesses']:
+        raise error
+    current_span.set_attribute("degraded", True)
+    return data_response['businesses']
+
+
+# Function to parse the JSON list of locations in a multi-location message,
+# lowercased, without repeats and capped at MAX_LOCATIONS
+def parse_locations(locations):
+    yelp_locations = []
+    for yelp_location in json.loads(locations):
+        yelp_location = str(yelp_location).strip().lower()
+        if yelp_location and yelp_location not in yelp_locations:
+            yelp_locations.append(yelp_location)
+    return yelp_locations[:MAX_LOCATIONS]
+
+
+# Function to report time from the slash command to the Slack answer, the
+# frontend sends requested_at with every request it routes through pubsub
+def record_time_to_answer(attributes):
+    if 'requested_at' not in attributes:
+        return
+    time_to_answer_ms = (time.time() - float(attributes['requested_at'])) * 1000
+    current_span = trace.get_current_span()
+    current_span.set_attribute("path", "pubsub")
+    current_span.set_attribute("time_to_answer_ms", time_to_answer_ms)
+    logger.info("happytaps path=pubsub location="+attributes['location']+" time_to_answer_ms="+str(round(time_to_answer_ms)))
+
+
+# Function to get a business list from the local cache, the first tier, which
+# answers popular locations without a network hop
+def get_local_taps(yelp_location):
+    data_response = location_cache.get(yelp_location)
+    if data_response is not None:
+        telemetry.record_cache_lookup("local")
+    return data_response
+
+
+# Function to get a business list from the taps store, the second tier, shared
+# across instances unless the store is local
+def get_stored_taps(yelp_location):
+    try:
+        data_response = store_get(yelp_location)
+    except Exception as error:
+        # The store is failing or its circuit is open, fall back to an expired local copy
+        logger.warning("Taps store read failed for "+yelp_location+": "+str(error))
+        data_response = location_cache.get_stale(yelp_location)
+        telemetry.record_cache_lookup("stale" if data_response is not None else "miss")
+        return data_response
+    if data_response is None:
+        telemetry.record_cache_lookup("miss")
+        return None
+
+    telemetry.record_cache_lookup(taps_store.name)
+    location_cache.put(yelp_location, data_response['businesses'], data_response['timestamp'], None if data_response['businesses'] else TAPS_NEGATIVE_TTL)
+    return data_response
+
+
+# Function to get business list, checking the local cache before the taps store
+def get_taps(yelp_location):
+    data_response = get_local_taps(yelp_location)
+    if data_response is not None:
+        return data_response
+    return get_stored_taps(yelp_location)
+
+
+# Function to get business lists for several locations, checking the local
+# cache first and reading the rest from the taps store in one batch.  Returns a dict
+# of location to business list, or None where nothing is stored.
+def get_many_taps(yelp_locations):
+    data_responses = {}
+    missing = []
+    for yelp_location in yelp_locations:
+        data_responses[yelp_location] = get_local_taps(yelp_location)
+        if data_responses[yelp_location] is None:
+            missing.append(yelp_location)
+    if not missing:
+        return data_responses
+
+    try:
+        records = store_get_multi(missing)
+    except Exception as error:
+        # The store is failing or its circuit is open, fall back to expired local copies
+        logger.warning("Taps store read failed for "+", ".join(missing)+": "+str(error))
+        for yelp_location in missing:
+            data_responses[yelp_location] = location_cache.get_stale(yelp_location)
+            telemetry.record_cache_lookup("stale" if data_responses[yelp_location] is not None else "miss")
+        return data_responses
+
+    for yelp_location in missing:
+        data_response = records.get(yelp_location)
+        if data_response is None:
+            telemetry.record_cache_lookup("miss")
+            continue
+        telemetry.record_cache_lookup(taps_store.name)
+        location_cache.put(yelp_location, data_response['businesses'], data_response['timestamp'], None if data_response['businesses'] else TAPS_NEGATIVE_TTL)
+        data_responses[yelp_location] = data_response
+    return data_responses
+
+
+# Function to read several business lists in one batch through the datastore
+# breaker
+def store_get_multi(yelp_locations):
+    with telemetry.dependency_call(taps_store.name, "get_multi", num_keys=len(yelp_locations)):
+        return datastore_breaker.call(taps_store.get_multi, yelp_locations, timeout=DATASTORE_TIMEOUT)
+
+
+# Function to read a business list through the datastore breaker, hedging the
+# read when enabled
+def store_get(yelp_location):
+    with telemetry.dependency_call(taps_store.name, "get") as get_span:
+        if datastore_hedger is None:
+            return datastore_breaker.call(taps_store.get, yelp_location, timeout=DATASTORE_TIMEOUT)
+        data_response, hedge_won = datastore_breaker.call(datastore_hedger.call, taps_store.get, yelp_location, timeout=DATASTORE_TIMEOUT)
+        get_span.set_attribute("hedge_won", hedge_won)
+        return data_response
+
+
+# Function to get fresh businesses near a location from the spatial index,
+# returns None if there aren't enough of them or the index can't be read
+def get_nearby_taps(yelp_location):
+    if spatial_index is None:
+        return None
+
+    try:
+        with tracer.start_span("geo_lookup") as geo_span:
+            yelp_businesses, oldest = datastore_breaker.call(spatial_index.lookup, yelp_location, TAPS_TTL)
+            geo_span.set_attribute("num_businesses", len(yelp_businesses or []))
+    except Exception as error:
+        logger.warning("Spatial index lookup failed for "+yelp_location+": "+str(error))
+        return None
+    if yelp_businesses is None or len(yelp_businesses) < GEO_MIN_BUSINESSES:
+        return None
+
+    telemetry.record_cache_lookup("geo")
+    location_cache.put(yelp_location, yelp_businesses, oldest)
+    return yelp_businesses
+
+
+# Function to file businesses in the spatial index, runs in the background
+def index_taps(yelp_location, region_center, yelp_businesses):
+    if spatial_index is None:
+        return
+    try:
+        with tracer.start_as_current_span("index_taps") as index_span:
+            index_span.set_attribute("location", yelp_location)
+            spatial_index.index(yelp_location, region_center, yelp_businesses)
+    except Exception:
+        logger.exception("Failed to index businesses for "+yelp_location)
+
+
+# Function to log a refresh that failed, running out of Yelp budget or Yelp
+# being down is expected and only noted
+def log_refresh_failure(refresh_kind, yelp_location, error):
+    if isinstance(error, YelpUnavailable):
+        logger.info(refresh_kind+" skipped for "+yelp_location+": "+str(error))
+    else:
+        logger.error(refresh_kind+" failed for "+yelp_location, exc_info=error)
+
+
+# Function to take the Yelp lease for a location.  Returns True if we hold it,
+# False if another instance does and None if there is no lease to wait on,
+# the lease is turned off or the datastore can't be reached.
+def acquire_lease(yelp_location):
+    if not YELP_LEASE_ENABLED:
+        return None
+    try:
+        with telemetry.dependency_call("datastore", "lease"):
+            return datastore_breaker.call(yelp_lease.acquire, yelp_location)
+    except Exception as error:
+        logger.warning("Lease unavailable for "+yelp_location+": "+str(error))
+        trace.get_current_span().set_attribute("lease_result", "unavailable")
+        return None
+
+
+# Function to release the Yelp lease, a failed release is left to expire
+def release_lease(yelp_location):
+    try:
+        datastore_breaker.call(yelp_lease.release, yelp_location)
+    except Exception as error:
+        logger.warning("Failed to release lease on "+yelp_location+": "+str(error))
+
+
+# Function to check whether the lease holder has stored a fresh business list,
+# returns None until it has.  Raises if the store can't be read.
+def get_lease_result(yelp_location):
+    data_response = datastore_breaker.call(taps_store.get, yelp_location, timeout=DATASTORE_TIMEOUT)
+    if data_response is None or data_response['timestamp'] <= datetime.now(tz=timezone.utc) - TAPS_TTL:
+        return None
+    location_cache.put(yelp_location, data_response['businesses'], data_response['timestamp'], None if data_response['businesses'] else TAPS_NEGATIVE_TTL)
+    return data_response
+
+
+# Function to check a Yelp call may be made, waiting a little for a rate limit
+# token for interactive calls.  The breaker is checked first so an open
+# circuit doesn't use up rate limit tokens.
+def admit_yelp_call(priority):
+    if not yelp_breaker.allow():
+        raise YelpUnavailable(503)
+    if not yelp_limiter.acquire(priority):
+        yelp_breaker.cancel()
+        raise YelpRateLimited()
+
+
+# Function to record the outcome of a Yelp call that got a response, raises
+# YelpUnavailable if it can't be used
+def record_yelp_response(priority, status_code, headers, yelp_data):
+    telemetry.record_yelp_call(priority, status_code)
+    if status_code >= 500:
+        yelp_breaker.record_failure()
+    else:
+        yelp_breaker.record_success()
+    yelp_limiter.record_response(status_code, headers)
+    check_yelp_response(status_code, yelp_data)
+
+
+# Function to tell a Yelp answer of "nothing here" apart from an error. An
+# unknown location comes back as a 400 LOCATION_NOT_FOUND, which is cached like
+# an empty result, anything else that isn't a 200 is treated as transient.
+def check_yelp_response(status_code, yelp_data):
+    if status_code == 200:
+        return
+    if status_code == 400 and yelp_data.get('error', {}).get('code') == 'LOCATION_NOT_FOUND':
+        return
+    raise YelpUnavailable(status_code)
+
+
+# Function to build the query for one page of bars from the Yelp API
+def yelp_search_params(yelp_location, offset, limit):
+    return {'location':yelp_location,'term':'bar','limit':limit,'offset':offset,'price':'1,2,3',}
+
+
+# Function to store the first page of a Yelp answer, returns its businesses or
+# None if Yelp says there are no bars here, which is remembered for a short while
+def store_yelp_page(yelp_location, yelp_data):
+    yelp_businesses = yelp_data.get('businesses') or []
+    with tracer.start_span("update_taps") as update_taps_span:
+        update_taps(yelp_location, yelp_businesses)
+        update_taps_span.set_attribute("num_businesses", len(yelp_businesses))
+    return yelp_businesses or None
+
+
+# Function to list the (offset, limit) of the deeper pages to fetch for a
+# location's candidate pool after its first page
+def pool_pages(yelp_data):
+    pool_depth = min(YELP_POOL_DEPTH, yelp_data.get('total', 0))
+    return [(offset, min(YELP_PAGE_SIZE, pool_depth - offset)) for offset in range(YELP_LIMIT, pool_depth, YELP_PAGE_SIZE)]
+
+
+# Function to store the first page of a location's candidate pool merged with
+# whatever deeper pages came back
+def store_pool(yelp_location, first_page, pages):
+    yelp_businesses = merge_businesses([first_page] + list(pages))
+    fill_pool_span = trace.get_current_span()
+    fill_pool_span.set_attribute("location", yelp_location)
+    fill_pool_span.set_attribute("pages", len(pages) + 1)
+    fill_pool_span.set_attribute("num_businesses", len(yelp_businesses))
+    if len(yelp_businesses) > len(first_page):
+        update_taps(yelp_location, yelp_businesses)
+        index_taps(yelp_location, None, yelp_businesses)
+
+
+# Function to merge pages of businesses, dropping duplicates by business id
+def merge_businesses(pages):
+    seen = set()
+    merged = []
+    for page in pages:
+        for business in page:
+            if business.get('id') in seen:
+                continue
+            seen.add(business.get('id'))
+            merged.append(business)
+    return merged
+
+
+# Function to update business list in the taps store
+def update_taps(yelp_location, updated_businesses):
+    timestamp = datetime.now(tz=timezone.utc)
+
+    # Saves the list to the store and writes through to the local cache, a
+    # failed write still leaves this instance with the new list.  Empty lists
+    # expire from the store along with the local cache.
+    try:
+        with telemetry.dependency_call(taps_store.name, "put"):
+            datastore_breaker.call(
+                taps_store.put, yelp_location, updated_businesses, timestamp,
+                ttl=None if updated_businesses else TAPS_NEGATIVE_TTL, timeout=DATASTORE_TIMEOUT,
+            )
+    except Exception as error:
+        logger.warning("Taps store write failed for "+yelp_location+": "+str(error))
+    location_cache.put(yelp_location, project_businesses(updated_businesses), timestamp, None if updated_businesses else TAPS_NEGATIVE_TTL)
+
+
+# Function to read the options of a pre-warm run from its JSON body, returns
+# (top_n, max_yelp_calls, concurrency, refresh_within).  A missing body or one
+# that isn't a JSON object runs with the defaults.
+def refresh_options(params):
+    if not isinstance(params, dict):
+        params = {}
+    return (
+        int(params.get('top_n', 50)),
+        int(params.get('max_yelp_calls', 20)),
+        int(params.get('concurrency', 4)),
+        timedelta(minutes = int(params.get('refresh_within_minutes', 120))),
+    )
+
+
+# Function to find the top_n most requested locations and, hottest first, the
+# ones among them that are missing or expire within refresh_within.  Returns
+# (hot_locations, to_refresh) with at most max_yelp_calls to refresh.
+def hot_locations_to_refresh(top_n, max_yelp_calls, refresh_within):
+    hot_locations = [location for location, _ in popularity.top_locations(top_n)]
+    timestamps = {location: record['timestamp'] for location, record in store_get_multi(hot_locations).items()}
+    refresh_before = datetime.now(tz=timezone.utc) - TAPS_TTL + refresh_within
+    to_refresh = [
+        location for location in hot_locations
+        if location not in timestamps or timestamps[location] < refresh_before
+    ][:max_yelp_calls]
+    return hot_locations, to_refresh
+
+
+# Function to name the outcome of a pre-warm refresh from the business list it
+# returned, Yelp having no bars for a location isn't a failure
+def refresh_outcome(yelp_businesses):
+    return "refreshed" if yelp_businesses else "no_results"
+
+
+# Function to summarise a pre-warm run, outcomes holds "refreshed", "no_results"
+# or "failed" for each location in to_refresh
+def refresh_summary(hot_locations, to_refresh, outcomes):
+    summary = {"hot_locations": len(hot_locations), "refreshed": [], "no_results": [], "failed": []}
+    for location, outcome in zip(to_refresh, outcomes):
+        summary[outcome].append(location)
+    return summary
+
+
+# Function collecting circuit breaker and hedging counters
+def breaker_stats():
+    return {
+        "yelp": yelp_breaker.stats(),
+        "datastore": datastore_breaker.stats(),
+        "datastore_hedging": datastore_hedger.stats() if datastore_hedger else None,
+    }
@@ -0,0 +1,204 @@
+"""
+    Client-side rate limiting for Yelp Fusion API calls from HappyTaps-FindTaps.
+
+    A token bucket caps the calls per second made by this instance and is shared
+    by all of its threads.  The daily quota is shared by all instances through
+    one Datastore entity per UTC day, which instances claim calls from in blocks
+    so Datastore only sees one transaction every claim_size calls:
+
+    - <day>    {used, daily_limit, timestamp}
+
+    The RateLimit-* headers Yelp sends back keep the shared count honest when it
+    drifts, e.g. when something else spends from the same API key.
+
+    Interactive calls may wait a little for a token.  Background calls never
+    wait, and leave a reserve of the bucket and of the daily quota untouched,
+    so refreshes and pool fills give way to Slack users first.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from google.cloud import datastore
+from google.cloud.datastore import Client
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+
+class YelpRateLimiter:
+    datastore_client: Client
+    _datastore_quota_kind: str
+
+    def __init__(
+        self,
+        *,
+        datastore_client: Client,
+        datastore_quota_kind: str,
+        max_qps: float,
+        burst: int,
+        daily_limit: int,
+        claim_size: int = 20,
+        background_reserve: float = 0.2,
+        max_wait_seconds: float = 2.0,
+        throttle_pause_seconds: float = 1.0,
+        logger: logging.Logger = None,
+    ):
+        self.datastore_client = datastore_client
+        self.max_qps = max_qps
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.claim_size = claim_size
+        self.background_reserve = background_reserve
+        self.max_wait_seconds = max_wait_seconds
+        self.throttle_pause_seconds = throttle_pause_seconds
+        self._datastore_quota_kind = datastore_quota_kind
+        self._logger = logger or logging.getLogger(__name__)
+
+        # Token bucket, refilled at max_qps up to burst tokens
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        # Calls claimed from today's shared quota that this instance hasn't made
+        # yet, and the calls left across all instances as far as we know
+        self._day = None
+        self._allowance = 0
+        self._remaining = None
+        self._observed_remaining = None
+        self._claim_lock = threading.Lock()
+
+        self.granted = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.rejected = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.throttled = 0
+
+
+    @property
+    def datastore_quota_kind(self) -> str:
+        return self._datastore_quota_kind
+
+
+    def acquire(self, priority: str = INTERACTIVE) -> bool:
+        """ Returns True if a Yelp call may be made now, waiting a little for interactive calls. """
+        if not self._take_quota(priority):
+            self._count(self.rejected, priority)
+            return False
+
+        reserve = self.burst * self.background_reserve if priority == BACKGROUND else 0
+        deadline = time.monotonic() + (self.max_wait_seconds if priority == INTERACTIVE else 0)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1 + reserve:
+                    self._tokens -= 1
+                    self.granted[priority] += 1
+                    return True
+                wait = max(self._paused_until - now, (1 + reserve - self._tokens) / self.max_qps)
+
+            if now + wait > deadline:
+                # Hand the unused call back to this instance's allowance
+                with self._claim_lock:
+                    self._allowance += 1
+                self._count(self.rejected, priority)
+                return False
+            time.sleep(wait)
+
+
+    def record_response(self, status_code: int, headers):
+        """ Updates quota and backoff state from a Yelp response. """
+        daily_limit = headers.get("RateLimit-DailyLimit")
+        remaining = headers.get("RateLimit-Remaining")
+        with self._claim_lock:
+            if daily_limit is not None:
+                self.daily_limit = int(float(daily_limit))
+            if remaining is not None:
+                self._observed_remaining = int(float(remaining))
+                self._remaining = self._observed_remaining if self._remaining is None else min(self._remaining, self._observed_remaining)
+                if self._observed_remaining <= 0:
+                    self._allowance = 0
+
+        # Yelp is throttling us, stop handing out tokens for a while
+        if status_code == 429:
+            retry_after = headers.get("Retry-After")
+            with self._lock:
+                self.throttled += 1
+                pause = float(retry_after) if retry_after else self.throttle_pause_seconds
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refill(time.monotonic())
+            tokens = self._tokens
+        with self._claim_lock:
+            return {
+                "day": self._day,
+                "tokens": round(tokens, 2),
+                "allowance": self._allowance,
+                "remaining": self._remaining,
+                "daily_limit": self.daily_limit,
+                "granted": dict(self.granted),
+                "rejected": dict(self.rejected),
+                "throttled": self.throttled,
+            }
+
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.max_qps)
+        self._refilled_at = now
+
+
+    def _count(self, counter: dict, priority: str):
+        with self._lock:
+            counter[priority] += 1
+
+
+    def _take_quota(self, priority: str) -> bool:
+        day = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d")
+        with self._claim_lock:
+            # Yelp's daily quota resets at midnight UTC
+            if day != self._day:
+                self._day = day
+                self._allowance = 0
+                self._remaining = None
+                self._observed_remaining = None
+
+            # Background calls leave the last part of the daily quota to users
+            if priority == BACKGROUND and self._remaining is not None and self._remaining < self.daily_limit * self.background_reserve:
+                return False
+
+            if self._allowance == 0:
+                self._allowance = self._claim(day)
+            if self._allowance == 0:
+                return False
+            self._allowance -= 1
+            return True
+
+
+    def _claim(self, day: str) -> int:
+        key = self.datastore_client.key(self.datastore_quota_kind, day)
+        try:
+            with self.datastore_client.transaction():
+                entity = self.datastore_client.get(key) or datastore.Entity(key=key)
+                used = entity.get("used", 0)
+                if self._observed_remaining is not None:
+                    used = max(used, self.daily_limit - self._observed_remaining)
+                claimed = max(0, min(self.claim_size, self.daily_limit - used))
+                entity.update({
+                    "used": used + claimed,
+                    "daily_limit": self.daily_limit,
+                    "timestamp": datetime.now(tz=timezone.utc),
+                })
+                self.datastore_client.put(entity)
+        except Exception:
+            # Don't stop serving users because the quota entity can't be read,
+            # the token bucket still bounds the rate of calls
+            self._logger.exception("Failed to claim Yelp quota for "+day)
+            return self.claim_size
+
+        self._remaining = self.daily_limit - used - claimed
+        return claimed
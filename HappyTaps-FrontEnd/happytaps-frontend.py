@@ -1,13 +1,59 @@
 import os
+import json
+import time
+import random
 import logging
+from datetime import datetime, timedelta, timezone
 from slack_bolt import App
 from slack_bolt.oauth.oauth_settings import OAuthSettings
+from slack_sdk import WebClient
 from slack_oauth_datastore import GoogleDatastoreInstallationStore, GoogleDatastoreOAuthStateStore
+from taps_cache import LocationCache
+from taps_messages import taps_message
+from taps_store import build_taps_store
+from popularity import PopularityCounter
+from taps_telemetry import TapsTelemetry, LazySpanExporter, inject_message_context
+from lazy_clients import LazyClient, Warmup
 from google.cloud.datastore import Client
-from google.cloud import pubsub_v1
 
-# Initialize datastore client
-datastore_client: Client = Client()
+# Tracing
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.propagate import set_global_textmap
+from opentelemetry.propagators.cloud_trace_propagator import (
+    CloudTraceFormatPropagator,
+)
+
+set_global_textmap(CloudTraceFormatPropagator())
+
+tracer_provider = TracerProvider()
+
+# Function to build the Cloud Trace exporter, imported here as it is only
+# needed once the first batch of spans goes out
+def build_cloud_trace_exporter():
+    from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+    return CloudTraceSpanExporter()
+
+
+# Export spans to Cloud Trace, can be turned off to run without GCP credentials
+# e.g. under loadtest_frontend.py.  The exporter is built in the background.
+if os.environ.get("CLOUD_TRACE_ENABLED", "true") == "true":
+    cloud_trace_exporter = LazySpanExporter(LazyClient(name="cloud_trace", factory=build_cloud_trace_exporter).start())
+    tracer_provider.add_span_processor(
+        BatchSpanProcessor(cloud_trace_exporter)
+    )
+trace.set_tracer_provider(tracer_provider)
+
+tracer = trace.get_tracer(__name__)
+
+# Dependency latency and cache metrics, see taps_telemetry.py
+telemetry = TapsTelemetry(service_name="happytaps-frontend")
+
+# Initialize datastore client, built in the background while the app loads
+# and on first use at the latest
+datastore_client: Client = LazyClient(name="datastore", factory=Client).start()
 
 # Define logger and set log level
 logger = logging.getLogger(__name__)
@@ -20,6 +66,7 @@ my_install_store = GoogleDatastoreInstallationStore(
         datastore_installation_kind = "HappyTaps-Installation",
         client_id=os.environ["SLACK_CLIENT_ID"],
         logger=logger,
+        use_deterministic_keys=os.environ.get("INSTALLATION_DETERMINISTIC_KEYS", "false") == "true",
     )
 
 # Create GoogleDAtaStoreOAuthStateStore for use with Slack OAuth settings
@@ -30,6 +77,9 @@ my_state_store = GoogleDatastoreOAuthStateStore(
         logger=logger,
     )
 
+# Purge expired OAuth states in the background rather than on each install
+my_state_store.start_purge_sweeper()
+
 # Define OAuthSettings for HappyTaps app using install and state store
 oauth_settings = OAuthSettings(
     client_id=os.environ["SLACK_CLIENT_ID"],
@@ -40,21 +90,104 @@ oauth_settings = OAuthSettings(
 )
 
 
-# Initialize the slack app
-app = App(
+# Function to start the root span of a slash command before Bolt looks up the
+# installation, so the authorize step shows up in the trace
+def start_command_span(context, next):
+    context["command_span"] = tracer.start_span("slash_command", kind=SpanKind.SERVER)
+    context["authorize_started_ns"] = time.time_ns()
+    next()
+
+
+# Bolt app that ends the root span of a slash command once the request has been
+# acked.  Bolt's next() only flags that a middleware is done, so a finally in a
+# middleware would end the span too early, and a request turned away by
+# authorize never reaches the middleware after it.
+class TracedApp(App):
+    def dispatch(self, req):
+        try:
+            return super().dispatch(req)
+        finally:
+            command_span = req.context.get("command_span")
+            if command_span is not None:
+                command_span.end()
+
+
+# Initialize the slack app, SLACK_API_URL points the Web API calls Bolt makes
+# at a local stand-in for load tests
+app = TracedApp(
     signing_secret=os.environ["SLACK_SIGNING_SECRET"],
-    oauth_settings=oauth_settings
+    oauth_settings=oauth_settings,
+    client=WebClient(base_url=os.environ.get("SLACK_API_URL", WebClient.BASE_URL)),
+    before_authorize=start_command_span,
 )
 
-# Initialize pubsub
-publisher = pubsub_v1.PublisherClient()
-pubsub_topic = 'projects/clear-router-191420/topics/find-taps'
+
+# Function to record how long authorize took, runs once Bolt has authorized the request
+@app.middleware
+def trace_command(context, next):
+    command_span = context.get("command_span")
+    if command_span is not None:
+        telemetry.record_elapsed("slack", "authorize", context["authorize_started_ns"], parent=command_span)
+    return next()
+
+# Function to build the pubsub publisher, imported here as the pubsub client
+# library is slow to import and only needed for locations that aren't cached
+def build_publisher():
+    from google.cloud import pubsub_v1
+    return pubsub_v1.PublisherClient()
+
+
+# Initialize pubsub in the background, PUBSUB_EMULATOR_HOST is honoured by the client
+publisher = LazyClient(name="pubsub", factory=build_publisher, logger=logger).start()
+pubsub_topic = os.environ.get("PUBSUB_TOPIC", 'projects/clear-router-191420/topics/find-taps')
+
+# Business lists are considered fresh for one day after FindTaps pulls them from Yelp
+TAPS_TTL = timedelta(days = 1)
+
+# Several areas can be compared in one command, separated by semicolons since
+# locations may contain commas, e.g. /happytaps greenpoint; williamsburg; bushwick
+LOCATION_SEPARATOR = ";"
+MAX_LOCATIONS = int(os.environ.get("MAX_LOCATIONS", 5))
+
+# Store FindTaps writes business lists to, must match its TAPS_STORE and for
+# sqlite its TAPS_STORE_PATH, which only works with both on one host
+taps_store = build_taps_store(
+    os.environ.get("TAPS_STORE", "datastore"),
+    datastore_client=datastore_client,
+    sqlite_path=os.environ.get("TAPS_STORE_PATH", "happytaps.db"),
+)
+
+# In-process cache of business lists written by FindTaps, used to answer fresh
+# locations directly instead of going through pubsub
+location_cache = LocationCache(
+    max_size=int(os.environ.get("LOCATION_CACHE_SIZE", 512)),
+    ttl=TAPS_TTL,
+)
+
+# Per-location request counters, FindTaps pre-warms the hottest locations.
+# Locations answered here never reach FindTaps, so they are counted here in the
+# same sharded entities FindTaps counts the requests it answers in.
+popularity = PopularityCounter(
+    datastore_client=datastore_client,
+    datastore_counter_kind="HappyTaps-Popularity",
+    flush_interval_seconds=float(os.environ.get("POPULARITY_FLUSH_SECONDS", 30)),
+    logger=logger,
+)
+
+# Warm the datastore and pubsub clients in parallel before the server starts
+# listening, so the first slash command after a cold start doesn't pay for them
+READY_TIMEOUT_SECONDS = float(os.environ.get("READY_TIMEOUT_SECONDS", 10))
+warmup = Warmup(checks={
+    "datastore": lambda: datastore_client.get(datastore_client.key("HappyTaps-Warmup", "warmup")),
+    "pubsub": publisher.client,
+}, logger=logger)
 
 # HappyTaps command entrypoint
 @app.command("/happytaps")
-def happy_taps(ack, body, respond):
+def happy_taps(ack, body, respond, context):
     # Reply with messaging to user right away
     ack("One watering hole coming up!")
+    requested_at = time.time()
 
     # Check if a specific location was specified, if not default to NYC
     if 'text' in body:
@@ -62,12 +195,76 @@ def happy_taps(ack, body, respond):
     else:
         yelp_location = 'NYC'
 
+    yelp_locations = [location.strip() for location in yelp_location.split(LOCATION_SEPARATOR) if location.strip()][:MAX_LOCATIONS]
+    # A single location may still carry a stray separator, e.g. "greenpoint;"
+    if len(yelp_locations) == 1:
+        yelp_location = yelp_locations[0]
+
     # Store the response url for channel where HappyTaps request originated
     response_url = str(respond.response_url)
 
-    # Publish details of HappyTaps request to the FindTaps pubsub topic
-    future = publisher.publish(pubsub_topic,b'FindTaps',location=yelp_location,response_url=response_url)
+    # Listeners run after the ack, parent the span on the slash command's root
+    # span so the whole command, including FindTaps, is one trace
+    command_span = context.get("command_span")
+    parent = trace.set_span_in_context(command_span) if command_span is not None else None
+    with tracer.start_as_current_span("happy_taps", context=parent) as happy_taps_span:
+        # Answer straight from the cache when the business list is fresh, several
+        # areas always go to FindTaps which looks them all up at once
+        yelp_businesses = get_fresh_taps(yelp_location.lower()) if len(yelp_locations) < 2 else None
+        if yelp_businesses:
+            popularity.increment(yelp_location.lower())
+            bar = yelp_businesses[random.randint(0,len(yelp_businesses)-1)]
+            with telemetry.dependency_call("slack", "respond"):
+                respond(taps_message(yelp_location.lower(), bar))
+            path = "fast_path"
+
+        # Otherwise publish details of HappyTaps request to the FindTaps pubsub topic,
+        # carrying the trace context in the message attributes.  The publisher
+        # batches in the background, so the publish is timed until its future resolves
+        else:
+            message_attributes = inject_message_context()
+            if len(yelp_locations) > 1:
+                message_attributes["locations"] = json.dumps(yelp_locations)
+            publish_started_ns = time.time_ns()
+            future = publisher.publish(pubsub_topic,b'FindTaps',location=yelp_location,response_url=response_url,requested_at=str(requested_at),**message_attributes)
+            future.add_done_callback(lambda _: telemetry.record_elapsed("pubsub", "publish", publish_started_ns, parent=happy_taps_span))
+            path = "pubsub"
+
+        # Tag the path taken so time-to-answer can be compared between them,
+        # for pubsub FindTaps reports time-to-answer using requested_at
+        elapsed_ms = (time.time() - requested_at) * 1000
+        happy_taps_span.set_attribute("path", path)
+        happy_taps_span.set_attribute("location", yelp_location)
+        happy_taps_span.set_attribute("elapsed_ms", elapsed_ms)
+        logger.info("happytaps path="+path+" location="+yelp_location+" elapsed_ms="+str(round(elapsed_ms)))
+
+
+# Function to get a fresh business list from the local cache or taps store,
+# returns None if the location needs to be refreshed by FindTaps or the store
+# can't be read
+def get_fresh_taps(yelp_location):
+    data_response = location_cache.get(yelp_location)
+    if data_response is not None:
+        telemetry.record_cache_lookup("local")
+    else:
+        try:
+            with telemetry.dependency_call(taps_store.name, "get"):
+                data_response = taps_store.get(yelp_location)
+        except Exception as error:
+            logger.warning("Taps store read failed for "+yelp_location+", publishing instead: "+str(error))
+            return None
+        if data_response is None:
+            telemetry.record_cache_lookup("miss")
+            return None
+        telemetry.record_cache_lookup(taps_store.name)
+        location_cache.put(yelp_location, data_response['businesses'], data_response['timestamp'])
+
+    if data_response['timestamp'] > datetime.now(tz=timezone.utc) - TAPS_TTL:
+        return data_response['businesses']
+    return None
 
 # Start your app
 if __name__ == "__main__":
+    if not warmup.wait(READY_TIMEOUT_SECONDS):
+        logger.warning("Starting before warm-up passed: "+str(warmup.stats()))
     app.start(port=int(os.environ.get("PORT", 3000)))
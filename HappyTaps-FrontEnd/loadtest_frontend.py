@@ -0,0 +1,306 @@
+"""
+    Load generator for /happytaps ack latency on a local HappyTaps-FrontEnd.
+
+    Slack gives a slash command 3 seconds to be acked.  This starts the frontend
+    on Bolt's development server, the same way boot.sh does, against:
+
+    - the Datastore emulator (DATASTORE_EMULATOR_HOST), seeded with an
+      installation for a fake workspace and optionally some fresh locations
+    - the Pub/Sub emulator (PUBSUB_EMULATOR_HOST), with the FindTaps topic
+    - a local stand-in for the Slack Web API (auth.test) and response_url
+
+    then sends correctly signed slash command requests at each of the given
+    rates, open loop, and reports the distribution of ack latency and the share
+    of requests acked after the deadline.
+
+        gcloud beta emulators datastore start --no-store-on-disk
+        gcloud beta emulators pubsub start
+        $(gcloud beta emulators datastore env-init)
+        $(gcloud beta emulators pubsub env-init)
+        python loadtest_frontend.py --rates 5,10,20,40 --duration 30
+        python loadtest_frontend.py --fast-path-share 0.5 --slack-latency-ms 80
+
+    --fast-path-share is the fraction of requests for locations seeded as
+    fresh, which the frontend answers itself instead of publishing to pubsub.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+from uuid import uuid4
+
+import requests
+from google.cloud import datastore
+from slack_sdk.oauth.installation_store import Installation
+
+from slack_oauth_datastore import GoogleDatastoreInstallationStore
+from taps_store import DatastoreTapsStore
+
+ACK_DEADLINE_MS = 3000
+PUBSUB_TOPIC = "projects/clear-router-191420/topics/find-taps"
+
+# Fake workspace the requests come from
+CLIENT_ID = "111.222"
+TEAM_ID = "TLOADTEST"
+USER_ID = "ULOADTEST"
+BOT_ID = "BLOADTEST"
+BOT_USER_ID = "WLOADTEST"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_slack(latency_ms, counter):
+    class SlackHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency_ms / 1000)
+            with counter["lock"]:
+                counter[self.path] = counter.get(self.path, 0) + 1
+
+            if self.path.startswith("/api/auth.test"):
+                body = {
+                    "ok": True,
+                    "url": "https://loadtest.slack.com/",
+                    "team": "loadtest",
+                    "user": "happytaps",
+                    "team_id": TEAM_ID,
+                    "user_id": BOT_USER_ID,
+                    "bot_id": BOT_ID,
+                    "is_enterprise_install": False,
+                }
+            else:
+                body = {"ok": True}
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), SlackHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def seed_emulators(datastore_client, fast_locations, deterministic_keys):
+    # Installation for the fake workspace, what Bolt looks up on every request
+    install_store = GoogleDatastoreInstallationStore(
+        datastore_client=datastore_client,
+        datastore_bot_kind="HappyTaps-Bot",
+        datastore_installation_kind="HappyTaps-Installation",
+        client_id=CLIENT_ID,
+        logger=logging.getLogger(__name__),
+        use_deterministic_keys=deterministic_keys,
+    )
+    install_store.save(Installation(
+        app_id="ALOADTEST",
+        team_id=TEAM_ID,
+        team_name="loadtest",
+        bot_token="xoxb-loadtest",
+        bot_id=BOT_ID,
+        bot_user_id=BOT_USER_ID,
+        bot_scopes=["commands", "incoming-webhook"],
+        user_id=USER_ID,
+        installed_at=time.time(),
+    ))
+
+    # Fresh business lists for the fast path
+    timestamp = datetime.now(tz=timezone.utc)
+    records = {}
+    for location in fast_locations:
+        businesses = [
+            {"id": location+"-"+str(i), "name": "Bar "+str(i), "url": "https://www.yelp.com/biz/"+str(i),
+             "image_url": "https://s3-media1.fl.yelpcdn.com/bphoto/"+str(i)+"/o.jpg",
+             "coordinates": {"latitude": 40.7, "longitude": -73.95}}
+            for i in range(20)
+        ]
+        records[location] = {"businesses": businesses, "timestamp": timestamp}
+    taps_store = DatastoreTapsStore(datastore_client=datastore_client)
+    for start in range(0, len(fast_locations), 500):
+        taps_store.put_multi({location: records[location] for location in fast_locations[start:start + 500]})
+
+    # The emulator starts without topics, publishing to a missing one fails
+    requests.put("http://"+os.environ["PUBSUB_EMULATOR_HOST"]+"/v1/"+PUBSUB_TOPIC, timeout=10)
+
+
+def start_frontend(env):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "happytaps-frontend.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, PORT=str(port), **env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    # Bolt's development server answers any GET with a 404 once it's up
+    url = "http://127.0.0.1:"+str(port)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("frontend exited with "+str(process.returncode)+", are both emulators running?")
+        try:
+            requests.get(url+"/", timeout=1)
+            return process, url+"/slack/events"
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("frontend didn't start within 60 seconds")
+
+
+def signed_command(signing_secret, location, response_url):
+    body = urlencode({
+        "token": "loadtest",
+        "team_id": TEAM_ID,
+        "team_domain": "loadtest",
+        "channel_id": "CLOADTEST",
+        "channel_name": "general",
+        "user_id": USER_ID,
+        "user_name": "loadtest",
+        "command": "/happytaps",
+        "text": location,
+        "api_app_id": "ALOADTEST",
+        "is_enterprise_install": "false",
+        "response_url": response_url,
+        "trigger_id": uuid4().hex,
+    })
+    timestamp = str(int(time.time()))
+    signature = "v0=" + hmac.new(
+        signing_secret.encode("utf-8"),
+        ("v0:"+timestamp+":"+body).encode("utf-8"),
+        hashlib.sha256,
+    ).hexdigest()
+    return body, {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": signature,
+    }
+
+
+def run_rate(url, signing_secret, response_url, rate, duration, fast_locations, fast_path_share, max_in_flight):
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max_in_flight))
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def send(location):
+        body, headers = signed_command(signing_secret, location, response_url)
+        start = time.perf_counter()
+        try:
+            ok = session.post(url, data=body, headers=headers, timeout=30).status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with lock:
+            if ok:
+                latencies.append(elapsed_ms)
+            else:
+                failures[0] += 1
+
+    # Open loop, requests go out on schedule no matter how slow the acks are
+    total = int(rate * duration)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for index in range(total):
+            delay = start + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if fast_locations and random.random() < fast_path_share:
+                location = random.choice(fast_locations)
+            else:
+                location = "pubsub-"+uuid4().hex[:12]
+            executor.submit(send, location)
+    return latencies, failures[0], time.perf_counter() - start
+
+
+def report(rate, latencies, failures, elapsed):
+    sent = len(latencies) + failures
+    print(f"rate={rate}/s  {sent} sent in {elapsed:.1f}s, {failures} failed")
+    if not latencies:
+        return
+    ordered = sorted(latencies)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    late = sum(1 for latency in latencies if latency > ACK_DEADLINE_MS)
+    print(f"  ack ms  mean {statistics.mean(latencies):.1f}  p50 {percentile(0.50):.1f}  p90 {percentile(0.90):.1f}  "
+          f"p95 {percentile(0.95):.1f}  p99 {percentile(0.99):.1f}  max {ordered[-1]:.1f}")
+    print(f"  over {ACK_DEADLINE_MS / 1000:.0f}s deadline: {late} ({(late + failures) / sent:.1%} including failures)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", default="5,10,20", help="comma separated requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to hold each rate")
+    parser.add_argument("--fast-path-share", type=float, default=0.0, help="fraction of requests for fresh locations")
+    parser.add_argument("--fast-locations", type=int, default=50, help="distinct fresh locations to seed")
+    parser.add_argument("--slack-latency-ms", type=float, default=50, help="latency of the fake Slack Web API")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="cap on requests waiting for an ack")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the frontend")
+    args = parser.parse_args()
+
+    for emulator in ("DATASTORE_EMULATOR_HOST", "PUBSUB_EMULATOR_HOST"):
+        if emulator not in os.environ:
+            sys.exit(emulator+" isn't set, start the Datastore and Pub/Sub emulators first")
+
+    slack_calls = {"lock": threading.Lock()}
+    slack = start_fake_slack(args.slack_latency_ms, slack_calls)
+    slack_url = "http://127.0.0.1:"+str(slack.server_address[1])
+    signing_secret = uuid4().hex
+    env = {
+        "SLACK_CLIENT_ID": CLIENT_ID,
+        "SLACK_CLIENT_SECRET": "loadtest",
+        "SLACK_SIGNING_SECRET": signing_secret,
+        "SLACK_API_URL": slack_url+"/api/",
+        "PUBSUB_TOPIC": PUBSUB_TOPIC,
+        "CLOUD_TRACE_ENABLED": "false",
+    }
+    env.update(entry.split("=", 1) for entry in args.env)
+
+    run_id = uuid4().hex[:8]
+    fast_locations = ["fast-"+run_id+"-"+str(i) for i in range(args.fast_locations)] if args.fast_path_share else []
+    seed_emulators(datastore.Client(), fast_locations, env.get("INSTALLATION_DETERMINISTIC_KEYS", "false") == "true")
+
+    process, url = start_frontend(env)
+    try:
+        for rate in [float(value) for value in args.rates.split(",")]:
+            latencies, failures, elapsed = run_rate(
+                url, signing_secret, slack_url+"/respond", rate, args.duration,
+                fast_locations, args.fast_path_share, args.max_in_flight,
+            )
+            report(rate, latencies, failures, elapsed)
+    finally:
+        process.terminate()
+        process.wait()
+        slack.shutdown()
+
+    calls = {path: count for path, count in slack_calls.items() if path != "lock"}
+    print("fake slack calls: "+", ".join(path+"="+str(count) for path, count in sorted(calls.items())))
+
+
+if __name__ == "__main__":
+    main()
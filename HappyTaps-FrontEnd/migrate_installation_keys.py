@@ -0,0 +1,27 @@
+"""
+    One-off migration of HappyTaps installation and bot rows from UUID keys to
+    deterministic keys.  Run once before setting INSTALLATION_DETERMINISTIC_KEYS=true
+    on the frontend:
+
+        SLACK_CLIENT_ID=... python migrate_installation_keys.py
+"""
+import os
+import logging
+from google.cloud.datastore import Client
+from slack_oauth_datastore import GoogleDatastoreInstallationStore
+
+# Define logger and set log level
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+install_store = GoogleDatastoreInstallationStore(
+        datastore_client=Client(),
+        datastore_bot_kind = "HappyTaps-Bot",
+        datastore_installation_kind = "HappyTaps-Installation",
+        client_id=os.environ["SLACK_CLIENT_ID"],
+        logger=logger,
+        use_deterministic_keys=True,
+    )
+
+if __name__ == "__main__":
+    install_store.migrate_to_deterministic_keys()
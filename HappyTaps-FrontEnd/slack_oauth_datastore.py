@@ -22,15 +22,35 @@
     - name: team_id
     - name: installed_at
         direction: asc
+
+    GoogleDatastoreInstallationStore keeps a short-lived read-through cache of
+    find_bot/find_installation results, including negative results, so Bolt
+    authorization doesn't cost a Datastore query per command.  The cache is
+    invalidated for a workspace whenever its installation or bot is saved or
+    deleted through this store.
+
+    With use_deterministic_keys=True rows are stored under keys derived from
+    client_id/enterprise_id/team_id/user_id instead of random UUIDs, and no
+    query is needed to find them:
+
+    - <client_id>:<enterprise_id>:<team_id>            latest row for the workspace
+    - <workspace key> / user:<user_id>                 latest row for a user
+    - <workspace key> / <user_id>:<installed_at>       installation history
+
+    The bot kind uses the same workspace key for the latest bot and
+    <workspace key> / <installed_at> for its history.  Existing UUID keyed rows
+    can be moved over with migrate_to_deterministic_keys().
 """
 #pylint: disable=line-too-long,missing-class-docstring,missing-function-docstring
 
 import logging
+import threading
 from datetime import datetime, timezone, timedelta
 from logging import Logger
 from typing import Optional
 from uuid import uuid4
 
+from cachetools import TTLCache
 from google.cloud import datastore
 from google.cloud.datastore import Client, Entity
 from slack_sdk.oauth import OAuthStateStore, InstallationStore
@@ -47,6 +67,53 @@ def _to_timestamp(obj):
     return obj
 
 
+def _entity_to_bot(entity) -> Bot:
+    return Bot(
+        app_id = entity.get("app_id"),
+        enterprise_id = entity.get("enterprise_id"),
+        enterprise_name = entity.get("enterprise_name"),
+        team_id = entity.get("team_id"),
+        team_name = entity.get("team_name"),
+        bot_token = entity.get("bot_token"),
+        bot_id = entity.get("bot_id"),
+        bot_user_id = entity.get("bot_user_id"),
+        bot_scopes = entity.get("bot_scopes"),
+        bot_refresh_token = entity.get("bot_refresh_token"),
+        bot_token_expires_at = _to_timestamp(entity.get("bot_token_expires_at")),
+        is_enterprise_install = entity.get("is_enterprise_install"),
+        installed_at = _to_timestamp(entity.get("installed_at")),
+    )
+
+
+def _entity_to_installation(entity) -> Installation:
+    return Installation(
+        app_id = entity.get("app_id"),
+        enterprise_id = entity.get("enterprise_id"),
+        enterprise_name = entity.get("enterprise_name"),
+        enterprise_url = entity.get("enterprise_url"),
+        team_id = entity.get("team_id"),
+        team_name = entity.get("team_name"),
+        bot_token = entity.get("bot_token"),
+        bot_id = entity.get("bot_id"),
+        bot_user_id = entity.get("bot_user_id"),
+        bot_scopes = entity.get("bot_scopes"),
+        bot_refresh_token = entity.get("bot_refresh_token"),
+        bot_token_expires_at = _to_timestamp(entity.get("bot_token_expires_at")),
+        user_id = entity.get("user_id"),
+        user_token = entity.get("user_token"),
+        user_scopes = entity.get("user_scopes"),
+        user_refresh_token = entity.get("user_refresh_token"),
+        user_token_expires_at = _to_timestamp(entity.get("user_token_expires_at")),
+        incoming_webhook_url = entity.get("incoming_webhook_url"),
+        incoming_webhook_channel = entity.get("incoming_webhook_channel"),
+        incoming_webhook_channel_id = entity.get("incoming_webhook_channel_id"),
+        incoming_webhook_configuration_url = entity.get("incoming_webhook_configuration_url"),
+        is_enterprise_install = entity.get("is_enterprise_install"),
+        token_type = entity.get("token_type"),
+        installed_at = _to_timestamp(entity.get("installed_at")),
+    )
+
+
 
 class GoogleDatastoreInstallationStore(InstallationStore):
     datastore_client: Client
@@ -78,6 +145,15 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         "team_name"
     ]
 
+    bot_fields = [
+        "bot_token",
+        "bot_id",
+        "bot_user_id",
+        "bot_scopes",
+        "bot_refresh_token",
+        "bot_token_expires_at",
+    ]
+
 
     def __init__(
         self,
@@ -87,7 +163,11 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         datastore_installation_kind: str,
         client_id: str,
         logger: Logger,
-        has_composite_index: bool = False
+        has_composite_index: bool = False,
+        cache_ttl_seconds: int = 60,
+        negative_cache_ttl_seconds: int = 5,
+        cache_max_size: int = 1024,
+        use_deterministic_keys: bool = False,
     ):
         self.datastore_client = datastore_client
         self.client_id = client_id
@@ -95,6 +175,10 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         self._datastore_bot_kind = datastore_bot_kind
         self._datastore_installation_kind = datastore_installation_kind
         self._has_composite_index = has_composite_index
+        self._cache = TTLCache(maxsize=cache_max_size, ttl=cache_ttl_seconds)
+        self._negative_cache = TTLCache(maxsize=cache_max_size, ttl=negative_cache_ttl_seconds)
+        self._cache_lock = threading.Lock()
+        self._use_deterministic_keys = use_deterministic_keys
 
 
     @property
@@ -114,6 +198,45 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         return self._datastore_installation_kind
 
 
+    def _cache_get(self, cache_key):
+        """ Returns (found, value) for a cached lookup result. """
+        with self._cache_lock:
+            if cache_key in self._cache:
+                return True, self._cache[cache_key]
+            if cache_key in self._negative_cache:
+                return True, None
+        return False, None
+
+
+    def _cache_put(self, cache_key, value):
+        with self._cache_lock:
+            if value is None:
+                self._negative_cache[cache_key] = None
+            else:
+                self._cache[cache_key] = value
+
+
+    def _cache_invalidate(self, enterprise_id: Optional[str], team_id: Optional[str]):
+        """ Drops cached lookups that may resolve to this workspace's rows. """
+        e_id = enterprise_id or None
+        t_id = team_id or None
+        with self._cache_lock:
+            for cache in (self._cache, self._negative_cache):
+                for cache_key in list(cache.keys()):
+                    _, key_e_id, key_t_id, _, _ = cache_key
+                    if key_e_id == e_id and (key_t_id == t_id or key_t_id is None or t_id is None):
+                        cache.pop(cache_key, None)
+
+
+    def _workspace_key(self, kind: str, enterprise_id: Optional[str], team_id: Optional[str]):
+        """ Key of the latest row for a workspace, parent of its other rows. """
+        return self.datastore_client.key(kind, f"{self.client_id}:{enterprise_id or 'none'}:{team_id or 'none'}")
+
+
+    def _is_deterministic_key(self, key) -> bool:
+        return key.parent is not None or key.name.startswith(self.client_id + ":")
+
+
     def _generate_kind_new_key(self, kind):
         """" Generates a unique kind ID. """
         while True:
@@ -125,6 +248,13 @@ class GoogleDatastoreInstallationStore(InstallationStore):
 
 
     def save(self, installation: Installation):
+        if self._use_deterministic_keys:
+            entities = self._installation_entities(installation) + self._bot_entities(installation.to_bot())
+            with self.datastore_client.transaction():
+                self.datastore_client.put_multi(entities)
+            self._cache_invalidate(installation.enterprise_id, installation.team_id)
+            return
+
         installation_dict = installation.to_dict()
         installation_dict["client_id"] = self.client_id
 
@@ -144,11 +274,18 @@ class GoogleDatastoreInstallationStore(InstallationStore):
 
         installation_entity.update(**installation_dict)
         self.datastore_client.put(installation_entity)
+        self._cache_invalidate(installation_dict["enterprise_id"], installation_dict["team_id"])
 
         self.save_bot(installation.to_bot())
 
 
     def save_bot(self, bot: Bot):
+        if self._use_deterministic_keys:
+            with self.datastore_client.transaction():
+                self.datastore_client.put_multi(self._bot_entities(bot))
+            self._cache_invalidate(bot.enterprise_id, bot.team_id)
+            return
+
         bot_dict = bot.to_dict()
         bot_dict["client_id"] = self.client_id
 
@@ -168,6 +305,50 @@ class GoogleDatastoreInstallationStore(InstallationStore):
 
         bot_entity.update(**bot_dict)
         self.datastore_client.put(bot_entity)
+        self._cache_invalidate(bot_dict["enterprise_id"], bot_dict["team_id"])
+
+
+    def _installation_entities(self, installation: Installation):
+        """ Builds the history, user latest and workspace latest rows for an installation. """
+        installation_dict = installation.to_dict()
+        installation_dict["client_id"] = self.client_id
+
+        kind = self.datastore_installation_kind
+        t_id = None if installation.is_enterprise_install else installation.team_id
+        workspace_key = self._workspace_key(kind, installation.enterprise_id, t_id)
+        keys = [
+            self.datastore_client.key(kind, f"{installation.user_id}:{installation.installed_at}", parent=workspace_key),
+            self.datastore_client.key(kind, f"user:{installation.user_id}", parent=workspace_key),
+            workspace_key,
+        ]
+
+        entities = []
+        for key in keys:
+            entity: Entity = datastore.Entity(key=key, exclude_from_indexes=self.installation_exclude_from_indexes)
+            entity.update(**installation_dict)
+            entities.append(entity)
+        return entities
+
+
+    def _bot_entities(self, bot: Bot):
+        """ Builds the history and workspace latest rows for a bot. """
+        bot_dict = bot.to_dict()
+        bot_dict["client_id"] = self.client_id
+
+        kind = self.datastore_bot_kind
+        t_id = None if bot.is_enterprise_install else bot.team_id
+        workspace_key = self._workspace_key(kind, bot.enterprise_id, t_id)
+        keys = [
+            self.datastore_client.key(kind, f"{bot.installed_at}", parent=workspace_key),
+            workspace_key,
+        ]
+
+        entities = []
+        for key in keys:
+            entity: Entity = datastore.Entity(key=key, exclude_from_indexes=self.bot_exclude_from_indexes)
+            entity.update(**bot_dict)
+            entities.append(entity)
+        return entities
 
 
     def find_bot(
@@ -182,6 +363,27 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         if is_enterprise_install:
             t_id = None
 
+        cache_key = ("bot", e_id, t_id, None, bool(is_enterprise_install))
+        found, bot = self._cache_get(cache_key)
+        if found:
+            return bot
+
+        if self._use_deterministic_keys:
+            bot = self._get_bot(e_id, t_id)
+        else:
+            bot = self._query_bot(e_id, t_id)
+        self._cache_put(cache_key, bot)
+        return bot
+
+
+    def _get_bot(self, e_id: Optional[str], t_id: Optional[str]) -> Optional[Bot]:
+        entity = self.datastore_client.get(self._workspace_key(self.datastore_bot_kind, e_id, t_id))
+        if entity is None:
+            return None
+        return _entity_to_bot(entity)
+
+
+    def _query_bot(self, e_id: Optional[str], t_id: Optional[str]) -> Optional[Bot]:
         query = self.datastore_client.query(kind=self.datastore_bot_kind)
         query.add_filter("client_id", "=", self.client_id)
         query.add_filter("enterprise_id", "=", e_id)
@@ -193,22 +395,7 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         rows = list(query.fetch(limit=1))
 
         if rows:
-            entity = rows[0]
-            return Bot(
-                app_id = entity.get("app_id"),
-                enterprise_id = entity.get("enterprise_id"),
-                enterprise_name = entity.get("enterprise_name"),
-                team_id = entity.get("team_id"),
-                team_name = entity.get("team_name"),
-                bot_token = entity.get("bot_token"),
-                bot_id = entity.get("bot_id"),
-                bot_user_id = entity.get("bot_user_id"),
-                bot_scopes = entity.get("bot_scopes"),
-                bot_refresh_token = entity.get("bot_refresh_token"),
-                bot_token_expires_at = _to_timestamp(entity.get("bot_token_expires_at")),
-                is_enterprise_install = entity.get("is_enterprise_install"),
-                installed_at = _to_timestamp(entity.get("installed_at")),
-            )
+            return _entity_to_bot(rows[0])
 
         return None
 
@@ -226,6 +413,44 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         if is_enterprise_install:
             t_id = None
 
+        cache_key = ("installation", e_id, t_id, user_id, bool(is_enterprise_install))
+        found, installation = self._cache_get(cache_key)
+        if found:
+            return installation
+
+        if self._use_deterministic_keys:
+            installation = self._get_installation(e_id, t_id, user_id)
+        else:
+            installation = self._query_installation(e_id, t_id, user_id)
+        self._cache_put(cache_key, installation)
+        return installation
+
+
+    def _get_installation(self, e_id: Optional[str], t_id: Optional[str], user_id: Optional[str]) -> Optional[Installation]:
+        workspace_key = self._workspace_key(self.datastore_installation_kind, e_id, t_id)
+        if user_id is None:
+            entity = self.datastore_client.get(workspace_key)
+            if entity is None:
+                return None
+            return _entity_to_installation(entity)
+
+        # Fetch the user's row together with the workspace row, whose bot
+        # token is the most recent one issued for the workspace
+        user_key = self.datastore_client.key(self.datastore_installation_kind, f"user:{user_id}", parent=workspace_key)
+        entities = {entity.key: entity for entity in self.datastore_client.get_multi([user_key, workspace_key])}
+        user_entity = entities.get(user_key)
+        if user_entity is None:
+            return None
+
+        workspace_entity = entities.get(workspace_key)
+        if workspace_entity is not None and workspace_entity.get("bot_token"):
+            user_entity = dict(user_entity)
+            for field in self.bot_fields:
+                user_entity[field] = workspace_entity.get(field)
+        return _entity_to_installation(user_entity)
+
+
+    def _query_installation(self, e_id: Optional[str], t_id: Optional[str], user_id: Optional[str]) -> Optional[Installation]:
         query = self.datastore_client.query(kind=self.datastore_installation_kind)
         query.add_filter("client_id", "=", self.client_id)
         query.add_filter("enterprise_id", "=", e_id)
@@ -240,33 +465,7 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         rows = list(query.fetch(limit=1))
 
         if rows:
-            entity = rows[0]
-            return Installation(
-                app_id = entity.get("app_id"),
-                enterprise_id = entity.get("enterprise_id"),
-                enterprise_name = entity.get("enterprise_name"),
-                enterprise_url = entity.get("enterprise_url"),
-                team_id = entity.get("team_id"),
-                team_name = entity.get("team_name"),
-                bot_token = entity.get("bot_token"),
-                bot_id = entity.get("bot_id"),
-                bot_user_id = entity.get("bot_user_id"),
-                bot_scopes = entity.get("bot_scopes"),
-                bot_refresh_token = entity.get("bot_refresh_token"),
-                bot_token_expires_at = _to_timestamp(entity.get("bot_token_expires_at")),
-                user_id = entity.get("user_id"),
-                user_token = entity.get("user_token"),
-                user_scopes = entity.get("user_scopes"),
-                user_refresh_token = entity.get("user_refresh_token"),
-                user_token_expires_at = _to_timestamp(entity.get("user_token_expires_at")),
-                incoming_webhook_url = entity.get("incoming_webhook_url"),
-                incoming_webhook_channel = entity.get("incoming_webhook_channel"),
-                incoming_webhook_channel_id = entity.get("incoming_webhook_channel_id"),
-                incoming_webhook_configuration_url = entity.get("incoming_webhook_configuration_url"),
-                is_enterprise_install = entity.get("is_enterprise_install"),
-                token_type = entity.get("token_type"),
-                installed_at = _to_timestamp(entity.get("installed_at")),
-            )
+            return _entity_to_installation(rows[0])
 
         return None
 
@@ -277,6 +476,15 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         enterprise_id: Optional[str],
         team_id: Optional[str],
     ) -> None:
+        if self._use_deterministic_keys:
+            query = self.datastore_client.query(kind=self.datastore_bot_kind, ancestor=self._workspace_key(self.datastore_bot_kind, enterprise_id, team_id))
+            query.keys_only()
+            rows = list(query.fetch())
+            if rows:
+                self.datastore_client.delete_multi([row.key for row in rows])
+            self._cache_invalidate(enterprise_id, team_id)
+            return
+
         query = self.datastore_client.query(kind=self.datastore_bot_kind)
         query.add_filter("client_id", "=", self.client_id)
         query.add_filter("enterprise_id", "=", enterprise_id)
@@ -284,7 +492,8 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         query.keys_only()
         rows = list(query.fetch())
         if rows:
-            self.datastore_client.delete_multi(rows)
+            self.datastore_client.delete_multi([row.key for row in rows])
+        self._cache_invalidate(enterprise_id, team_id)
 
 
     def delete_installation(
@@ -294,6 +503,29 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         team_id: Optional[str],
         user_id: Optional[str] = None,
     ) -> None:
+        if self._use_deterministic_keys:
+            # Ancestor queries are strongly consistent and need no composite index
+            workspace_key = self._workspace_key(self.datastore_installation_kind, enterprise_id, team_id)
+            query = self.datastore_client.query(kind=self.datastore_installation_kind, ancestor=workspace_key)
+            rows = list(query.fetch())
+            replacement = None
+            if user_id is None:
+                keys = [row.key for row in rows]
+            else:
+                keys = [row.key for row in rows if row.key != workspace_key and row.get("user_id") == user_id]
+                workspace_row = next((row for row in rows if row.key == workspace_key), None)
+                if workspace_row is not None and workspace_row.get("user_id") == user_id:
+                    replacement = self._latest_installation_without(rows, workspace_row, user_id)
+                    if replacement is None:
+                        keys.append(workspace_key)
+            with self.datastore_client.transaction():
+                if replacement is not None:
+                    self.datastore_client.put(replacement)
+                if keys:
+                    self.datastore_client.delete_multi(keys)
+            self._cache_invalidate(enterprise_id, team_id)
+            return
+
         query = self.datastore_client.query(kind=self.datastore_installation_kind)
         query.add_filter("client_id", "=", self.client_id)
         query.add_filter("enterprise_id", "=", enterprise_id)
@@ -305,7 +537,26 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         query.keys_only()
         rows = list(query.fetch())
         if rows:
-            self.datastore_client.delete_multi(rows)
+            self.datastore_client.delete_multi([row.key for row in rows])
+        self._cache_invalidate(enterprise_id, team_id)
+
+
+    def _latest_installation_without(self, rows, workspace_row, user_id: str):
+        """ Rebuilds the workspace latest row from the newest other user's row, None if there is none. """
+        remaining = [
+            row for row in rows
+            if row.key.parent is not None and row.key.name.startswith("user:") and row.get("user_id") != user_id
+        ]
+        if not remaining:
+            return None
+
+        newest = max(remaining, key=lambda row: _to_timestamp(row.get("installed_at")) or 0)
+        entity: Entity = datastore.Entity(key=workspace_row.key, exclude_from_indexes=self.installation_exclude_from_indexes)
+        entity.update(newest)
+        # The bot belongs to the workspace, deleting a user doesn't revoke it
+        for field in self.bot_fields:
+            entity[field] = workspace_row.get(field)
+        return entity
 
 
     def delete_all(
@@ -320,8 +571,46 @@ class GoogleDatastoreInstallationStore(InstallationStore):
         )
 
 
+    def migrate_to_deterministic_keys(self, batch_size: int = 100) -> int:
+        """ Moves UUID keyed rows to deterministic keys, returns the number of rows moved. """
+        migrated = 0
+        kinds = [
+            (self.datastore_installation_kind, lambda entity: self._installation_entities(_entity_to_installation(entity))),
+            (self.datastore_bot_kind, lambda entity: self._bot_entities(_entity_to_bot(entity))),
+        ]
+        for kind, to_entities in kinds:
+            query = self.datastore_client.query(kind=kind)
+            query.add_filter("client_id", "=", self.client_id)
+            rows = [row for row in query.fetch() if not self._is_deterministic_key(row.key)]
+
+            # Oldest first so the latest rows end up holding the newest install
+            rows.sort(key=lambda row: _to_timestamp(row.get("installed_at")) or 0)
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                entities = {}
+                for row in batch:
+                    for entity in to_entities(row):
+                        entities[entity.key] = entity
+                with self.datastore_client.transaction():
+                    self.datastore_client.put_multi(list(entities.values()))
+                    self.datastore_client.delete_multi([row.key for row in batch])
+                migrated += len(batch)
+
+        with self._cache_lock:
+            self._cache.clear()
+            self._negative_cache.clear()
+        self.logger.info(f"Migrated {migrated} installation and bot rows to deterministic keys")
+        return migrated
+
+
 
 class GoogleDatastoreOAuthStateStore(OAuthStateStore):
+    """
+    Expired states are purged off the request path by a background sweeper
+    started with start_purge_sweeper().  Each sweep pages through expired
+    states with a cursor and grows or shrinks its batch size depending on how
+    much it finds, purged_count reports the total purged by this store.
+    """
     logger: Logger
     datastore_client: Client
     _datastore_state_kind: str
@@ -334,11 +623,22 @@ class GoogleDatastoreOAuthStateStore(OAuthStateStore):
         datastore_state_kind: str,
         expiration_seconds: int,
         logger: Logger,
+        purge_interval_seconds: int = 300,
+        purge_min_batch_size: int = 10,
+        purge_max_batch_size: int = 500,
     ):
         self.datastore_client = datastore_client
         self.expiration_seconds = expiration_seconds
         self._logger = logger
         self._datastore_state_kind = datastore_state_kind
+        self.purge_interval_seconds = purge_interval_seconds
+        self.purge_min_batch_size = purge_min_batch_size
+        self.purge_max_batch_size = purge_max_batch_size
+        self.purged_count = 0
+        self._purge_batch_size = purge_min_batch_size
+        self._purge_lock = threading.Lock()
+        self._sweeper_stop = threading.Event()
+        self._sweeper = None
 
 
     @property
@@ -350,16 +650,16 @@ class GoogleDatastoreOAuthStateStore(OAuthStateStore):
 
     def consume(self, state: str) -> bool:
         key = self.datastore_client.key(self.datastore_state_kind, state)
-        entity = self.datastore_client.get(key)
-        if entity is not None:
+        with self.datastore_client.transaction():
+            entity = self.datastore_client.get(key)
+            if entity is None:
+                return False
             self.datastore_client.delete(key)
-            now = datetime.now(timezone.utc)
-            return entity['expire_at'] > now
-        return False
+        now = datetime.now(timezone.utc)
+        return entity['expire_at'] > now
 
 
     def issue(self, *args, **kwargs) -> str:
-        self.purge_expired_records(10)
         state_value = str(uuid4())
         expire_at = datetime.now(timezone.utc) + timedelta(seconds=self.expiration_seconds)
         key = self.datastore_client.key(self.datastore_state_kind, state_value)
@@ -374,13 +674,59 @@ class GoogleDatastoreOAuthStateStore(OAuthStateStore):
         return self._datastore_state_kind
 
 
-    def purge_expired_records(self, max_records_limit=10):
+    def purge_expired_records(self, max_records_limit=None):
+        """ Purges expired states page by page, returns the number purged. """
         now = datetime.now(timezone.utc)
-        query = self.datastore_client.query(kind=self.datastore_state_kind)
-        query.add_filter("expire_at", "<", now)
-        query.keys_only()
-        expired_records = list(query.fetch(limit=max_records_limit))
-        if expired_records:
-            self.datastore_client.delete_multi(expired_records)
-
-        return len(expired_records)
+        purged = 0
+        cursor = None
+        with self._purge_lock:
+            while max_records_limit is None or purged < max_records_limit:
+                batch_size = self._purge_batch_size
+                if max_records_limit is not None:
+                    batch_size = min(batch_size, max_records_limit - purged)
+
+                query = self.datastore_client.query(kind=self.datastore_state_kind)
+                query.add_filter("expire_at", "<", now)
+                query.keys_only()
+                query_iter = query.fetch(limit=batch_size, start_cursor=cursor)
+                expired_records = list(next(query_iter.pages))
+                cursor = query_iter.next_page_token
+                if expired_records:
+                    self.datastore_client.delete_multi([record.key for record in expired_records])
+                    purged += len(expired_records)
+
+                # Grow the batch while pages come back full, shrink it once they don't
+                if len(expired_records) == batch_size:
+                    self._purge_batch_size = min(self._purge_batch_size * 2, self.purge_max_batch_size)
+                else:
+                    self._purge_batch_size = max(self._purge_batch_size // 2, self.purge_min_batch_size)
+                    break
+
+                if cursor is None:
+                    break
+
+            self.purged_count += purged
+
+        return purged
+
+
+    def start_purge_sweeper(self):
+        """ Starts a daemon thread purging expired states every purge_interval_seconds. """
+        if self._sweeper is not None:
+            return
+        self._sweeper = threading.Thread(target=self._sweep, name="oauth-state-sweeper", daemon=True)
+        self._sweeper.start()
+
+
+    def stop_purge_sweeper(self):
+        self._sweeper_stop.set()
+
+
+    def _sweep(self):
+        while not self._sweeper_stop.wait(self.purge_interval_seconds):
+            try:
+                purged = self.purge_expired_records()
+                if purged:
+                    self.logger.info(f"Purged {purged} expired OAuth states ({self.purged_count} total)")
+            except Exception:
+                self.logger.exception("Failed to purge expired OAuth states")
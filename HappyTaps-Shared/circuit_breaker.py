@@ -0,0 +1,230 @@
+"""
+    Circuit breakers and hedged calls for the HappyTaps services.
+
+    A CircuitBreaker opens after failure_threshold consecutive failures of a
+    dependency, and while it is open calls fail straight away with CircuitOpen
+    instead of tying up a thread for as long as the dependency takes.  After
+    reset_seconds a single trial call is let through (half open), its outcome
+    closes the circuit again or keeps it open for another reset_seconds.
+
+    A Hedger runs a read on an executor and, if it hasn't finished within the
+    recent p95 latency of that read, sends a second identical one and returns
+    whichever finishes first.  Only use it for calls that are safe to repeat.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from typing import Callable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+
+    def __init__(self, name: str):
+        super().__init__("Circuit "+name+" is open")
+        self.name = name
+
+
+
+class CircuitBreaker:
+    name: str
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30,
+        on_state_change: Callable[[str, str, str], None] = None,
+        logger: logging.Logger = None,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._on_state_change = on_state_change
+        self._logger = logger or logging.getLogger(__name__)
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                return HALF_OPEN
+            return self._state
+
+
+    def allow(self) -> bool:
+        """ Returns True if a call may go through, in half open state only one at a time. """
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                change = self._set_state(HALF_OPEN)
+            else:
+                change = None
+
+            if self._state == CLOSED:
+                allowed = True
+            elif self._state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                allowed = True
+            else:
+                self.rejected += 1
+                allowed = False
+        self._notify(change)
+        return allowed
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            change = self._set_state(CLOSED)
+        self._notify(change)
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                change = self._set_state(OPEN)
+                if change is not None:
+                    self.opened += 1
+            else:
+                change = None
+        self._notify(change)
+
+
+    def cancel(self):
+        """ Hands back a call that was allowed but never made, freeing the half open trial. """
+        with self._lock:
+            self._trial_in_flight = False
+
+
+    def call(self, fn, *args, **kwargs):
+        """ Calls fn through the breaker, raising CircuitOpen while the circuit is open. """
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+    def _set_state(self, state: str):
+        if state == self._state:
+            return None
+        change = (self._state, state)
+        self._state = state
+        return change
+
+
+    def _notify(self, change):
+        if change is None:
+            return
+        self._logger.warning("Circuit "+self.name+" changed from "+change[0]+" to "+change[1])
+        if self._on_state_change is not None:
+            self._on_state_change(self.name, change[0], change[1])
+
+
+
+class Hedger:
+    executor: Executor
+
+    def __init__(
+        self,
+        *,
+        executor: Executor,
+        percentile: float = 0.95,
+        min_delay_seconds: float = 0.02,
+        default_delay_seconds: float = 0.2,
+        window: int = 200,
+    ):
+        self.executor = executor
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.default_delay_seconds = default_delay_seconds
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.hedges = 0
+        self.hedge_wins = 0
+
+
+    def delay(self) -> float:
+        """ Returns how long to wait for the first call before sending a backup. """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        # Not enough samples yet for a meaningful percentile
+        if len(latencies) < 20:
+            return self.default_delay_seconds
+        return max(self.min_delay_seconds, latencies[int(self.percentile * (len(latencies) - 1))])
+
+
+    def call(self, fn, *args, **kwargs):
+        """ Returns (result, hedge_won) for the first successful call of fn. """
+        start = time.monotonic()
+        primary = self.executor.submit(fn, *args, **kwargs)
+        done, _ = wait([primary], timeout=self.delay())
+        if done:
+            self._record(time.monotonic() - start)
+            return primary.result(), False
+
+        backup = self.executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            self.hedges += 1
+
+        # Take the first call to succeed, raise only if both fail
+        pending = {primary, backup}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._record(time.monotonic() - start)
+                    hedge_won = future is backup
+                    if hedge_won:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result(), hedge_won
+        return primary.result(), False
+
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        with self._lock:
+            return {
+                "delay_seconds": round(delay, 4),
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+            }
+
+
+    def _record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
@@ -0,0 +1,154 @@
+"""
+    Lazily built clients and startup warm-up for the HappyTaps services.
+
+    Building a Datastore or Pub/Sub client looks up credentials and sets up a
+    gRPC channel, and on a cold start that used to happen while the module was
+    imported, before the server could take a request.  A LazyClient stands in
+    for the client and builds it on first use, or ahead of time on a background
+    thread with start(), so several clients are built in parallel while the
+    rest of the app loads.  Any attribute it doesn't define itself, get()
+    included, is looked up on the built client.
+
+    Warmup runs a set of checks in parallel once the app is loaded, e.g. a
+    Datastore read and a connection to each upstream host, and a readiness
+    endpoint waits on it so the first real request finds everything open.
+    The app is only ready once every check has passed, checks that failed are
+    run again the next time the endpoint waits.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable
+
+
+class LazyClient:
+    name: str
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        factory: Callable[[], object],
+        logger: logging.Logger = None,
+    ):
+        self.name = name
+        self._factory = factory
+        self._logger = logger or logging.getLogger(__name__)
+        self._client = None
+        self._lock = threading.Lock()
+        self.build_seconds = None
+
+
+    def client(self):
+        """ Returns the client, building it or waiting for a build in progress. """
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                start = time.perf_counter()
+                self._client = self._factory()
+                self.build_seconds = time.perf_counter() - start
+            return self._client
+
+
+    @property
+    def built(self) -> bool:
+        return self._client is not None
+
+
+    def start(self):
+        """ Builds the client on a background thread, a failed build is retried on first use. """
+        threading.Thread(target=self._build_quietly, name="build-"+self.name, daemon=True).start()
+        return self
+
+
+    def __getattr__(self, attribute):
+        return getattr(self.client(), attribute)
+
+
+    def _build_quietly(self):
+        try:
+            self.client()
+        except Exception:
+            self._logger.exception("Failed to build "+self.name+" client")
+
+
+
+class Warmup:
+
+    def __init__(
+        self,
+        *,
+        checks: dict,
+        logger: logging.Logger = None,
+    ):
+        self.checks = checks
+        self._logger = logger or logging.getLogger(__name__)
+        self._started_at = None
+        self._running = False
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self.seconds = {}
+        self.failed = []
+
+
+    def start(self):
+        """ Runs every check in parallel on background threads, then only re-runs the ones that failed. """
+        with self._lock:
+            if self._running or (self._done.is_set() and not self.failed):
+                return self
+            names = list(self.failed) if self._done.is_set() else list(self.checks)
+            if self._started_at is None:
+                self._started_at = time.perf_counter()
+            self._running = True
+            self.failed = []
+            self._done.clear()
+        threading.Thread(target=self._run, args=(names,), name="warmup", daemon=True).start()
+        return self
+
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Starts the warm-up if needed and returns True once every check has passed. """
+        self.start()
+        if not self._done.wait(timeout):
+            return False
+        with self._lock:
+            return not self.failed
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self._done.is_set() and not self.failed,
+                "seconds": {name: round(seconds, 4) for name, seconds in self.seconds.items()},
+                "failed": list(self.failed),
+            }
+
+
+    def _run(self, names):
+        threads = [
+            threading.Thread(target=self._check, args=(name, self.checks[name]), name="warmup-"+name, daemon=True)
+            for name in names
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with self._lock:
+            self.seconds["total"] = time.perf_counter() - self._started_at
+            self._running = False
+            self._done.set()
+
+
+    def _check(self, name, check):
+        start = time.perf_counter()
+        try:
+            check()
+        except Exception as error:
+            self._logger.warning("Warm-up of "+name+" failed: "+str(error))
+            with self._lock:
+                self.failed.append(name)
+        with self._lock:
+            self.seconds[name] = time.perf_counter() - start
@@ -0,0 +1,122 @@
+"""
+    Per-location request counters for the HappyTaps services.
+
+    Requests are counted in memory and flushed to Datastore in batches from a
+    background thread, so counting doesn't add a Datastore write per request.
+    Counts are kept per day and spread over a number of shard entities per
+    location, so concurrent flushes from several instances rarely contend on
+    the same entity:
+
+    - <day>:<location>:<shard>    {location, day, count}
+
+    top_locations() adds the shards back up to find the hottest locations.
+"""
+
+import atexit
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import datastore
+from google.cloud.datastore import Client
+
+
+class PopularityCounter:
+    datastore_client: Client
+    _datastore_counter_kind: str
+
+    def __init__(
+        self,
+        *,
+        datastore_client: Client,
+        datastore_counter_kind: str,
+        num_shards: int = 8,
+        flush_interval_seconds: float = 30,
+        logger: logging.Logger = None,
+    ):
+        self.datastore_client = datastore_client
+        self.num_shards = num_shards
+        self.flush_interval_seconds = flush_interval_seconds
+        self._datastore_counter_kind = datastore_counter_kind
+        self._logger = logger or logging.getLogger(__name__)
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="popularity-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+
+    @property
+    def datastore_counter_kind(self) -> str:
+        return self._datastore_counter_kind
+
+
+    def increment(self, location: str):
+        with self._lock:
+            self._counts[location] += 1
+
+
+    def flush(self):
+        with self._lock:
+            counts = self._counts
+            self._counts = Counter()
+        if not counts:
+            return
+
+        day = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d")
+        items = list(counts.items())
+        with self._flush_lock:
+            # Transactions are limited to 500 mutations
+            for start in range(0, len(items), 500):
+                batch = items[start:start + 500]
+                keys = [
+                    self.datastore_client.key(self.datastore_counter_kind, f"{day}:{location}:{random.randrange(self.num_shards)}")
+                    for location, _ in batch
+                ]
+                try:
+                    with self.datastore_client.transaction():
+                        existing = {entity.key: entity for entity in self.datastore_client.get_multi(keys)}
+                        entities = []
+                        for key, (location, count) in zip(keys, batch):
+                            entity = existing.get(key)
+                            if entity is None:
+                                entity = datastore.Entity(key=key)
+                                entity.update({"location": location, "day": day, "count": 0})
+                            entity["count"] += count
+                            entities.append(entity)
+                        self.datastore_client.put_multi(entities)
+                except Exception:
+                    # Put the counts back so they go out with the next flush
+                    self._logger.exception("Failed to flush popularity counters")
+                    with self._lock:
+                        self._counts.update(dict(batch))
+
+
+    def top_locations(self, n: int, days: int = 1) -> list:
+        """ Returns the n most requested locations over the last days as (location, count). """
+        totals = Counter()
+        today = datetime.now(tz=timezone.utc)
+        for offset in range(days):
+            day = (today - timedelta(days=offset)).strftime("%Y-%m-%d")
+            query = self.datastore_client.query(kind=self.datastore_counter_kind)
+            query.add_filter("day", "=", day)
+            for entity in query.fetch():
+                totals[entity["location"]] += entity["count"]
+
+        # Include counts that haven't been flushed yet
+        with self._lock:
+            totals.update(self._counts)
+        return totals.most_common(n)
+
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval_seconds)
+            try:
+                self.flush()
+            except Exception:
+                self._logger.exception("Failed to flush popularity counters")
@@ -0,0 +1,99 @@
+"""
+    In-process location cache for the HappyTaps services.
+
+    This is the first tier in front of the HappyTaps kind in Google Datastore.
+    Entries are bounded in number (least recently used entries are evicted first)
+    and expire a fixed time after the timestamp of the business list they hold,
+    so a cached entry is never served for longer than the Datastore copy would be.
+    Entries can be given a shorter TTL of their own, e.g. for negative results.
+    Expired entries stay until evicted so they can still be served while
+    Datastore is unavailable.
+
+    Datastore remains the shared second tier across Cloud Run instances.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+
+class LocationCache:
+    max_size: int
+    ttl: timedelta
+
+    def __init__(
+        self,
+        *,
+        max_size: int,
+        ttl: timedelta,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+
+    def get(self, location: str) -> Optional[dict]:
+        now = datetime.now(tz=timezone.utc)
+        with self._lock:
+            entry = self._entries.get(location)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Expire entries based on when the business list was fetched, they
+            # are kept around for get_stale() until evicted
+            if entry['expires_at'] <= now:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(location)
+            self.hits += 1
+            return entry
+
+
+    def get_stale(self, location: str) -> Optional[dict]:
+        """ Returns an entry even if it has expired, for when nothing fresher can be had. """
+        with self._lock:
+            entry = self._entries.get(location)
+            if entry is not None:
+                self.stale_hits += 1
+            return entry
+
+
+    def put(self, location: str, businesses: list, timestamp: datetime, ttl: Optional[timedelta] = None):
+        entry = {
+            "businesses": businesses,
+            "timestamp": timestamp,
+            "expires_at": timestamp + (ttl or self.ttl),
+        }
+        with self._lock:
+            self._entries[location] = entry
+            self._entries.move_to_end(location)
+
+            # Evict least recently used entries once we exceed the size limit
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def invalidate(self, location: str):
+        with self._lock:
+            self._entries.pop(location, None)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "stale_hits": self.stale_hits,
+            }
@@ -0,0 +1,53 @@
+"""
+    Storage format for business lists in the HappyTaps kind.
+
+    Version 1 stores the raw Yelp businesses payload as an unindexed nested
+    entity under "businesses".
+
+    Version 2 keeps only the fields HappyTaps uses and stores them as zlib
+    compressed JSON in a single bytes property "businesses_blob", with
+    "format_version" set to 2.  Readers handle both versions.
+
+    Version 1 is still written by default, so instances running code that only
+    reads version 1 keep working through a rolling deploy.  Set
+    TAPS_FORMAT_VERSION=2 once every service reads both.
+"""
+
+import json
+import zlib
+
+
+# Format written unless a service asks for another one
+FORMAT_VERSION = 1
+
+# Fields kept from each Yelp business
+PROJECTED_FIELDS = ("id", "name", "url", "image_url", "coordinates")
+
+
+def project_businesses(businesses: list) -> list:
+    return [
+        {field: business.get(field) for field in PROJECTED_FIELDS}
+        for business in businesses
+    ]
+
+
+def encode_businesses(businesses: list) -> bytes:
+    return zlib.compress(json.dumps(businesses, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_businesses(entity) -> list:
+    if entity.get("format_version") == 2:
+        return json.loads(zlib.decompress(entity["businesses_blob"]).decode("utf-8"))
+    return entity["businesses"]
+
+
+def taps_properties(businesses: list, format_version: int = FORMAT_VERSION):
+    """ Returns (properties, exclude_from_indexes) for storing a business list. """
+    if format_version == 1:
+        # Must exclude 'businesses' from indexes as values are too long
+        return {"businesses": businesses}, ["businesses"]
+
+    return {
+        "format_version": 2,
+        "businesses_blob": encode_businesses(project_businesses(businesses)),
+    }, ["businesses_blob"]
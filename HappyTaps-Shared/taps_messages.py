@@ -0,0 +1,139 @@
+"""
+    Slack Block Kit messages posted by HappyTaps-FindTaps, and by
+    HappyTaps-FrontEnd on the cache-hit fast path.
+"""
+
+
+def no_taps_message(yelp_location: str) -> dict:
+    return {
+        "response_type": "in_channel",
+        "blocks": [
+            {
+                "type": "header",
+                "text": {
+                    "type": "plain_text",
+                    "text": "No Happy Hour!!!!",
+                }
+            },
+            {
+                "type": "context",
+                "elements": [
+                    {
+                        "type": "mrkdwn",
+                        "text": "No bars are available near *"+yelp_location+"*! LAME!"
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def yelp_unavailable_message(yelp_location: str) -> dict:
+    return {
+        "response_type": "in_channel",
+        "blocks": [
+            {
+                "type": "header",
+                "text": {
+                    "type": "plain_text",
+                    "text": "Last Call!!!!",
+                }
+            },
+            {
+                "type": "context",
+                "elements": [
+                    {
+                        "type": "mrkdwn",
+                        "text": "Couldn't look up bars near *"+yelp_location+"* right now, try again in a minute!"
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def taps_message(yelp_location: str, bar: dict) -> dict:
+    bar_name = bar['name']
+    bar_url = bar['url']
+    bar_pic = bar['image_url']
+    bar_pretext = "Let's get some drinks near *"+yelp_location+"*, what do you think about this?"
+    return {
+        "response_type": "in_channel",
+        "blocks": [
+            {
+                "type": "header",
+                "text": {
+                    "type": "plain_text",
+                    "text": "Happy Hour!!!!",
+                }
+            },
+            {
+                "type": "context",
+                "elements": [
+                    {
+                        "type": "mrkdwn",
+                        "text": bar_pretext
+                    }
+                ]
+            },
+            {
+                "type": "image",
+                "image_url": bar_pic,
+                "alt_text": "happy hour pic"
+            },
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "<"+bar_url+"|"+bar_name+">"
+                }
+            }
+        ]
+    }
+
+
+def multi_taps_message(suggestions: list) -> dict:
+    blocks = [
+        {
+            "type": "header",
+            "text": {
+                "type": "plain_text",
+                "text": "Happy Hour!!!!",
+            }
+        },
+        {
+            "type": "context",
+            "elements": [
+                {
+                    "type": "mrkdwn",
+                    "text": "Let's get some drinks, here's a pick for each area. Where are we going?"
+                }
+            ]
+        },
+    ]
+    for yelp_location, bar, yelp_unavailable in suggestions:
+        blocks.append({"type": "divider"})
+        if bar is None and yelp_unavailable:
+            text = "*"+yelp_location+"*: couldn't look up bars here right now, try again in a minute!"
+        elif bar is None:
+            text = "*"+yelp_location+"*: no bars are available nearby! LAME!"
+        else:
+            text = "*"+yelp_location+"*: <"+bar['url']+"|"+bar['name']+">"
+        section = {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": text
+            }
+        }
+        if bar is not None and bar.get('image_url'):
+            section["accessory"] = {
+                "type": "image",
+                "image_url": bar['image_url'],
+                "alt_text": "happy hour pic"
+            }
+        blocks.append(section)
+    return {
+        "response_type": "in_channel",
+        "blocks": blocks,
+    }
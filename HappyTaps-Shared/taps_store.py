@@ -0,0 +1,452 @@
+"""
+    Stores for the business lists the HappyTaps services cache per location.
+
+    Every store maps a location to a record, the same shape the services keep
+    in their local caches:
+
+    - <location>    {businesses, timestamp}
+
+    and supports batched reads and writes.  A record written with a ttl expires
+    that long after its timestamp, and reads no longer return it.
+
+    - DatastoreTapsStore keeps records in the HappyTaps kind, in the storage
+      format from taps_format.py, with an "expire_at" property a Datastore TTL
+      policy can delete expired records by.  The default.
+    - SqliteTapsStore keeps records in a local SQLite database in WAL mode, so
+      the workers of one instance share it and readers never wait on a writer.
+    - MemoryTapsStore keeps records in a dict, per process.
+
+    Only the Datastore store is shared by every instance.  A DatastoreLease
+    waiter polls the store for the lease holder's result, so with the SQLite
+    or memory store a waiter on another instance never sees it and always
+    times out.  Each store says whether it is shared in its "shared" attribute.
+
+    build_taps_store() picks one by name, the services take it from TAPS_STORE.
+
+    sweep() deletes expired records and any record older than a retention
+    window, so locations nobody asks for any more don't stay stored forever.
+    The Datastore store pages through the kind by the indexed "timestamp"
+    with cursors, deletes with delete_multi and keeps to a write budget, and
+    can also rewrite records stored in an older format than the one it
+    writes.  Every store reports what it reclaimed:
+
+    - {scanned, deleted, compacted, bytes_reclaimed, seconds, complete}
+
+    where complete is False when the budget ran out before the sweep did.
+"""
+
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import datastore
+from google.cloud.datastore import Client
+
+from taps_format import FORMAT_VERSION, decode_businesses, encode_businesses, project_businesses, taps_properties
+
+DATASTORE = "datastore"
+SQLITE = "sqlite"
+MEMORY = "memory"
+
+# Datastore accepts at most 500 entities per commit
+MAX_WRITE_BATCH = 500
+
+# Lower bound for expire_at filters, null values would otherwise sort below it
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class WriteBudget:
+
+    def __init__(
+        self,
+        *,
+        writes_per_second: float = None,
+        max_writes: int = None,
+        max_seconds: float = None,
+    ):
+        self.writes_per_second = writes_per_second
+        self.max_writes = max_writes
+        self.max_seconds = max_seconds
+        self.writes = 0
+        self._started_at = time.monotonic()
+
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self._started_at
+
+
+    @property
+    def exhausted(self) -> bool:
+        if self.max_writes is not None and self.writes >= self.max_writes:
+            return True
+        return self.max_seconds is not None and self.seconds >= self.max_seconds
+
+
+    def limit(self, batch_size: int) -> int:
+        """ Returns how many writes the next batch may make. """
+        if self.max_writes is None:
+            return batch_size
+        return max(0, min(batch_size, self.max_writes - self.writes))
+
+
+    def spend(self, writes: int):
+        """ Counts writes, sleeping as long as needed to stay under writes_per_second. """
+        self.writes += writes
+        if self.writes_per_second:
+            ahead = self.writes / self.writes_per_second - self.seconds
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+
+class TapsStore(ABC):
+    name: str
+    ttl: timedelta
+    shared: bool
+
+    @abstractmethod
+    def get_multi(self, yelp_locations: list, timeout: float = None) -> dict:
+        """ Returns {location: record} for the locations that have an unexpired record. """
+
+
+    @abstractmethod
+    def put_multi(self, records: dict, ttl: timedelta = None, timeout: float = None):
+        """ Writes {location: record}, expiring them ttl (or the store's ttl) after their timestamps. """
+
+
+    def get(self, yelp_location: str, timeout: float = None):
+        return self.get_multi([yelp_location], timeout=timeout).get(yelp_location)
+
+
+    def put(self, yelp_location: str, businesses: list, timestamp: datetime, ttl: timedelta = None, timeout: float = None):
+        self.put_multi({yelp_location: {"businesses": businesses, "timestamp": timestamp}}, ttl=ttl, timeout=timeout)
+
+
+    def expire_at(self, timestamp: datetime, ttl: timedelta = None):
+        ttl = ttl or self.ttl
+        return timestamp + ttl if ttl else None
+
+
+    @abstractmethod
+    def sweep(
+        self,
+        retention: timedelta,
+        *,
+        budget: WriteBudget = None,
+        compact: bool = False,
+        timeout: float = None,
+    ) -> dict:
+        """ Deletes expired records and records older than retention, returns what was reclaimed. """
+
+
+
+class DatastoreTapsStore(TapsStore):
+    datastore_client: Client
+    _datastore_taps_kind: str
+    shared = True
+
+    def __init__(
+        self,
+        *,
+        datastore_client: Client,
+        datastore_taps_kind: str = "HappyTaps",
+        format_version: int = FORMAT_VERSION,
+        ttl: timedelta = None,
+    ):
+        self.name = DATASTORE
+        self.datastore_client = datastore_client
+        self.format_version = format_version
+        self.ttl = ttl
+        self._datastore_taps_kind = datastore_taps_kind
+
+
+    @property
+    def datastore_taps_kind(self) -> str:
+        return self._datastore_taps_kind
+
+
+    def get_multi(self, yelp_locations: list, timeout: float = None) -> dict:
+        keys = [self.datastore_client.key(self.datastore_taps_kind, yelp_location) for yelp_location in yelp_locations]
+        now = datetime.now(tz=timezone.utc)
+        records = {}
+        # A TTL policy deletes expired entities some time after they expire
+        for entity in self.datastore_client.get_multi(keys, timeout=timeout):
+            if entity.get("expire_at") is not None and entity["expire_at"] <= now:
+                continue
+            records[entity.key.name] = {"businesses": decode_businesses(entity), "timestamp": entity["timestamp"]}
+        return records
+
+
+    def put_multi(self, records: dict, ttl: timedelta = None, timeout: float = None):
+        entities = []
+        for yelp_location, record in records.items():
+            key = self.datastore_client.key(self.datastore_taps_kind, yelp_location)
+            properties, exclude_from_indexes = taps_properties(record["businesses"], self.format_version)
+            entity = datastore.Entity(key=key, exclude_from_indexes=exclude_from_indexes)
+            entity.update(properties)
+            entity.update({
+                "timestamp": record["timestamp"],
+                "expire_at": self.expire_at(record["timestamp"], ttl),
+            })
+            entities.append(entity)
+        self.datastore_client.put_multi(entities, timeout=timeout)
+
+
+    def sweep(
+        self,
+        retention: timedelta,
+        *,
+        budget: WriteBudget = None,
+        compact: bool = False,
+        timeout: float = None,
+    ) -> dict:
+        budget = budget or WriteBudget()
+        now = datetime.now(tz=timezone.utc)
+        result = {"scanned": 0, "deleted": 0, "compacted": 0, "bytes_reclaimed": 0}
+
+        def delete_page(entities):
+            self.datastore_client.delete_multi([entity.key for entity in entities], timeout=timeout)
+            result["deleted"] += len(entities)
+            result["bytes_reclaimed"] += sum(stored_size(entity) for entity in entities)
+            return len(entities)
+
+        def compact_page(entities):
+            # Version 1 records have no format_version, so they can't be
+            # queried for directly and every record within retention is read.
+            # Only records in an older format than the one written are rewritten.
+            stale = [entity for entity in entities if entity.get("format_version", 1) < self.format_version]
+            if not stale:
+                return 0
+            compacted = []
+            for entity in stale:
+                properties, exclude_from_indexes = taps_properties(decode_businesses(entity), self.format_version)
+                replacement = datastore.Entity(key=entity.key, exclude_from_indexes=exclude_from_indexes)
+                replacement.update(properties)
+                replacement.update({"timestamp": entity["timestamp"], "expire_at": entity.get("expire_at")})
+                result["bytes_reclaimed"] += stored_size(entity) - stored_size(replacement)
+                compacted.append(replacement)
+            self.datastore_client.put_multi(compacted, timeout=timeout)
+            result["compacted"] += len(compacted)
+            return len(compacted)
+
+        # Expired records first, then everything written before the retention
+        # window, oldest first so a sweep cut short has reclaimed the oldest
+        complete = self._sweep_pages([("expire_at", ">", EPOCH), ("expire_at", "<", now)], "expire_at", delete_page, budget, result, timeout)
+        complete = complete and self._sweep_pages([("timestamp", "<", now - retention)], "timestamp", delete_page, budget, result, timeout)
+        if compact:
+            complete = complete and self._sweep_pages([("timestamp", ">=", now - retention)], "timestamp", compact_page, budget, result, timeout)
+
+        result["seconds"] = round(budget.seconds, 3)
+        result["complete"] = complete
+        return result
+
+
+    def _sweep_pages(self, filters, order, handle_page, budget, result, timeout) -> bool:
+        # Pages through the kind with a cursor, handle_page returns how many
+        # writes it made.  Returns False if the budget ran out first.
+        cursor = None
+        while not budget.exhausted:
+            limit = budget.limit(MAX_WRITE_BATCH)
+            query = self.datastore_client.query(kind=self.datastore_taps_kind, order=[order])
+            for property_name, operator, value in filters:
+                query.add_filter(property_name, operator, value)
+            query_iter = query.fetch(limit=limit, start_cursor=cursor, timeout=timeout)
+            entities = list(next(query_iter.pages))
+            cursor = query_iter.next_page_token
+            result["scanned"] += len(entities)
+            if entities:
+                budget.spend(handle_page(entities))
+            if len(entities) < limit or cursor is None:
+                return True
+        return False
+
+
+
+class SqliteTapsStore(TapsStore):
+    path: str
+    shared = False
+
+    def __init__(
+        self,
+        *,
+        path: str,
+        ttl: timedelta = None,
+        busy_timeout_seconds: float = 5,
+    ):
+        self.name = SQLITE
+        self.path = path
+        self.ttl = ttl
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS taps ("
+                "location TEXT PRIMARY KEY, businesses BLOB NOT NULL, timestamp REAL NOT NULL, expire_at REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS taps_expire_at ON taps (expire_at)")
+
+
+    def get_multi(self, yelp_locations: list, timeout: float = None) -> dict:
+        if not yelp_locations:
+            return {}
+        rows = self._connection().execute(
+            "SELECT location, businesses, timestamp FROM taps WHERE location IN ("+",".join("?" * len(yelp_locations))+")"
+            " AND (expire_at IS NULL OR expire_at > ?)",
+            list(yelp_locations) + [time.time()],
+        ).fetchall()
+        return {
+            location: {
+                "businesses": json.loads(zlib.decompress(businesses).decode("utf-8")),
+                "timestamp": datetime.fromtimestamp(timestamp, tz=timezone.utc),
+            }
+            for location, businesses, timestamp in rows
+        }
+
+
+    def put_multi(self, records: dict, ttl: timedelta = None, timeout: float = None):
+        rows = []
+        for yelp_location, record in records.items():
+            expire_at = self.expire_at(record["timestamp"], ttl)
+            rows.append((
+                yelp_location,
+                encode_businesses(project_businesses(record["businesses"])),
+                record["timestamp"].timestamp(),
+                expire_at.timestamp() if expire_at else None,
+            ))
+        with self._connection() as connection:
+            connection.executemany("INSERT OR REPLACE INTO taps VALUES (?, ?, ?, ?)", rows)
+
+
+    def sweep(
+        self,
+        retention: timedelta,
+        *,
+        budget: WriteBudget = None,
+        compact: bool = False,
+        timeout: float = None,
+    ) -> dict:
+        # Records are always stored compacted, and deleting from a local file
+        # doesn't need throttling
+        budget = budget or WriteBudget()
+        now = time.time()
+        swept = "expire_at <= ? OR timestamp < ?"
+        parameters = (now, now - retention.total_seconds())
+        with self._connection() as connection:
+            stored_bytes = connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(location) + LENGTH(businesses)), 0) FROM taps WHERE "+swept, parameters
+            ).fetchone()[0]
+            deleted = connection.execute("DELETE FROM taps WHERE "+swept, parameters).rowcount
+        return {
+            "scanned": deleted, "deleted": deleted, "compacted": 0, "bytes_reclaimed": stored_bytes,
+            "seconds": round(budget.seconds, 3), "complete": True,
+        }
+
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads, keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout_seconds)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+
+
+class MemoryTapsStore(TapsStore):
+    shared = False
+
+    def __init__(
+        self,
+        *,
+        ttl: timedelta = None,
+    ):
+        self.name = MEMORY
+        self.ttl = ttl
+        self._records = {}
+        self._lock = threading.Lock()
+
+
+    def get_multi(self, yelp_locations: list, timeout: float = None) -> dict:
+        now = datetime.now(tz=timezone.utc)
+        records = {}
+        with self._lock:
+            for yelp_location in yelp_locations:
+                entry = self._records.get(yelp_location)
+                if entry is None:
+                    continue
+                record, expire_at = entry
+                if expire_at is not None and expire_at <= now:
+                    del self._records[yelp_location]
+                    continue
+                records[yelp_location] = record
+        return records
+
+
+    def put_multi(self, records: dict, ttl: timedelta = None, timeout: float = None):
+        with self._lock:
+            for yelp_location, record in records.items():
+                self._records[yelp_location] = (
+                    {"businesses": project_businesses(record["businesses"]), "timestamp": record["timestamp"]},
+                    self.expire_at(record["timestamp"], ttl),
+                )
+
+
+    def sweep(
+        self,
+        retention: timedelta,
+        *,
+        budget: WriteBudget = None,
+        compact: bool = False,
+        timeout: float = None,
+    ) -> dict:
+        budget = budget or WriteBudget()
+        now = datetime.now(tz=timezone.utc)
+        with self._lock:
+            scanned = len(self._records)
+            expired = [
+                location for location, (record, expire_at) in self._records.items()
+                if (expire_at is not None and expire_at <= now) or record["timestamp"] < now - retention
+            ]
+            for yelp_location in expired:
+                del self._records[yelp_location]
+        # Records are held as objects, there is no stored size to report
+        return {
+            "scanned": scanned, "deleted": len(expired), "compacted": 0, "bytes_reclaimed": 0,
+            "seconds": round(budget.seconds, 3), "complete": True,
+        }
+
+
+
+def stored_size(entity) -> int:
+    """ Estimates the bytes a HappyTaps entity takes up, its key name and business list. """
+    if "businesses_blob" in entity:
+        businesses = len(entity["businesses_blob"])
+    else:
+        businesses = len(json.dumps(entity.get("businesses"), separators=(",", ":")).encode("utf-8"))
+    return len(entity.key.name.encode("utf-8")) + businesses
+
+
+
+def build_taps_store(
+    backend: str,
+    *,
+    datastore_client: Client = None,
+    sqlite_path: str = "happytaps.db",
+    format_version: int = FORMAT_VERSION,
+    ttl: timedelta = None,
+) -> TapsStore:
+    """ Returns the store named by backend: datastore, sqlite or memory. """
+    if backend == DATASTORE:
+        return DatastoreTapsStore(datastore_client=datastore_client, format_version=format_version, ttl=ttl)
+    if backend == SQLITE:
+        return SqliteTapsStore(path=sqlite_path, ttl=ttl)
+    if backend == MEMORY:
+        return MemoryTapsStore(ttl=ttl)
+    raise ValueError("Unknown taps store "+repr(backend)+", expected datastore, sqlite or memory")
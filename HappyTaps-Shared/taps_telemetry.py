@@ -0,0 +1,185 @@
+"""
+    OpenTelemetry metrics and Pub/Sub trace propagation for the HappyTaps services.
+
+    Calls to anything outside a service go through dependency_call(), which
+    opens a child span and records the call's latency, so every dependency
+    shows up both in traces and in these metrics:
+
+    - happytaps.dependency.duration    ms, {dependency, operation, outcome}
+    - happytaps.cache.lookups          {tier}, a keyed miss may still be a geo hit
+    - happytaps.yelp.calls             {priority, status}
+    - happytaps.pubsub.queue_age       ms from publish to handling, {subscription}
+
+    Metrics are exported over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set, e.g.
+    to a local collector at http://localhost:4317, and printed to stdout with
+    OTEL_METRICS_EXPORTER=console.
+
+    Trace context travels between services in Pub/Sub message attributes, so one
+    slash command shows up as a single trace from the frontend onwards.
+
+    LazySpanExporter builds the span exporter on the first export, so creating
+    the Cloud Trace client doesn't hold up startup.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+from opentelemetry import metrics, trace
+from opentelemetry.propagate import extract, inject
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import ConsoleMetricExporter, PeriodicExportingMetricReader
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace.export import SpanExporter
+from opentelemetry.trace import SpanKind
+
+from lazy_clients import LazyClient
+
+
+def inject_message_context() -> dict:
+    """ Returns Pub/Sub message attributes carrying the current trace context. """
+    carrier = {}
+    inject(carrier)
+    return carrier
+
+
+def extract_message_context(attributes: dict):
+    """ Returns the trace context carried in Pub/Sub message attributes, if any. """
+    return extract(attributes or {})
+
+
+def parse_publish_time(publish_time: str) -> Optional[datetime]:
+    """ Parses a push message's publishTime, which may carry nanoseconds. """
+    if not publish_time:
+        return None
+    seconds, _, fraction = publish_time.rstrip("Z").partition(".")
+    parsed = datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+    if fraction:
+        parsed = parsed.replace(microsecond=int(fraction[:6].ljust(6, "0")))
+    return parsed
+
+
+class TapsTelemetry:
+    service_name: str
+
+    def __init__(
+        self,
+        *,
+        service_name: str,
+        export_interval_seconds: float = 60,
+    ):
+        self.service_name = service_name
+
+        readers = []
+        if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+            # Imported here, the gRPC exporter is slow to import and mostly unused
+            from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+            readers.append(PeriodicExportingMetricReader(
+                OTLPMetricExporter(insecure=os.environ.get("OTEL_EXPORTER_OTLP_INSECURE", "true") == "true"),
+                export_interval_millis=export_interval_seconds * 1000,
+            ))
+        if os.environ.get("OTEL_METRICS_EXPORTER") == "console":
+            readers.append(PeriodicExportingMetricReader(
+                ConsoleMetricExporter(),
+                export_interval_millis=export_interval_seconds * 1000,
+            ))
+        self.meter_provider = MeterProvider(
+            resource=Resource.create({"service.name": service_name}),
+            metric_readers=readers,
+        )
+        metrics.set_meter_provider(self.meter_provider)
+
+        meter = self.meter_provider.get_meter(service_name)
+        self.tracer = trace.get_tracer(service_name)
+        self.dependency_duration = meter.create_histogram(
+            "happytaps.dependency.duration",
+            unit="ms",
+            description="Latency of calls to Yelp, Datastore, Pub/Sub and Slack",
+        )
+        self.cache_lookups = meter.create_counter(
+            "happytaps.cache.lookups",
+            description="Business list lookups by the tier that answered them",
+        )
+        self.yelp_calls = meter.create_counter(
+            "happytaps.yelp.calls",
+            description="Calls made to the Yelp search API",
+        )
+        self.queue_age = meter.create_histogram(
+            "happytaps.pubsub.queue_age",
+            unit="ms",
+            description="Time from Pub/Sub publish to the push being handled",
+        )
+
+
+    @contextmanager
+    def dependency_call(self, dependency: str, operation: str, links=None, **attributes):
+        """ Wraps a call to a dependency in a child span and records its latency. """
+        outcome = "ok"
+        start = time.perf_counter()
+        with self.tracer.start_as_current_span(dependency+"."+operation, kind=SpanKind.CLIENT, links=links) as span:
+            span.set_attribute("dependency", dependency)
+            for name, value in attributes.items():
+                span.set_attribute(name, value)
+            try:
+                yield span
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                self.dependency_duration.record((time.perf_counter() - start) * 1000, {
+                    "dependency": dependency,
+                    "operation": operation,
+                    "outcome": outcome,
+                })
+
+
+    def record_elapsed(self, dependency: str, operation: str, start_time_ns: int, parent=None):
+        """ Records a dependency call that was timed elsewhere, ending now. """
+        context = trace.set_span_in_context(parent) if parent is not None else None
+        span = self.tracer.start_span(dependency+"."+operation, context=context, kind=SpanKind.CLIENT, start_time=start_time_ns)
+        span.set_attribute("dependency", dependency)
+        end_time_ns = time.time_ns()
+        span.end(end_time=end_time_ns)
+        self.dependency_duration.record((end_time_ns - start_time_ns) / 1e6, {
+            "dependency": dependency,
+            "operation": operation,
+            "outcome": "ok",
+        })
+
+
+    def record_cache_lookup(self, tier: str):
+        trace.get_current_span().set_attribute("cache_tier", tier)
+        self.cache_lookups.add(1, {"tier": tier})
+
+
+    def record_yelp_call(self, priority: str, status: int):
+        self.yelp_calls.add(1, {"priority": priority, "status": status})
+
+
+    def record_queue_age(self, publish_time: str, subscription: str) -> Optional[float]:
+        """ Records how long a push message waited in Pub/Sub, from its publishTime. """
+        published_at = parse_publish_time(publish_time)
+        if published_at is None:
+            return None
+        queue_age_ms = (datetime.now(tz=timezone.utc) - published_at).total_seconds() * 1000
+        trace.get_current_span().set_attribute("queue_age_ms", queue_age_ms)
+        self.queue_age.record(queue_age_ms, {"subscription": subscription})
+        return queue_age_ms
+
+
+
+class LazySpanExporter(SpanExporter):
+
+    def __init__(self, exporter: LazyClient):
+        self._exporter = exporter
+
+
+    def export(self, spans):
+        return self._exporter.client().export(spans)
+
+
+    def shutdown(self):
+        if self._exporter.built:
+            self._exporter.client().shutdown()
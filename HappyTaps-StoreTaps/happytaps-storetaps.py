@@ -1,50 +1,265 @@
 import os
 import json
+import zlib
+import base64
 import logging
-from datetime import datetime, timezone
-from flask import Flask, request
+import threading
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, jsonify
 from google.cloud import datastore
+from taps_store import build_taps_store, WriteBudget
+from taps_format import FORMAT_VERSION
+from taps_writer import BatchWriter
+from circuit_breaker import CircuitBreaker, OPEN
+from taps_telemetry import TapsTelemetry, LazySpanExporter, extract_message_context
+from lazy_clients import LazyClient, Warmup
+
+# Tracing
+from opentelemetry import trace
+from opentelemetry.trace import Link, SpanKind
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.instrumentation.flask import FlaskInstrumentor
+from opentelemetry.propagate import set_global_textmap
+from opentelemetry.propagators.cloud_trace_propagator import (
+    CloudTraceFormatPropagator,
+)
+
+set_global_textmap(CloudTraceFormatPropagator())
+
+tracer_provider = TracerProvider()
+
+# Function to build the Cloud Trace exporter, imported here as it is only
+# needed once the first batch of spans goes out
+def build_cloud_trace_exporter():
+    from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+    return CloudTraceSpanExporter()
+
+
+# Export spans to Cloud Trace, can be turned off to run without GCP credentials.
+# The exporter is built in the background.
+if os.environ.get("CLOUD_TRACE_ENABLED", "true") == "true":
+    cloud_trace_exporter = LazySpanExporter(LazyClient(name="cloud_trace", factory=build_cloud_trace_exporter).start())
+    tracer_provider.add_span_processor(
+        BatchSpanProcessor(cloud_trace_exporter)
+    )
+trace.set_tracer_provider(tracer_provider)
+
+tracer = trace.get_tracer(__name__)
+
+# Dependency latency metrics, see taps_telemetry.py
+telemetry = TapsTelemetry(service_name="happytaps-storetaps")
 
 # Intitialize Flask app that exposes endpoint for pubsub FindTaps subscription
 app = Flask(__name__)
 
+# Instrument Flask app for open telemetry tracing
+FlaskInstrumentor().instrument_app(app)
+
 # Define logger and set log level
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Instantiates a Google datastore client
-datastore_client = datastore.Client()
+# Storage format written for business lists, readers handle every version
+TAPS_FORMAT_VERSION = int(os.environ.get("TAPS_FORMAT_VERSION", FORMAT_VERSION))
+
+# Writes from concurrent messages are coalesced into put_multi batches,
+# flushed at least every STORE_FLUSH_INTERVAL seconds
+STORE_FLUSH_INTERVAL = float(os.environ.get("STORE_FLUSH_INTERVAL", 0.2))
+STORE_FLUSH_TIMEOUT = float(os.environ.get("STORE_FLUSH_TIMEOUT", 30))
+
+# Google datastore client, built in the background while the app loads and on
+# first use at the latest
+datastore_client = LazyClient(name="datastore", factory=datastore.Client, logger=logger).start()
+
+# Store for business lists, TAPS_STORE=sqlite shares a database file with a
+# FindTaps and FrontEnd on the same host
+taps_store = build_taps_store(
+    os.environ.get("TAPS_STORE", "datastore"),
+    datastore_client=datastore_client,
+    sqlite_path=os.environ.get("TAPS_STORE_PATH", "happytaps.db"),
+    format_version=TAPS_FORMAT_VERSION,
+)
+
+# Circuit breaker around datastore writes, while it is open messages are
+# nacked straight away and pubsub redelivers them with backoff
+datastore_breaker = CircuitBreaker(
+    name="datastore",
+    failure_threshold=int(os.environ.get("BREAKER_FAILURES", 5)),
+    reset_seconds=float(os.environ.get("BREAKER_RESET_SECONDS", 30)),
+    logger=logger,
+)
+
+# Batch writer shared by all request threads
+taps_writer = BatchWriter(
+    taps_store=taps_store,
+    flush_interval=STORE_FLUSH_INTERVAL,
+    write_timeout=float(os.environ.get("DATASTORE_TIMEOUT_SECONDS", 10)),
+    breaker=datastore_breaker,
+    telemetry=telemetry,
+    logger=logger,
+)
+
+# Business lists not rewritten for TAPS_RETENTION_DAYS are deleted by POST
+# /sweeptaps, which a scheduled job calls.  The sweep keeps to
+# SWEEP_WRITES_PER_SECOND so it doesn't compete with storetaps writes, and
+# stops after SWEEP_MAX_WRITES or SWEEP_MAX_SECONDS to pick up on the next run.
+# SWEEP_MAX_SECONDS stays under Cloud Scheduler's default 180s attempt deadline
+# and Cloud Run's 300s request timeout so a run isn't cut off and retried.
+TAPS_RETENTION_DAYS = float(os.environ.get("TAPS_RETENTION_DAYS", 30))
+SWEEP_WRITES_PER_SECOND = float(os.environ.get("SWEEP_WRITES_PER_SECOND", 50))
+SWEEP_MAX_WRITES = int(os.environ.get("SWEEP_MAX_WRITES", 20000))
+SWEEP_MAX_SECONDS = float(os.environ.get("SWEEP_MAX_SECONDS", 120))
+sweep_lock = threading.Lock()
+last_sweep = {}
+
+# Warm the datastore client as soon as the app is loaded, GET /ready waits on it
+# so a startup probe holds traffic back until then
+READY_TIMEOUT_SECONDS = float(os.environ.get("READY_TIMEOUT_SECONDS", 10))
+warmup = Warmup(checks={
+    "datastore": lambda: datastore_client.get(datastore_client.key("HappyTaps-Warmup", "warmup"), timeout=taps_writer.write_timeout),
+}, logger=logger).start()
 
 # Flask app decorator defining route for storetaps endpoint
 @app.route('/storetaps', methods=['POST'])
-# Function to update business list in Cloud Datastore
+# Function to update business lists in Cloud Datastore
 def store_taps():
-    # Save attributes from pubsub push subscription message
-    data = request.json
-    attributes = data['message']['attributes']
-    yelp_location = str(attributes['yelp_location'])
-    updated_businesses = json.loads(str(attributes['updated_businesses']))
-    logging.info("yelp_location: "+yelp_location)
-    logging.info("updated_businesses: "+updated_businesses)
-
-    # Define key for datastore
-    data_key = datastore_client.key("HappyTaps",yelp_location)
-
-    # Define element to be updated in datastore
-    # Must exclude 'businesses' from indexes as values are too long
-    data_element = datastore.Entity(key=data_key, exclude_from_indexes=(['businesses']))
-    data_element.update({
-        "businesses":updated_businesses,
-        "timestamp":datetime.now(tz=timezone.utc)
-    })
-
-    # Saves the entity to datastore
-    datastore_client.put(data_element)
+    # A push that isn't a pubsub envelope will never succeed, ack it so it
+    # isn't redelivered
+    envelope = request.get_json(silent=True)
+    message = envelope.get('message') if isinstance(envelope, dict) else None
+    if not isinstance(message, dict):
+        logger.error("Dropping storetaps push without a pubsub message")
+        return '', 204
+
+    # Continue the publisher's trace when it carries one in the message
+    # attributes, and link back to the push request's own span
+    push_span = trace.get_current_span()
+    with tracer.start_as_current_span(
+        "process_storetaps",
+        context=extract_message_context(message.get('attributes')),
+        kind=SpanKind.CONSUMER,
+        links=[Link(push_span.get_span_context())],
+    ):
+        telemetry.record_queue_age(message.get('publishTime'), "storetaps")
+        return write_message(message)
+
+
+# Function to decode a pubsub message and write its business lists to Cloud Datastore
+def write_message(message):
+    # Decode the business lists carried by the pubsub push subscription message
+    try:
+        locations = decode_message(message)
+    except (KeyError, ValueError, zlib.error) as error:
+        # Malformed messages will never succeed, ack them so they aren't redelivered
+        logger.error("Dropping malformed storetaps message "+str(message.get('messageId'))+": "+str(error))
+        return '', 204
+
+    logging.info("storing "+str(len(locations))+" locations: "+", ".join(locations))
+
+    # Don't hold a thread waiting on datastore while it is known to be failing
+    if datastore_breaker.state == OPEN:
+        return 'Datastore unavailable', 503
+
+    # Queue the records for the next batch and wait until it has been written,
+    # pubsub redelivers the message if we fail before acking
+    timestamp = datetime.now(tz=timezone.utc)
+    records = {yelp_location: {"businesses": businesses, "timestamp": timestamp} for yelp_location, businesses in locations.items()}
+    try:
+        taps_writer.put(records).wait(STORE_FLUSH_TIMEOUT)
+    except Exception:
+        logger.exception("Failed to store locations: "+", ".join(locations))
+        return 'Error', 500
 
     # Success return code to let pubsub know message delivered
     return 'Ok', 200
 
-    
+
+# Route decorator exposing batch writer counters
+@app.route('/storestats', methods=['GET'])
+def store_stats():
+    stats = taps_writer.stats()
+    stats["datastore_breaker"] = datastore_breaker.stats()
+    stats["last_sweep"] = last_sweep
+    return jsonify(stats), 200
+
+
+# Route decorator for the sweeper, called by a scheduled job.  A JSON body can
+# override the defaults for one run, e.g. {"retention_days": 7, "compact": true}
+# also rewrites records within retention still stored in an older format.
+@app.route('/sweeptaps', methods=['POST'])
+def sweep_taps():
+    options = request.get_json(silent=True) or {}
+
+    # Don't add to the load on datastore while it is known to be failing
+    if datastore_breaker.state == OPEN:
+        return 'Datastore unavailable', 503
+
+    # One sweep at a time, overlapping runs would page over the same records
+    if not sweep_lock.acquire(blocking=False):
+        return 'Sweep already running', 409
+    try:
+        budget = WriteBudget(
+            writes_per_second=float(options.get("writes_per_second", SWEEP_WRITES_PER_SECOND)),
+            max_writes=int(options.get("max_writes", SWEEP_MAX_WRITES)),
+            max_seconds=float(options.get("max_seconds", SWEEP_MAX_SECONDS)),
+        )
+        retention = timedelta(days=float(options.get("retention_days", TAPS_RETENTION_DAYS)))
+        with telemetry.dependency_call(taps_store.name, "sweep") as sweep_span:
+            result = datastore_breaker.call(
+                taps_store.sweep, retention, budget=budget, compact=bool(options.get("compact", False)), timeout=taps_writer.write_timeout,
+            )
+            for name, value in result.items():
+                sweep_span.set_attribute("sweep_"+name, value)
+    except Exception:
+        logger.exception("Failed to sweep the taps store")
+        return 'Error', 500
+    finally:
+        sweep_lock.release()
+
+    logger.info("swept taps store: "+json.dumps(result))
+    last_sweep.clear()
+    last_sweep.update(result, finished_at=datetime.now(tz=timezone.utc).isoformat())
+    return jsonify(result), 200
+
+
+# Route decorator for the readiness probe, answers once the datastore client is warm
+@app.route('/ready', methods=['GET'])
+def ready():
+    if not warmup.wait(READY_TIMEOUT_SECONDS):
+        return jsonify(warmup.stats()), 503
+    return jsonify(warmup.stats()), 200
+
+
+# Function to decode a pubsub message into a dict of location -> businesses.
+#
+# Business lists travel in the message body, as JSON or as zlib compressed
+# JSON when the 'encoding' attribute is 'zlib+json':
+#
+#     {"locations": {"greenpoint": [...], "nyc": [...]}}
+#
+# Messages with a single list in the 'updated_businesses' attribute are still
+# accepted, although attribute values are limited to 1024 bytes.
+def decode_message(message):
+    attributes = message.get('attributes', {})
+    if 'updated_businesses' in attributes:
+        locations = {attributes['yelp_location']: json.loads(str(attributes['updated_businesses']))}
+    else:
+        payload = base64.b64decode(message['data'])
+        if attributes.get('encoding') == 'zlib+json':
+            payload = zlib.decompress(payload)
+        payload = json.loads(payload.decode('utf-8'))
+        if not isinstance(payload, dict):
+            raise ValueError("payload is not an object")
+        locations = payload['locations']
+        if not isinstance(locations, dict):
+            raise ValueError("locations is not an object")
+
+    for yelp_location, businesses in locations.items():
+        if not isinstance(businesses, list) or not all(isinstance(business, dict) for business in businesses):
+            raise ValueError("businesses for "+str(yelp_location)+" is not a list of objects")
+    return {str(yelp_location).lower(): businesses for yelp_location, businesses in locations.items()}
+
 
 # Start your app
 if __name__ == "__main__":
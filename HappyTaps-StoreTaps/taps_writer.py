@@ -0,0 +1,155 @@
+"""
+    Coalescing batch writer for HappyTaps-StoreTaps.
+
+    Records handed to BatchWriter.put() as {location: {businesses, timestamp}}
+    are buffered and written with the taps store's put_multi from a background
+    thread, either once a full batch is pending or when the oldest pending
+    record has waited flush_interval seconds.  Multiple writes for the same
+    location within a batch are coalesced into the last one.
+
+    put() returns a handle that is completed once the batch holding those
+    records has been written, so callers can hold the Pub/Sub ack until their
+    data is durable.
+
+    Batches are written through an optional circuit breaker, so while Datastore
+    keeps failing the store the batch fails straight away instead of waiting on it.
+
+    With telemetry, each put_multi gets its own span linked to the spans of
+    every put() it carries, since one batch serves many requests.
+"""
+
+import logging
+import threading
+import time
+
+from opentelemetry import trace
+from opentelemetry.trace import Link
+
+from circuit_breaker import CircuitBreaker
+from taps_store import TapsStore
+from taps_telemetry import TapsTelemetry
+
+
+# Datastore accepts at most 500 entities per commit
+MAX_BATCH_SIZE = 500
+
+
+class FlushHandle:
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._error = None
+
+
+    def set_result(self, error: Exception = None):
+        self._error = error
+        self._done.set()
+
+
+    def wait(self, timeout: float = None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Batch was not written within "+str(timeout)+" seconds")
+        if self._error is not None:
+            raise self._error
+
+
+
+class BatchWriter:
+    taps_store: TapsStore
+
+    def __init__(
+        self,
+        *,
+        taps_store: TapsStore,
+        flush_interval: float,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        write_timeout: float = None,
+        breaker: CircuitBreaker = None,
+        telemetry: TapsTelemetry = None,
+        logger: logging.Logger = None,
+    ):
+        self.taps_store = taps_store
+        self.flush_interval = flush_interval
+        self.write_timeout = write_timeout
+        self.breaker = breaker
+        self.telemetry = telemetry
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self._logger = logger or logging.getLogger(__name__)
+        self._pending = {}
+        self._pending_links = []
+        self._pending_since = None
+        self._handle = FlushHandle()
+        self._cond = threading.Condition()
+        self.batches_written = 0
+        self.records_written = 0
+        self._thread = threading.Thread(target=self._run, name="taps-batch-writer", daemon=True)
+        self._thread.start()
+
+
+    def put(self, records: dict) -> FlushHandle:
+        with self._cond:
+            self._pending.update(records)
+            span_context = trace.get_current_span().get_span_context()
+            if self.telemetry is not None and span_context.is_valid:
+                self._pending_links.append(Link(span_context))
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+            handle = self._handle
+            self._cond.notify()
+        return handle
+
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "batches_written": self.batches_written,
+                "records_written": self.records_written,
+            }
+
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                # Wait for a full batch or for the oldest write to reach the flush interval
+                deadline = self._pending_since + self.flush_interval
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                records = list(self._pending.items())
+                links = self._pending_links
+                handle = self._handle
+                self._pending = {}
+                self._pending_links = []
+                self._pending_since = None
+                self._handle = FlushHandle()
+
+            try:
+                for start in range(0, len(records), self.max_batch_size):
+                    self._put_multi(dict(records[start:start + self.max_batch_size]), links)
+                    self.batches_written += 1
+                self.records_written += len(records)
+                handle.set_result()
+            except Exception as error:
+                self._logger.exception("Failed to write batch of "+str(len(records))+" records")
+                handle.set_result(error)
+
+
+    def _put_multi(self, records, links):
+        if self.telemetry is None:
+            return self._write(records)
+        with self.telemetry.dependency_call(self.taps_store.name, "put_multi", links=links, batch_size=len(records)):
+            self._write(records)
+
+
+    def _write(self, records):
+        if self.breaker is None:
+            self.taps_store.put_multi(records, timeout=self.write_timeout)
+        else:
+            self.breaker.call(self.taps_store.put_multi, records, timeout=self.write_timeout)
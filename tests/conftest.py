@@ -0,0 +1,65 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# The services' modules are imported by name, as they are in the containers,
+# with the modules they share built from HappyTaps-Shared
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("HappyTaps-Shared", "HappyTaps-FindTaps", "HappyTaps-FrontEnd", "HappyTaps-StoreTaps"):
+    sys.path.insert(0, os.path.join(REPO, directory))
+
+# Entrypoints build their clients at import, keep them off the network
+os.environ.setdefault("CLOUD_TRACE_ENABLED", "false")
+os.environ.setdefault("YELP_API_KEY", "test")
+
+import taps_pipeline  # noqa: E402
+from circuit_breaker import CircuitBreaker  # noqa: E402
+from fake_datastore import FakeDatastoreClient  # noqa: E402
+from fake_frontend import FakePublisher  # noqa: E402
+from popularity import PopularityCounter  # noqa: E402
+from taps_cache import LocationCache  # noqa: E402
+from taps_store import MemoryTapsStore  # noqa: E402
+
+_services = {}
+
+
+# Fixture loading a service's entrypoint by its file name, once per test run
+@pytest.fixture
+def load_service():
+    def load(path):
+        if path not in _services:
+            spec = importlib.util.spec_from_file_location(os.path.basename(path).replace("-", "_")[:-3], os.path.join(REPO, path))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _services[path] = module
+        return _services[path]
+    return load
+
+
+# Fixture loading the frontend with its store, cache, counters and publisher
+# replaced by in-memory ones
+@pytest.fixture
+def frontend(load_service, monkeypatch):
+    for name in ("SLACK_CLIENT_ID", "SLACK_CLIENT_SECRET", "SLACK_SIGNING_SECRET"):
+        monkeypatch.setenv(name, "test")
+    frontend = load_service("HappyTaps-FrontEnd/happytaps-frontend.py")
+    monkeypatch.setattr(frontend, "popularity", PopularityCounter(datastore_client=FakeDatastoreClient(), datastore_counter_kind="HappyTaps-Popularity"))
+    monkeypatch.setattr(frontend, "publisher", FakePublisher())
+    monkeypatch.setattr(frontend, "taps_store", MemoryTapsStore())
+    monkeypatch.setattr(frontend, "location_cache", LocationCache(max_size=16, ttl=frontend.TAPS_TTL))
+    return frontend
+
+
+# Fixture for the FindTaps pipeline with an in-memory store, a fresh local
+# cache and counters, a breaker opening on the first failure and no spatial index
+@pytest.fixture
+def pipeline(monkeypatch):
+    popularity = PopularityCounter(datastore_client=FakeDatastoreClient(), datastore_counter_kind="HappyTaps-Popularity")
+    monkeypatch.setattr(taps_pipeline, "popularity", popularity)
+    monkeypatch.setattr(taps_pipeline, "taps_store", MemoryTapsStore())
+    monkeypatch.setattr(taps_pipeline, "location_cache", LocationCache(max_size=16, ttl=taps_pipeline.TAPS_MAX_AGE))
+    monkeypatch.setattr(taps_pipeline, "datastore_breaker", CircuitBreaker(name="datastore", failure_threshold=1))
+    monkeypatch.setattr(taps_pipeline, "spatial_index", None)
+    return taps_pipeline
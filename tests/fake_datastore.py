@@ -0,0 +1,199 @@
+"""
+    In-memory stand-in for google.cloud.datastore.Client, for unit tests.
+
+    Keeps entities in a dict by key, builds real Key and Entity objects, and
+    runs every transaction under one lock so read-modify-write sequences in a
+    transaction are atomic the way Datastore makes them.  fail_with makes every
+    call raise that exception, to test what callers do while Datastore is down.
+
+    Queries support kind, ancestor, equality and inequality filters, order,
+    keys_only and paging with limit and cursors, and order null before any
+    other value as Datastore does.  Like the real client, delete_multi only
+    takes keys.
+"""
+
+import operator
+import threading
+
+from google.cloud import datastore
+
+FILTER_OPERATORS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "!=": operator.ne,
+}
+
+
+# Function to compare values the way Datastore orders them, null before anything else
+def _ordered(value):
+    return (value is not None, value)
+
+
+class FakeDatastoreClient:
+
+    def __init__(self, project: str = "happytaps-test"):
+        self.project = project
+        self.entities = {}
+        self.calls = []
+        self.fail_with = None
+        self._lock = threading.RLock()
+
+
+    def key(self, *path_args, **kwargs):
+        return datastore.Key(*path_args, project=self.project, **kwargs)
+
+
+    def get(self, key, timeout=None, **kwargs):
+        self._call("get")
+        with self._lock:
+            entity = self.entities.get(key)
+            return self._copy(entity) if entity is not None else None
+
+
+    def get_multi(self, keys, timeout=None, **kwargs):
+        self._call("get_multi")
+        with self._lock:
+            return [self._copy(self.entities[key]) for key in keys if key in self.entities]
+
+
+    def put(self, entity, timeout=None, **kwargs):
+        self.put_multi([entity], timeout=timeout)
+
+
+    def put_multi(self, entities, timeout=None, **kwargs):
+        self._call("put_multi")
+        with self._lock:
+            for entity in entities:
+                self.entities[entity.key] = self._copy(entity)
+
+
+    def delete(self, key, timeout=None, **kwargs):
+        self.delete_multi([key], timeout=timeout)
+
+
+    def delete_multi(self, keys, timeout=None, **kwargs):
+        self._call("delete_multi")
+        with self._lock:
+            for key in keys:
+                if not isinstance(key, datastore.Key):
+                    raise AttributeError(type(key).__name__+" is not a Key")
+                self.entities.pop(key, None)
+
+
+    def query(self, kind=None, ancestor=None, order=(), **kwargs):
+        query = FakeQuery(self, kind, ancestor)
+        query.order = list(order)
+        return query
+
+
+    def transaction(self, **kwargs):
+        return self._lock
+
+
+    def _call(self, name):
+        self.calls.append(name)
+        if self.fail_with is not None:
+            raise self.fail_with
+
+
+    def _copy(self, entity):
+        copy = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+        copy.update(entity)
+        return copy
+
+
+
+class FakeQuery:
+
+    def __init__(self, client: FakeDatastoreClient, kind: str, ancestor):
+        self._client = client
+        self.kind = kind
+        self.ancestor = ancestor
+        self.filters = []
+        self.order = []
+        self._keys_only = False
+
+
+    def add_filter(self, property_name, operator, value):
+        self.filters.append((property_name, operator, value))
+        return self
+
+
+    def keys_only(self):
+        self._keys_only = True
+
+
+    def fetch(self, limit=None, start_cursor=None, timeout=None, **kwargs):
+        self._client._call("query")
+        with self._client._lock:
+            rows = [entity for key, entity in self._client.entities.items() if self._matches(key, entity)]
+
+        # Cursors mark a position in the results rather than an offset, so
+        # deleting the rows of one page doesn't skip any on the next
+        offset = 0
+        if start_cursor is not None:
+            rows.append(start_cursor)
+        rows = self._sorted(rows)
+        if start_cursor is not None:
+            offset = next(i for i, entity in enumerate(rows) if entity is start_cursor)
+            del rows[offset]
+
+        end = len(rows) if limit is None else offset + limit
+        page = rows[offset:end]
+        cursor = self._client._copy(page[-1]) if page and end < len(rows) else None
+        return FakeIterator([self._result(entity) for entity in page], cursor)
+
+
+    def _sorted(self, rows):
+        # Datastore orders by key after the requested properties
+        rows = sorted(rows, key=lambda entity: entity.key.flat_path)
+        for name in reversed(self.order):
+            descending = name.startswith("-")
+            rows.sort(key=lambda entity: _ordered(entity.get(name.lstrip("-"))), reverse=descending)
+        return rows
+
+
+    def _matches(self, key, entity):
+        if key.kind != self.kind:
+            return False
+        if self.ancestor is not None and key != self.ancestor and not self._descends_from(key):
+            return False
+        for property_name, op, value in self.filters:
+            if property_name not in entity or not FILTER_OPERATORS[op](_ordered(entity[property_name]), _ordered(value)):
+                return False
+        return True
+
+
+    def _descends_from(self, key):
+        parent = key.parent
+        while parent is not None:
+            if parent == self.ancestor:
+                return True
+            parent = parent.parent
+        return False
+
+
+    def _result(self, entity):
+        if self._keys_only:
+            return datastore.Entity(key=entity.key)
+        return self._client._copy(entity)
+
+
+
+class FakeIterator:
+
+    def __init__(self, page: list, next_page_token):
+        self._page = page
+        self.next_page_token = next_page_token
+
+
+    def __iter__(self):
+        return iter(self._page)
+
+
+    @property
+    def pages(self):
+        yield iter(self._page)
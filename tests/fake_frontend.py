@@ -0,0 +1,37 @@
+"""
+    Stand-ins for the Pub/Sub publisher and Slack respond() used by
+    HappyTaps-FrontEnd's slash command, for unit tests.
+"""
+
+BAR = {"id": "a", "name": "Bar", "url": "https://www.yelp.com/biz/bar", "image_url": "https://s3-media.yelp.com/bar.jpg", "coordinates": {"latitude": 40.72, "longitude": -73.95}}
+
+
+class FakeFuture:
+    def add_done_callback(self, callback):
+        callback(self)
+
+
+class FakePublisher:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, data, **attributes):
+        self.published.append(attributes)
+        return FakeFuture()
+
+
+class FakeRespond:
+    response_url = "https://hooks.slack.test/response"
+
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, message):
+        self.messages.append(message)
+
+
+# Function to run /happytaps with the given text, returns what it responded
+def command(frontend, text):
+    respond = FakeRespond()
+    frontend.happy_taps(ack=lambda message: None, body={"text": text}, respond=respond, context={})
+    return respond
@@ -0,0 +1,33 @@
+def business(business_id):
+    return {"id": business_id, "name": "Bar "+business_id, "url": "https://www.yelp.com/biz/"+business_id,
+            "image_url": "https://s3-media.yelp.com/"+business_id+".jpg", "coordinates": {"latitude": 40.72, "longitude": -73.95}}
+
+
+def test_pages_are_merged_without_repeats_in_order(pipeline):
+    first = [business("a"), business("b")]
+    # Results shift between page requests, so a business can show up twice
+    second = [business("b"), business("c")]
+    third = [business("a"), business("d")]
+
+    assert [bar["id"] for bar in pipeline.merge_businesses([first, second, third])] == ["a", "b", "c", "d"]
+
+
+def test_deeper_pages_cover_the_pool_depth(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, "YELP_POOL_DEPTH", 120)
+
+    assert pipeline.pool_pages({"total": 500}) == [(20, 50), (70, 50)]
+    assert pipeline.pool_pages({"total": 100}) == [(20, 50), (70, 30)]
+    # Nothing beyond the first page
+    assert pipeline.pool_pages({"total": 15}) == []
+    assert pipeline.pool_pages({}) == []
+
+
+def test_pool_is_only_stored_when_it_adds_businesses(pipeline):
+    first = [business("a"), business("b")]
+
+    pipeline.store_pool("greenpoint", first, [[business("a")], []])
+    assert pipeline.taps_store.get("greenpoint") is None
+
+    pipeline.store_pool("greenpoint", first, [[business("b"), business("c")]])
+    assert [bar["id"] for bar in pipeline.taps_store.get("greenpoint")["businesses"]] == ["a", "b", "c"]
+    assert [bar["id"] for bar in pipeline.location_cache.get("greenpoint")["businesses"]] == ["a", "b", "c"]
@@ -0,0 +1,115 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, Hedger
+
+
+def fail():
+    raise RuntimeError("datastore down")
+
+
+def test_opens_after_consecutive_failures_and_rejects_calls():
+    changes = []
+    breaker = CircuitBreaker(name="datastore", failure_threshold=3, reset_seconds=60, on_state_change=lambda *change: changes.append(change))
+    calls = []
+
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            breaker.call(fail)
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: calls.append(1))
+
+    assert calls == []
+    assert breaker.state == OPEN
+    assert changes == [("datastore", CLOSED, OPEN)]
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(name="datastore", failure_threshold=2)
+
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+    assert breaker.call(lambda: "ok") == "ok"
+    with pytest.raises(RuntimeError):
+        breaker.call(fail)
+
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_one_trial_through_and_its_outcome_decides():
+    breaker = CircuitBreaker(name="yelp", failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_cancel_hands_back_the_half_open_trial():
+    breaker = CircuitBreaker(name="yelp", failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+
+    assert breaker.allow()
+    breaker.cancel()
+    assert breaker.allow()
+
+
+def test_fast_call_is_not_hedged():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        hedger = Hedger(executor=executor, default_delay_seconds=1)
+
+        assert hedger.call(lambda: "businesses") == ("businesses", False)
+        assert hedger.stats()["hedges"] == 0
+
+
+def test_backup_call_answers_when_the_first_is_slow():
+    release = threading.Event()
+    calls = []
+
+    def get():
+        calls.append(1)
+        # Only the first call hangs
+        if len(calls) == 1:
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        hedger = Hedger(executor=executor, default_delay_seconds=0.01)
+        assert hedger.call(get) == ("fast", True)
+        release.set()
+
+    assert hedger.stats()["hedges"] == 1
+    assert hedger.stats()["hedge_wins"] == 1
+
+
+def test_hedged_call_raises_only_when_both_calls_fail():
+    def get():
+        raise RuntimeError("datastore down")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        hedger = Hedger(executor=executor, default_delay_seconds=0)
+        with pytest.raises(RuntimeError):
+            hedger.call(get)
+
+
+def test_hedge_delay_follows_the_observed_latency():
+    hedger = Hedger(executor=None, percentile=0.5, min_delay_seconds=0.02, default_delay_seconds=0.2)
+    assert hedger.delay() == 0.2
+
+    for seconds in [0.05] * 10 + [0.5] * 10:
+        hedger._record(seconds)
+    assert hedger.delay() == 0.05
+
+    hedger = Hedger(executor=None, percentile=0.5, min_delay_seconds=0.02)
+    for _ in range(20):
+        hedger._record(0.001)
+    assert hedger.delay() == 0.02
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+
+from fake_frontend import BAR, command
+
+
+class FailingStore:
+    name = "datastore"
+
+    def get(self, yelp_location, timeout=None):
+        raise RuntimeError("datastore down")
+
+
+def test_fresh_store_record_is_answered_and_cached(frontend):
+    timestamp = datetime.now(tz=timezone.utc)
+    frontend.taps_store.put("greenpoint", [BAR], timestamp)
+
+    assert frontend.get_fresh_taps("greenpoint") == [BAR]
+    assert frontend.location_cache.get("greenpoint")["timestamp"] == timestamp
+
+
+def test_cached_location_doesnt_read_the_store(frontend, monkeypatch):
+    frontend.location_cache.put("greenpoint", [BAR], datetime.now(tz=timezone.utc))
+    monkeypatch.setattr(frontend, "taps_store", FailingStore())
+
+    assert frontend.get_fresh_taps("greenpoint") == [BAR]
+
+
+def test_stale_and_missing_locations_go_to_findtaps(frontend):
+    frontend.taps_store.put("greenpoint", [BAR], datetime.now(tz=timezone.utc) - timedelta(days=2))
+
+    assert frontend.get_fresh_taps("greenpoint") is None
+    assert frontend.get_fresh_taps("astoria") is None
+
+
+def test_store_failure_publishes_instead(frontend, monkeypatch):
+    monkeypatch.setattr(frontend, "taps_store", FailingStore())
+
+    assert frontend.get_fresh_taps("greenpoint") is None
+    respond = command(frontend, "greenpoint")
+
+    assert respond.messages == []
+    assert frontend.publisher.published[0]["location"] == "greenpoint"
+
+
+def test_fast_path_answers_in_the_channel(frontend):
+    frontend.taps_store.put("greenpoint", [BAR], datetime.now(tz=timezone.utc))
+
+    respond = command(frontend, "Greenpoint")
+
+    assert frontend.publisher.published == []
+    (message,) = respond.messages
+    assert message["response_type"] == "in_channel"
+    assert "<"+BAR["url"]+"|"+BAR["name"]+">" in str(message)
@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta, timezone
+
+from fake_frontend import BAR, command
+
+
+def test_location_answered_by_the_frontend_is_counted(frontend):
+    frontend.taps_store.put("greenpoint", [BAR], datetime.now(tz=timezone.utc))
+
+    respond = command(frontend, "Greenpoint")
+
+    assert len(respond.messages) == 1
+    assert frontend.publisher.published == []
+    assert frontend.popularity.top_locations(5) == [("greenpoint", 1)]
+
+
+def test_location_sent_to_findtaps_is_left_for_findtaps_to_count(frontend):
+    frontend.taps_store.put("greenpoint", [BAR], datetime.now(tz=timezone.utc) - timedelta(days=2))
+
+    respond = command(frontend, "greenpoint")
+
+    assert respond.messages == []
+    assert len(frontend.publisher.published) == 1
+    assert frontend.popularity.top_locations(5) == []
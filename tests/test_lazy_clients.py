@@ -0,0 +1,73 @@
+import threading
+
+from fake_datastore import FakeDatastoreClient
+from google.cloud import datastore
+
+from lazy_clients import LazyClient, Warmup
+
+
+def test_client_methods_named_like_proxy_methods_reach_the_client():
+    lazy_client = LazyClient(name="datastore", factory=FakeDatastoreClient)
+    key = lazy_client.key("HappyTaps", "greenpoint")
+    entity = datastore.Entity(key=key)
+    entity["timestamp"] = 1
+
+    lazy_client.put(entity)
+
+    assert lazy_client.get(key)["timestamp"] == 1
+    assert lazy_client.get_multi([key])[0].key == key
+
+
+def test_client_is_built_once_across_threads():
+    builds = []
+    lazy_client = LazyClient(name="datastore", factory=lambda: builds.append(1) or FakeDatastoreClient())
+
+    threads = [threading.Thread(target=lazy_client.client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert lazy_client.built
+    assert lazy_client.build_seconds is not None
+
+
+def test_failed_background_build_is_retried_on_first_use():
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("no credentials yet")
+        return FakeDatastoreClient()
+
+    lazy_client = LazyClient(name="datastore", factory=factory)
+    lazy_client._build_quietly()
+
+    assert not lazy_client.built
+    assert lazy_client.project == "happytaps-test"
+    assert len(attempts) == 2
+
+
+def test_warmup_is_not_ready_while_a_check_fails_and_retries_it():
+    runs = {"datastore": 0, "yelp": 0}
+
+    def datastore_check():
+        runs["datastore"] += 1
+        if runs["datastore"] == 1:
+            raise RuntimeError("datastore down")
+
+    def yelp_check():
+        runs["yelp"] += 1
+
+    warmup = Warmup(checks={"datastore": datastore_check, "yelp": yelp_check})
+
+    assert warmup.wait(5) is False
+    assert warmup.stats()["failed"] == ["datastore"]
+    assert warmup.stats()["ready"] is False
+
+    # Only the failed check runs again
+    assert warmup.wait(5) is True
+    assert warmup.stats()["ready"] is True
+    assert runs == {"datastore": 2, "yelp": 1}
@@ -0,0 +1,68 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from fake_frontend import BAR, command
+from taps_messages import multi_taps_message
+
+
+def test_locations_are_normalised_and_capped(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, "MAX_LOCATIONS", 3)
+
+    locations = json.dumps([" Greenpoint ", "greenpoint", "", "Williamsburg, Brooklyn", "Bushwick", "Astoria"])
+
+    assert pipeline.parse_locations(locations) == ["greenpoint", "williamsburg, brooklyn", "bushwick"]
+
+
+def test_several_locations_are_split_on_semicolons(frontend):
+    frontend.taps_store.put("greenpoint", [BAR], datetime.now(tz=timezone.utc))
+
+    respond = command(frontend, "Greenpoint; Williamsburg, Brooklyn ;")
+
+    # Always answered by FindTaps, even when one of them is fresh here
+    assert respond.messages == []
+    (published,) = frontend.publisher.published
+    assert json.loads(published["locations"]) == ["Greenpoint", "Williamsburg, Brooklyn"]
+
+
+def test_single_location_with_a_stray_separator_takes_the_fast_path(frontend):
+    frontend.taps_store.put("greenpoint", [BAR], datetime.now(tz=timezone.utc))
+
+    respond = command(frontend, "Greenpoint;")
+
+    assert len(respond.messages) == 1
+    assert frontend.publisher.published == []
+
+
+def test_cached_locations_skip_the_batched_store_read(pipeline):
+    now = datetime.now(tz=timezone.utc)
+    pipeline.location_cache.put("greenpoint", [BAR], now)
+    pipeline.taps_store.put("bushwick", [BAR], now)
+
+    data_responses = pipeline.get_many_taps(["greenpoint", "bushwick", "astoria"])
+
+    assert data_responses["greenpoint"]["businesses"] == [BAR]
+    assert data_responses["bushwick"]["businesses"] == [BAR]
+    assert data_responses["astoria"] is None
+    assert pipeline.location_cache.get("bushwick") is not None
+
+
+def test_store_failure_falls_back_to_expired_local_copies(pipeline, monkeypatch):
+    pipeline.location_cache.put("greenpoint", [BAR], datetime.now(tz=timezone.utc) - timedelta(days=3))
+    monkeypatch.setattr(pipeline.taps_store, "get_multi", lambda *args, **kwargs: 1 / 0)
+
+    data_responses = pipeline.get_many_taps(["greenpoint", "bushwick"])
+
+    assert data_responses["greenpoint"]["businesses"] == [BAR]
+    assert data_responses["bushwick"] is None
+
+
+def test_one_message_answers_every_area():
+    message = multi_taps_message([("greenpoint", BAR, False), ("nowhere", None, False), ("bushwick", None, True)])
+    texts = [block["text"]["text"] for block in message["blocks"] if block["type"] == "section"]
+
+    assert texts == [
+        "*greenpoint*: <"+BAR["url"]+"|"+BAR["name"]+">",
+        "*nowhere*: no bars are available nearby! LAME!",
+        "*bushwick*: couldn't look up bars here right now, try again in a minute!",
+    ]
+    assert message["blocks"][3]["accessory"]["image_url"] == BAR["image_url"]
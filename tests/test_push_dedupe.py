@@ -0,0 +1,86 @@
+from fake_datastore import FakeDatastoreClient
+from push_dedupe import PushDeduplicator
+
+
+def build_dedupe(datastore_client):
+    return PushDeduplicator(datastore_client=datastore_client, datastore_marker_kind="HappyTaps-PushMarker")
+
+
+def test_redelivery_to_the_same_instance_is_a_duplicate():
+    datastore_client = FakeDatastoreClient()
+    dedupe = build_dedupe(datastore_client)
+
+    assert dedupe.claim("m1")
+    calls = len(datastore_client.calls)
+    assert not dedupe.claim("m1")
+
+    # Answered from the in-process table
+    assert len(datastore_client.calls) == calls
+    assert dedupe.stats() == {"tracked": 1, "claimed": 1, "duplicates": 1}
+
+
+def test_redelivery_to_another_instance_is_a_duplicate_until_released():
+    datastore_client = FakeDatastoreClient()
+    first = build_dedupe(datastore_client)
+    second = build_dedupe(datastore_client)
+
+    assert first.claim("m1")
+    assert not second.claim("m1")
+
+    first.release("m1")
+    assert second.claim("m1")
+
+
+def test_completed_message_is_not_handled_again():
+    datastore_client = FakeDatastoreClient()
+    first = build_dedupe(datastore_client)
+    second = build_dedupe(datastore_client)
+
+    assert first.claim("m1")
+    first.complete("m1")
+    # Releasing after completion leaves the done marker in place
+    first.release("m1")
+
+    assert not second.claim("m1")
+
+
+def test_message_is_handled_while_datastore_is_down():
+    datastore_client = FakeDatastoreClient()
+    datastore_client.fail_with = RuntimeError("datastore down")
+    dedupe = build_dedupe(datastore_client)
+
+    assert dedupe.claim("m1")
+    assert dedupe.claim("")
+
+
+def test_expired_claim_from_a_dead_instance_is_taken_over():
+    datastore_client = FakeDatastoreClient()
+    dead = PushDeduplicator(datastore_client=datastore_client, datastore_marker_kind="HappyTaps-PushMarker", in_progress_seconds=-1)
+    other = build_dedupe(datastore_client)
+
+    assert dead.claim("m1")
+    assert other.claim("m1")
+
+
+def test_done_marker_from_another_instance_stops_local_redeliveries():
+    datastore_client = FakeDatastoreClient()
+    first = build_dedupe(datastore_client)
+    second = build_dedupe(datastore_client)
+
+    assert first.claim("m1")
+    first.complete("m1")
+    assert not second.claim("m1")
+    calls = len(datastore_client.calls)
+
+    assert not second.claim("m1")
+    assert len(datastore_client.calls) == calls
+
+
+def test_local_table_is_bounded():
+    dedupe = PushDeduplicator(datastore_client=FakeDatastoreClient(), datastore_marker_kind="HappyTaps-PushMarker", max_local_messages=2)
+
+    for message_id in ("m1", "m2", "m3"):
+        assert dedupe.claim(message_id)
+
+    assert dedupe.stats()["tracked"] == 2
+    assert not dedupe.claim("m3")
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from circuit_breaker import CircuitOpen
+
+
+def test_hot_locations_missing_or_expiring_soon_are_refreshed_hottest_first(pipeline):
+    now = datetime.now(tz=timezone.utc)
+    for location, count in (("nyc", 3), ("greenpoint", 2), ("bushwick", 1)):
+        for _ in range(count):
+            pipeline.popularity.increment(location)
+    pipeline.taps_store.put("nyc", [{"id": "a"}], now - pipeline.TAPS_TTL + timedelta(minutes=30))
+    pipeline.taps_store.put("greenpoint", [{"id": "b"}], now)
+
+    hot_locations, to_refresh = pipeline.hot_locations_to_refresh(top_n=3, max_yelp_calls=5, refresh_within=timedelta(hours=2))
+
+    assert hot_locations == ["nyc", "greenpoint", "bushwick"]
+    assert to_refresh == ["nyc", "bushwick"]
+
+
+def test_hot_locations_are_read_through_the_datastore_breaker(pipeline, monkeypatch):
+    pipeline.popularity.increment("nyc")
+    reads = []
+    monkeypatch.setattr(pipeline.taps_store, "get_multi", lambda *args, **kwargs: reads.append(kwargs) or {})
+
+    pipeline.hot_locations_to_refresh(top_n=3, max_yelp_calls=5, refresh_within=timedelta(hours=2))
+    assert reads == [{"timeout": pipeline.DATASTORE_TIMEOUT}]
+
+    pipeline.datastore_breaker.record_failure()
+    with pytest.raises(CircuitOpen):
+        pipeline.hot_locations_to_refresh(top_n=3, max_yelp_calls=5, refresh_within=timedelta(hours=2))
+    assert len(reads) == 1
+
+
+def test_location_without_bars_is_not_reported_as_failed(pipeline):
+    to_refresh = ["nyc", "nowhere", "greenpoint"]
+    outcomes = [pipeline.refresh_outcome([{"id": "a"}]), pipeline.refresh_outcome(None), "failed"]
+
+    assert pipeline.refresh_summary(["nyc", "nowhere", "greenpoint", "bushwick"], to_refresh, outcomes) == {
+        "hot_locations": 4,
+        "refreshed": ["nyc"],
+        "no_results": ["nowhere"],
+        "failed": ["greenpoint"],
+    }
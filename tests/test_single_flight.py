@@ -0,0 +1,142 @@
+import asyncio
+import threading
+
+import pytest
+
+from fake_datastore import FakeDatastoreClient
+from single_flight import AsyncSingleFlight, DatastoreLease, SingleFlight
+
+
+def test_concurrent_calls_for_a_key_share_one_result():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "businesses"
+
+    leader = threading.Thread(target=lambda: results.append(flight.do("greenpoint", work)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("greenpoint", work))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    # Followers register before the leader finishes
+    while flight._calls["greenpoint"].waiters < 3:
+        pass
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert len(calls) == 1
+    assert [result.value for result in results] == ["businesses"] * 4
+    assert sorted(result.shared for result in results) == [False, True, True, True]
+
+
+def test_error_is_raised_to_waiters_and_the_key_is_freed():
+    flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError("yelp down")
+
+    with pytest.raises(RuntimeError):
+        flight.do("greenpoint", fail)
+
+    assert flight.do("greenpoint", lambda: "businesses").value == "businesses"
+
+
+def test_async_calls_for_a_key_share_one_result():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "businesses"
+
+    async def run():
+        return await asyncio.gather(*(flight.do("greenpoint", work) for _ in range(4)))
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert [result.value for result in results] == ["businesses"] * 4
+    assert [result.shared for result in results] == [False, True, True, True]
+
+
+def test_lease_is_held_by_one_instance_until_released():
+    datastore_client = FakeDatastoreClient()
+    first = DatastoreLease(datastore_client=datastore_client, datastore_lease_kind="HappyTaps-Lease", lease_seconds=10)
+    second = DatastoreLease(datastore_client=datastore_client, datastore_lease_kind="HappyTaps-Lease", lease_seconds=10)
+
+    assert first.acquire("greenpoint")
+    assert not second.acquire("greenpoint")
+    # Re-acquiring your own lease extends it
+    assert first.acquire("greenpoint")
+
+    # Only the holder can release it
+    second.release("greenpoint")
+    assert not second.acquire("greenpoint")
+    first.release("greenpoint")
+    assert second.acquire("greenpoint")
+
+
+def test_expired_lease_can_be_taken_over():
+    datastore_client = FakeDatastoreClient()
+    crashed = DatastoreLease(datastore_client=datastore_client, datastore_lease_kind="HappyTaps-Lease", lease_seconds=-1)
+    other = DatastoreLease(datastore_client=datastore_client, datastore_lease_kind="HappyTaps-Lease", lease_seconds=10)
+
+    assert crashed.acquire("greenpoint")
+    assert other.acquire("greenpoint")
+
+
+def test_async_error_is_raised_to_waiters_and_the_key_is_freed():
+    flight = AsyncSingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("yelp down")
+
+    async def work():
+        return "businesses"
+
+    async def run():
+        results = await asyncio.gather(*(flight.do("greenpoint", fail) for _ in range(3)), return_exceptions=True)
+        return results, await flight.do("greenpoint", work)
+
+    results, retry = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry.value == "businesses"
+    assert not retry.shared
+
+
+def test_keys_are_coalesced_separately():
+    flight = SingleFlight()
+    inner = []
+
+    # A call for another key runs while the first is in flight
+    def outer():
+        inner.append(flight.do("astoria", lambda: "astoria bars").value)
+        return "greenpoint bars"
+
+    assert flight.do("greenpoint", outer).value == "greenpoint bars"
+    assert inner == ["astoria bars"]
+
+
+def test_release_by_an_expired_holder_keeps_the_new_lease():
+    datastore_client = FakeDatastoreClient()
+    crashed = DatastoreLease(datastore_client=datastore_client, datastore_lease_kind="HappyTaps-Lease", lease_seconds=-1)
+    other = DatastoreLease(datastore_client=datastore_client, datastore_lease_kind="HappyTaps-Lease", lease_seconds=10)
+    third = DatastoreLease(datastore_client=datastore_client, datastore_lease_kind="HappyTaps-Lease", lease_seconds=10)
+
+    assert crashed.acquire("greenpoint")
+    assert other.acquire("greenpoint")
+    # The slow first holder finishing late doesn't free the key for a third
+    crashed.release("greenpoint")
+    assert not third.acquire("greenpoint")
@@ -0,0 +1,254 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import datastore
+from slack_sdk.oauth.installation_store import Installation
+
+from fake_datastore import FakeDatastoreClient
+from slack_oauth_datastore import GoogleDatastoreInstallationStore, GoogleDatastoreOAuthStateStore
+
+
+def build_store(datastore_client, **kwargs):
+    return GoogleDatastoreInstallationStore(
+        datastore_client=datastore_client,
+        datastore_bot_kind="HappyTaps-Bot",
+        datastore_installation_kind="HappyTaps-Installation",
+        client_id="111.222",
+        logger=None,
+        **kwargs,
+    )
+
+
+def installation(team_id="T1", user_id="U1", installed_at=1700000000.0, bot_token="xoxb-1"):
+    return Installation(
+        app_id="A1",
+        team_id=team_id,
+        user_id=user_id,
+        bot_token=bot_token,
+        bot_id="B1",
+        bot_user_id="UB1",
+        bot_scopes=["commands"],
+        installed_at=installed_at,
+    )
+
+
+def test_lookups_are_answered_from_the_cache():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client)
+    store.save(installation())
+
+    assert store.find_installation(enterprise_id=None, team_id="T1").bot_token == "xoxb-1"
+    assert store.find_bot(enterprise_id=None, team_id="T1").bot_token == "xoxb-1"
+    calls = len(datastore_client.calls)
+
+    assert store.find_installation(enterprise_id=None, team_id="T1").bot_token == "xoxb-1"
+    assert store.find_bot(enterprise_id=None, team_id="T1").bot_token == "xoxb-1"
+    assert len(datastore_client.calls) == calls
+
+
+def test_missing_workspace_is_cached_until_it_is_saved():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client)
+
+    assert store.find_bot(enterprise_id=None, team_id="T1") is None
+    calls = len(datastore_client.calls)
+    assert store.find_bot(enterprise_id=None, team_id="T1") is None
+    assert len(datastore_client.calls) == calls
+
+    store.save(installation())
+    assert store.find_bot(enterprise_id=None, team_id="T1").bot_token == "xoxb-1"
+
+
+def test_negative_results_expire_on_their_own():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client, negative_cache_ttl_seconds=0.01)
+    other = build_store(datastore_client)
+
+    assert store.find_installation(enterprise_id=None, team_id="T1") is None
+    # Saved by another instance, which can't invalidate this one's cache
+    other.save(installation())
+    time.sleep(0.02)
+
+    assert store.find_installation(enterprise_id=None, team_id="T1").bot_token == "xoxb-1"
+
+
+def test_deletes_invalidate_only_that_workspace():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client)
+    store.save(installation(team_id="T1"))
+    store.save(installation(team_id="T2", bot_token="xoxb-2"))
+    assert store.find_installation(enterprise_id=None, team_id="T1") is not None
+    assert store.find_installation(enterprise_id=None, team_id="T2") is not None
+
+    store.delete_all(enterprise_id=None, team_id="T1")
+
+    assert store.find_installation(enterprise_id=None, team_id="T1") is None
+    assert store.find_bot(enterprise_id=None, team_id="T1") is None
+    calls = len(datastore_client.calls)
+    assert store.find_installation(enterprise_id=None, team_id="T2").bot_token == "xoxb-2"
+    assert len(datastore_client.calls) == calls
+
+
+def test_saving_a_workspace_drops_cached_user_lookups():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client)
+    store.save(installation(user_id="U1"))
+    assert store.find_installation(enterprise_id=None, team_id="T1", user_id="U2") is None
+
+    store.save(installation(user_id="U2", installed_at=1700000100.0))
+
+    assert store.find_installation(enterprise_id=None, team_id="T1", user_id="U2").user_id == "U2"
+
+
+def stored_keys(datastore_client, kind):
+    return sorted(key.flat_path for key in datastore_client.entities if key.kind == kind)
+
+
+def test_deterministic_keys_are_found_without_a_query():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client, use_deterministic_keys=True)
+    store.save(installation(user_id="U1"))
+    store.save(installation(user_id="U2", installed_at=1700000100.0, bot_token="xoxb-2"))
+
+    assert stored_keys(datastore_client, "HappyTaps-Installation") == [
+        ("HappyTaps-Installation", "111.222:none:T1"),
+        ("HappyTaps-Installation", "111.222:none:T1", "HappyTaps-Installation", "U1:1700000000.0"),
+        ("HappyTaps-Installation", "111.222:none:T1", "HappyTaps-Installation", "U2:1700000100.0"),
+        ("HappyTaps-Installation", "111.222:none:T1", "HappyTaps-Installation", "user:U1"),
+        ("HappyTaps-Installation", "111.222:none:T1", "HappyTaps-Installation", "user:U2"),
+    ]
+    assert store.find_installation(enterprise_id=None, team_id="T1").user_id == "U2"
+    # A user's row carries the workspace's latest bot token
+    assert store.find_installation(enterprise_id=None, team_id="T1", user_id="U1").bot_token == "xoxb-2"
+    assert store.find_bot(enterprise_id=None, team_id="T1").bot_token == "xoxb-2"
+    assert "query" not in datastore_client.calls
+
+
+def test_deleting_the_latest_user_rebuilds_the_workspace_row():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client, use_deterministic_keys=True)
+    store.save(installation(user_id="U1"))
+    store.save(installation(user_id="U2", installed_at=1700000100.0, bot_token="xoxb-2"))
+
+    store.delete_installation(enterprise_id=None, team_id="T1", user_id="U2")
+
+    latest = store.find_installation(enterprise_id=None, team_id="T1")
+    assert latest.user_id == "U1"
+    # The bot belongs to the workspace and outlives the user who installed it
+    assert latest.bot_token == "xoxb-2"
+    assert store.find_installation(enterprise_id=None, team_id="T1", user_id="U2") is None
+
+    store.delete_installation(enterprise_id=None, team_id="T1", user_id="U1")
+    assert stored_keys(datastore_client, "HappyTaps-Installation") == []
+
+
+def test_deleting_an_older_user_keeps_the_workspace_row():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client, use_deterministic_keys=True)
+    store.save(installation(user_id="U1"))
+    store.save(installation(user_id="U2", installed_at=1700000100.0))
+
+    store.delete_installation(enterprise_id=None, team_id="T1", user_id="U1")
+
+    assert store.find_installation(enterprise_id=None, team_id="T1").user_id == "U2"
+    assert store.find_installation(enterprise_id=None, team_id="T1", user_id="U1") is None
+
+
+def test_delete_all_removes_every_deterministic_row():
+    datastore_client = FakeDatastoreClient()
+    store = build_store(datastore_client, use_deterministic_keys=True)
+    store.save(installation(team_id="T1"))
+    store.save(installation(team_id="T2"))
+
+    store.delete_all(enterprise_id=None, team_id="T1")
+
+    assert store.find_bot(enterprise_id=None, team_id="T1") is None
+    assert store.find_installation(enterprise_id=None, team_id="T1") is None
+    assert all("T1" not in path[1] for path in stored_keys(datastore_client, "HappyTaps-Bot"))
+    assert store.find_bot(enterprise_id=None, team_id="T2") is not None
+
+
+def test_migration_moves_uuid_rows_to_deterministic_keys():
+    datastore_client = FakeDatastoreClient()
+    build_store(datastore_client).save(installation(user_id="U1"))
+    build_store(datastore_client).save(installation(user_id="U2", installed_at=1700000100.0, bot_token="xoxb-2"))
+    store = build_store(datastore_client, use_deterministic_keys=True)
+
+    # One installation and one bot row per save
+    assert store.migrate_to_deterministic_keys(batch_size=1) == 4
+    assert all(path[1].startswith("111.222:") for path in stored_keys(datastore_client, "HappyTaps-Installation"))
+    assert all(path[1].startswith("111.222:") for path in stored_keys(datastore_client, "HappyTaps-Bot"))
+    # The latest rows hold the newest install
+    assert store.find_installation(enterprise_id=None, team_id="T1").user_id == "U2"
+    assert store.find_bot(enterprise_id=None, team_id="T1").bot_token == "xoxb-2"
+    assert store.find_installation(enterprise_id=None, team_id="T1", user_id="U1").user_id == "U1"
+
+    assert store.migrate_to_deterministic_keys() == 0
+
+
+def build_state_store(datastore_client, **kwargs):
+    return GoogleDatastoreOAuthStateStore(
+        datastore_client=datastore_client,
+        datastore_state_kind="HappyTaps-State",
+        expiration_seconds=600,
+        logger=None,
+        **kwargs,
+    )
+
+
+def put_expired_states(datastore_client, count):
+    expire_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+    for i in range(count):
+        entity = datastore.Entity(key=datastore_client.key("HappyTaps-State", "expired-"+str(i)))
+        entity.update({"expire_at": expire_at})
+        datastore_client.put(entity)
+
+
+def test_state_is_consumed_once():
+    state_store = build_state_store(FakeDatastoreClient())
+    state = state_store.issue()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(state_store.consume(state))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False, False, False, False, True]
+
+
+def test_expired_state_is_rejected_and_deleted():
+    datastore_client = FakeDatastoreClient()
+    state_store = build_state_store(datastore_client)
+    put_expired_states(datastore_client, 1)
+
+    assert not state_store.consume("expired-0")
+    assert datastore_client.entities == {}
+
+
+def test_purge_grows_its_batch_while_pages_come_back_full():
+    datastore_client = FakeDatastoreClient()
+    state_store = build_state_store(datastore_client, purge_min_batch_size=2, purge_max_batch_size=8)
+    put_expired_states(datastore_client, 20)
+    live = state_store.issue()
+
+    # Pages of 2, 4, 8 and 8, the last one short
+    assert state_store.purge_expired_records() == 20
+    assert datastore_client.calls.count("query") == 4
+    assert list(datastore_client.entities) == [datastore_client.key("HappyTaps-State", live)]
+    assert state_store.purged_count == 20
+    # A short page shrinks the batch for the next sweep
+    assert state_store._purge_batch_size == 4
+
+
+def test_purge_stops_at_the_record_limit():
+    datastore_client = FakeDatastoreClient()
+    state_store = build_state_store(datastore_client, purge_min_batch_size=2, purge_max_batch_size=8)
+    put_expired_states(datastore_client, 20)
+
+    assert state_store.purge_expired_records(max_records_limit=5) == 5
+    assert len(datastore_client.entities) == 15
+    assert state_store.purge_expired_records() == 15
+    assert state_store.purged_count == 20
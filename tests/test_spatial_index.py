@@ -0,0 +1,83 @@
+import threading
+from datetime import timedelta
+
+import geohash
+from fake_datastore import FakeDatastoreClient
+from spatial_index import SpatialIndex, normalize_location
+from taps_format import decode_businesses
+
+GREENPOINT = {"latitude": 40.7304, "longitude": -73.9515}
+
+
+def business(business_id, latitude=40.7304, longitude=-73.9515):
+    return {"id": business_id, "name": business_id, "coordinates": {"latitude": latitude, "longitude": longitude}}
+
+
+def build_index(datastore_client):
+    return SpatialIndex(datastore_client=datastore_client, datastore_cell_kind="HappyTaps-Cell", datastore_alias_kind="HappyTaps-Alias")
+
+
+def test_encode_and_decode_round_trip():
+    cell = geohash.encode(57.64911, 10.40744, 11)
+    latitude, longitude, lat_error, lon_error = geohash.decode(cell)
+
+    assert cell == "u4pruydqqvj"
+    assert abs(latitude - 57.64911) <= lat_error
+    assert abs(longitude - 10.40744) <= lon_error
+
+
+def test_neighbours_surround_the_cell():
+    cell = geohash.encode(GREENPOINT["latitude"], GREENPOINT["longitude"], 6)
+    neighbours = geohash.neighbours(cell)
+
+    assert len(set(neighbours)) == 8
+    assert cell not in neighbours
+    for neighbour in neighbours:
+        assert cell in geohash.neighbours(neighbour)
+
+
+def test_neighbours_wrap_around_the_antimeridian_and_stop_at_the_poles():
+    east = geohash.encode(0, 179.999, 4)
+    assert any(geohash.decode(neighbour)[1] < 0 for neighbour in geohash.neighbours(east))
+
+    pole = geohash.encode(89.999, 0, 2)
+    assert len(geohash.neighbours(pole)) == 5
+
+
+def test_nearby_query_text_shares_businesses_through_its_alias():
+    datastore_client = FakeDatastoreClient()
+    index = build_index(datastore_client)
+    index.index("Greenpoint, Brooklyn", GREENPOINT, [business("a"), business("b", 40.7350, -73.9450)])
+
+    # A fresh instance resolves the alias from datastore, not its own memory
+    businesses, oldest = build_index(datastore_client).lookup("greenpoint brooklyn", timedelta(days=1))
+
+    assert normalize_location("Greenpoint, Brooklyn") == "greenpoint brooklyn"
+    assert sorted(b["id"] for b in businesses) == ["a", "b"]
+    assert oldest is not None
+    assert build_index(datastore_client).lookup("williamsburg", timedelta(days=1)) == (None, None)
+
+
+def test_concurrent_indexing_of_a_cell_keeps_both_instances_businesses():
+    datastore_client = FakeDatastoreClient()
+    first = build_index(datastore_client)
+    second = build_index(datastore_client)
+    get_multi = datastore_client.get_multi
+    second_done = threading.Event()
+
+    # The second instance indexes the same cell while the first is between
+    # reading and writing it
+    def interleaved_get_multi(keys, **kwargs):
+        datastore_client.get_multi = get_multi
+        entities = get_multi(keys, **kwargs)
+        thread = threading.Thread(target=lambda: second.index("greenpoint", None, [business("b")]) or second_done.set())
+        thread.start()
+        second_done.wait(0.5)
+        return entities
+
+    datastore_client.get_multi = interleaved_get_multi
+    first.index("greenpoint", None, [business("a")])
+    assert second_done.wait(5)
+
+    cell = datastore_client.get(datastore_client.key("HappyTaps-Cell", geohash.encode(GREENPOINT["latitude"], GREENPOINT["longitude"], 6)))
+    assert sorted(b["id"] for b in decode_businesses(cell)) == ["a", "b"]
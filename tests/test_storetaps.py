@@ -0,0 +1,55 @@
+import base64
+import json
+import zlib
+
+import pytest
+
+
+@pytest.fixture
+def storetaps(load_service):
+    return load_service("HappyTaps-StoreTaps/happytaps-storetaps.py")
+
+
+def push_message(payload, **attributes):
+    return {"messageId": "m1", "data": base64.b64encode(payload).decode(), "attributes": attributes}
+
+
+def test_decode_message_reads_json_and_zlib_bodies(storetaps):
+    locations = {"Greenpoint": [{"id": "a"}], "nyc": []}
+    body = json.dumps({"locations": locations}).encode()
+
+    expected = {"greenpoint": [{"id": "a"}], "nyc": []}
+    assert storetaps.decode_message(push_message(body)) == expected
+    assert storetaps.decode_message(push_message(zlib.compress(body), encoding="zlib+json")) == expected
+
+
+def test_decode_message_reads_the_legacy_attribute(storetaps):
+    message = {"attributes": {"yelp_location": "NYC", "updated_businesses": json.dumps([{"id": "a"}])}}
+
+    assert storetaps.decode_message(message) == {"nyc": [{"id": "a"}]}
+
+
+@pytest.mark.parametrize("payload", [
+    [],
+    {"locations": []},
+    {"locations": {"nyc": {"id": "a"}}},
+    {"locations": {"nyc": ["a"]}},
+])
+def test_decode_message_rejects_the_wrong_shape(storetaps, payload):
+    with pytest.raises(ValueError):
+        storetaps.decode_message(push_message(json.dumps(payload).encode()))
+
+
+@pytest.mark.parametrize("body", [b"not json", b"[1]", b"{}", b'{"message": 3}'])
+def test_push_without_a_message_is_acked(storetaps, body):
+    response = storetaps.app.test_client().post("/storetaps", data=body, content_type="application/json")
+
+    assert response.status_code == 204
+
+
+def test_malformed_message_is_acked(storetaps):
+    envelope = {"message": push_message(json.dumps({"locations": {"nyc": "a"}}).encode())}
+
+    response = storetaps.app.test_client().post("/storetaps", json=envelope)
+
+    assert response.status_code == 204
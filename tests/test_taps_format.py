@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta, timezone
+
+from fake_datastore import FakeDatastoreClient
+from taps_format import FORMAT_VERSION, decode_businesses, taps_properties
+from taps_store import DatastoreTapsStore
+
+BUSINESSES = [
+    {"id": "b1", "name": "Bar One", "url": "https://yelp.example/b1", "image_url": "https://img.example/b1.jpg",
+     "coordinates": {"latitude": 40.72, "longitude": -73.95}, "rating": 4.5, "review_count": 120},
+]
+PROJECTED = [{key: BUSINESSES[0][key] for key in ("id", "name", "url", "image_url", "coordinates")}]
+
+
+def test_version_1_is_written_by_default():
+    assert FORMAT_VERSION == 1
+    properties, exclude_from_indexes = taps_properties(BUSINESSES)
+    assert properties == {"businesses": BUSINESSES}
+    assert "format_version" not in properties
+    assert exclude_from_indexes == ["businesses"]
+
+
+def test_version_2_round_trips_the_projected_fields():
+    properties, exclude_from_indexes = taps_properties(BUSINESSES, 2)
+    assert properties["format_version"] == 2
+    assert isinstance(properties["businesses_blob"], bytes)
+    assert exclude_from_indexes == ["businesses_blob"]
+    assert decode_businesses(properties) == PROJECTED
+
+
+def test_version_1_records_decode_without_a_format_version():
+    assert decode_businesses({"businesses": BUSINESSES}) == BUSINESSES
+
+
+def test_stores_read_records_written_in_either_version():
+    client = FakeDatastoreClient()
+    timestamp = datetime.now(tz=timezone.utc)
+    v1_store = DatastoreTapsStore(datastore_client=client, format_version=1)
+    v2_store = DatastoreTapsStore(datastore_client=client, format_version=2)
+    v1_store.put_multi({"greenpoint": {"businesses": BUSINESSES, "timestamp": timestamp}})
+    v2_store.put_multi({"astoria": {"businesses": BUSINESSES, "timestamp": timestamp}})
+
+    for store in (v1_store, v2_store):
+        records = store.get_multi(["greenpoint", "astoria"])
+        assert records["greenpoint"]["businesses"] == BUSINESSES
+        assert records["astoria"]["businesses"] == PROJECTED
+
+
+def test_compaction_only_rewrites_older_formats():
+    client = FakeDatastoreClient()
+    timestamp = datetime.now(tz=timezone.utc)
+    DatastoreTapsStore(datastore_client=client, format_version=1).put_multi({"greenpoint": {"businesses": BUSINESSES, "timestamp": timestamp}})
+    DatastoreTapsStore(datastore_client=client, format_version=2).put_multi({"astoria": {"businesses": BUSINESSES, "timestamp": timestamp}})
+
+    # A version 1 writer leaves version 2 records alone
+    result = DatastoreTapsStore(datastore_client=client, format_version=1).sweep(timedelta(days=30), compact=True)
+    assert result["compacted"] == 0
+    assert client.get(client.key("HappyTaps", "astoria"))["format_version"] == 2
+
+    result = DatastoreTapsStore(datastore_client=client, format_version=2).sweep(timedelta(days=30), compact=True)
+    assert result["compacted"] == 1
+    assert result["bytes_reclaimed"] > 0
+    entity = client.get(client.key("HappyTaps", "greenpoint"))
+    assert entity["format_version"] == 2
+    assert "businesses" not in entity
+    assert entity["timestamp"] == timestamp
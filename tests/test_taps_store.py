@@ -0,0 +1,102 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fake_datastore import FakeDatastoreClient
+from taps_store import DatastoreTapsStore, MemoryTapsStore, SqliteTapsStore, build_taps_store
+
+BUSINESSES = [{"id": "a", "name": "Bar", "url": "https://www.yelp.com/biz/bar", "image_url": "https://s3-media.yelp.com/bar.jpg",
+               "coordinates": {"latitude": 40.72, "longitude": -73.95}}]
+
+
+@pytest.fixture(params=["datastore", "sqlite", "memory"])
+def store_factory(request, tmp_path):
+    datastore_client = FakeDatastoreClient()
+
+    def build(**kwargs):
+        if request.param == "datastore":
+            return DatastoreTapsStore(datastore_client=datastore_client, **kwargs)
+        if request.param == "sqlite":
+            return SqliteTapsStore(path=str(tmp_path / "happytaps.db"), **kwargs)
+        return MemoryTapsStore(**kwargs)
+    return build
+
+
+def now():
+    # SQLite keeps timestamps as seconds, whole ones compare exactly
+    return datetime.now(tz=timezone.utc).replace(microsecond=0)
+
+
+def test_records_round_trip(store_factory):
+    store = store_factory()
+    timestamp = now()
+
+    store.put_multi({
+        "greenpoint": {"businesses": BUSINESSES, "timestamp": timestamp},
+        "nowhere": {"businesses": [], "timestamp": timestamp},
+    })
+
+    assert store.get_multi(["greenpoint", "nowhere", "astoria"]) == {
+        "greenpoint": {"businesses": BUSINESSES, "timestamp": timestamp},
+        "nowhere": {"businesses": [], "timestamp": timestamp},
+    }
+    assert store.get("astoria") is None
+    assert store.get_multi([]) == {}
+
+
+def test_put_replaces_the_record(store_factory):
+    store = store_factory()
+    store.put("greenpoint", BUSINESSES, now() - timedelta(hours=1))
+    timestamp = now()
+
+    store.put("greenpoint", [], timestamp)
+
+    assert store.get("greenpoint") == {"businesses": [], "timestamp": timestamp}
+
+
+def test_expired_records_are_not_returned(store_factory):
+    store = store_factory(ttl=timedelta(hours=1))
+    store.put("greenpoint", BUSINESSES, now() - timedelta(hours=2))
+    store.put("bushwick", BUSINESSES, now())
+    # A ttl given with the write wins over the store's
+    store.put("nowhere", [], now() - timedelta(minutes=40), ttl=timedelta(minutes=30))
+
+    assert list(store.get_multi(["greenpoint", "bushwick", "nowhere"])) == ["bushwick"]
+
+
+def test_sweep_deletes_expired_and_old_records(store_factory):
+    store = store_factory()
+    store.put("expired", BUSINESSES, now() - timedelta(hours=2), ttl=timedelta(hours=1))
+    store.put("old", BUSINESSES, now() - timedelta(days=40))
+    store.put("fresh", BUSINESSES, now())
+
+    result = store.sweep(timedelta(days=30))
+
+    assert result["deleted"] == 2
+    assert result["complete"]
+    assert set(result) == {"scanned", "deleted", "compacted", "bytes_reclaimed", "seconds", "complete"}
+    assert list(store.get_multi(["expired", "old", "fresh"])) == ["fresh"]
+
+
+def test_sqlite_store_is_shared_through_its_file(tmp_path):
+    path = str(tmp_path / "happytaps.db")
+    writer = SqliteTapsStore(path=path)
+    reader = SqliteTapsStore(path=path)
+    timestamp = now()
+
+    thread = threading.Thread(target=writer.put, args=("greenpoint", BUSINESSES, timestamp))
+    thread.start()
+    thread.join()
+
+    assert reader.get("greenpoint") == {"businesses": BUSINESSES, "timestamp": timestamp}
+
+
+def test_stores_are_built_by_name(tmp_path):
+    datastore_store = build_taps_store("datastore", datastore_client=FakeDatastoreClient(), format_version=2)
+    assert datastore_store.shared
+    assert datastore_store.format_version == 2
+    assert not build_taps_store("sqlite", sqlite_path=str(tmp_path / "happytaps.db")).shared
+    assert not build_taps_store("memory").shared
+    with pytest.raises(ValueError):
+        build_taps_store("redis")
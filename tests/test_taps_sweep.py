@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from circuit_breaker import CircuitBreaker
+from fake_datastore import FakeDatastoreClient
+from taps_store import DatastoreTapsStore, WriteBudget
+
+
+def old_records(store, count):
+    oldest = datetime.now(tz=timezone.utc) - timedelta(days=60)
+    store.put_multi({"location-"+str(i): {"businesses": [], "timestamp": oldest + timedelta(hours=i)} for i in range(count)})
+
+
+def stored_locations(datastore_client):
+    return sorted(key.name for key in datastore_client.entities)
+
+
+def test_budget_limits_each_batch_to_the_writes_left():
+    budget = WriteBudget(max_writes=5)
+
+    assert budget.limit(500) == 5
+    budget.spend(4)
+    assert budget.limit(500) == 1
+    assert not budget.exhausted
+    budget.spend(1)
+    assert budget.exhausted
+    assert WriteBudget().limit(500) == 500
+
+
+def test_budget_keeps_to_its_write_rate():
+    budget = WriteBudget(writes_per_second=200)
+
+    budget.spend(10)
+
+    assert budget.seconds >= 0.05
+
+
+def test_sweep_cut_short_deletes_the_oldest_and_resumes_next_run():
+    datastore_client = FakeDatastoreClient()
+    store = DatastoreTapsStore(datastore_client=datastore_client)
+    old_records(store, 10)
+    store.put("fresh", [], datetime.now(tz=timezone.utc))
+
+    result = store.sweep(timedelta(days=30), budget=WriteBudget(max_writes=4))
+
+    assert result["deleted"] == 4
+    assert not result["complete"]
+    assert stored_locations(datastore_client) == sorted(["fresh"] + ["location-"+str(i) for i in range(4, 10)])
+
+    result = store.sweep(timedelta(days=30))
+
+    assert result["deleted"] == 6
+    assert result["complete"]
+    assert stored_locations(datastore_client) == ["fresh"]
+
+
+def test_sweep_out_of_time_does_nothing():
+    datastore_client = FakeDatastoreClient()
+    store = DatastoreTapsStore(datastore_client=datastore_client)
+    old_records(store, 3)
+
+    result = store.sweep(timedelta(days=30), budget=WriteBudget(max_seconds=0))
+
+    assert result["scanned"] == 0
+    assert not result["complete"]
+    assert len(datastore_client.entities) == 3
+
+
+@pytest.fixture
+def storetaps(load_service, monkeypatch):
+    storetaps = load_service("HappyTaps-StoreTaps/happytaps-storetaps.py")
+    monkeypatch.setattr(storetaps, "taps_store", DatastoreTapsStore(datastore_client=FakeDatastoreClient()))
+    monkeypatch.setattr(storetaps, "datastore_breaker", CircuitBreaker(name="datastore"))
+    monkeypatch.setattr(storetaps, "last_sweep", {})
+    return storetaps
+
+
+def test_sweep_endpoint_reports_a_run_cut_short(storetaps):
+    old_records(storetaps.taps_store, 3)
+
+    response = storetaps.app.test_client().post("/sweeptaps", json={"max_writes": 2, "writes_per_second": 0})
+
+    assert response.status_code == 200
+    assert response.get_json()["deleted"] == 2
+    assert response.get_json()["complete"] is False
+    assert storetaps.last_sweep["complete"] is False
+
+
+def test_overlapping_sweeps_are_refused(storetaps):
+    storetaps.sweep_lock.acquire()
+    try:
+        response = storetaps.app.test_client().post("/sweeptaps")
+    finally:
+        storetaps.sweep_lock.release()
+
+    assert response.status_code == 409
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+def test_unknown_location_is_an_answer_not_an_error(pipeline):
+    pipeline.check_yelp_response(200, {"businesses": []})
+    pipeline.check_yelp_response(400, {"error": {"code": "LOCATION_NOT_FOUND"}})
+
+
+@pytest.mark.parametrize("status_code, yelp_data", [
+    (400, {"error": {"code": "VALIDATION_ERROR"}}),
+    (401, {}),
+    (429, {"error": {"code": "TOO_MANY_REQUESTS_PER_SECOND"}}),
+    (503, {}),
+])
+def test_other_failures_are_transient(pipeline, status_code, yelp_data):
+    with pytest.raises(pipeline.YelpUnavailable) as error:
+        pipeline.check_yelp_response(status_code, yelp_data)
+    assert error.value.status_code == status_code
+
+
+def test_empty_answer_is_remembered_for_the_negative_ttl(pipeline):
+    assert pipeline.store_yelp_page("nowhere", {"businesses": []}) is None
+
+    data_response = pipeline.taps_store.get("nowhere")
+    assert data_response["businesses"] == []
+    assert pipeline.cached_answer("nowhere", data_response, schedule_refresh=None) == []
+
+    data_response["timestamp"] = datetime.now(tz=timezone.utc) - pipeline.TAPS_NEGATIVE_TTL - timedelta(minutes=1)
+    assert pipeline.cached_answer("nowhere", data_response, schedule_refresh=None) is None
+
+
+def test_stale_list_is_served_while_a_refresh_is_scheduled(pipeline):
+    refreshes = []
+    data_response = {"businesses": [{"id": "a"}], "timestamp": datetime.now(tz=timezone.utc) - pipeline.TAPS_TTL - timedelta(minutes=1)}
+
+    assert pipeline.cached_answer("greenpoint", data_response, schedule_refresh=lambda location: refreshes.append(location) or True) == [{"id": "a"}]
+    assert refreshes == ["greenpoint"]
+
+
+def test_yelp_outage_falls_back_to_any_old_list(pipeline):
+    error = pipeline.YelpUnavailable(503)
+    old = {"businesses": [{"id": "a"}], "timestamp": datetime.now(tz=timezone.utc) - timedelta(days=30)}
+
+    assert pipeline.fallback_answer(old, error) == [{"id": "a"}]
+    # An empty list isn't worth serving in place of an error
+    with pytest.raises(pipeline.YelpUnavailable):
+        pipeline.fallback_answer({"businesses": [], "timestamp": old["timestamp"]}, error)
+    with pytest.raises(pipeline.YelpUnavailable):
+        pipeline.fallback_answer(None, error)
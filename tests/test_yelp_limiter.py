@@ -0,0 +1,96 @@
+from fake_datastore import FakeDatastoreClient
+from yelp_limiter import BACKGROUND, INTERACTIVE, YelpRateLimiter
+
+
+def build_limiter(datastore_client, **kwargs):
+    options = dict(max_qps=0.001, burst=10, daily_limit=100, claim_size=5, max_wait_seconds=0)
+    options.update(kwargs)
+    return YelpRateLimiter(datastore_client=datastore_client, datastore_quota_kind="HappyTaps-YelpQuota", **options)
+
+
+def quota_used(datastore_client):
+    (entity,) = datastore_client.entities.values()
+    return entity["used"]
+
+
+def limiter_rejected(limiter):
+    return limiter.stats()["rejected"][INTERACTIVE]
+
+
+def test_daily_quota_is_claimed_in_blocks():
+    datastore_client = FakeDatastoreClient()
+    limiter = build_limiter(datastore_client)
+
+    assert all(limiter.acquire() for _ in range(5))
+    assert quota_used(datastore_client) == 5
+    assert datastore_client.calls.count("put_multi") == 1
+
+    assert limiter.acquire()
+    assert quota_used(datastore_client) == 10
+
+
+def test_instances_share_the_daily_quota():
+    datastore_client = FakeDatastoreClient()
+    first = build_limiter(datastore_client, daily_limit=8)
+    second = build_limiter(datastore_client, daily_limit=8)
+
+    assert all(first.acquire() for _ in range(5))
+    assert all(second.acquire() for _ in range(3))
+    assert not second.acquire()
+    assert limiter_rejected(second) == 1
+
+
+def test_background_calls_leave_a_reserve_of_the_bucket():
+    limiter = build_limiter(FakeDatastoreClient(), burst=5, background_reserve=0.2)
+
+    assert all(limiter.acquire(BACKGROUND) for _ in range(4))
+    assert not limiter.acquire(BACKGROUND)
+    assert limiter.acquire(INTERACTIVE)
+
+
+def test_throttled_response_pauses_calls():
+    limiter = build_limiter(FakeDatastoreClient())
+
+    limiter.record_response(429, {"Retry-After": "60"})
+
+    assert not limiter.acquire()
+    assert limiter.stats()["throttled"] == 1
+
+
+def test_calls_are_still_allowed_while_the_quota_cannot_be_claimed():
+    datastore_client = FakeDatastoreClient()
+    datastore_client.fail_with = RuntimeError("datastore down")
+    limiter = build_limiter(datastore_client)
+
+    assert all(limiter.acquire() for _ in range(5))
+
+
+def test_exhausted_quota_reported_by_yelp_stops_calls():
+    datastore_client = FakeDatastoreClient()
+    limiter = build_limiter(datastore_client)
+
+    assert limiter.acquire()
+    limiter.record_response(200, {"RateLimit-DailyLimit": "100", "RateLimit-Remaining": "0"})
+
+    assert not limiter.acquire()
+    # The shared count catches up with what Yelp reported
+    assert quota_used(datastore_client) == 100
+
+
+def test_background_calls_leave_a_reserve_of_the_daily_quota():
+    limiter = build_limiter(FakeDatastoreClient(), background_reserve=0.2)
+
+    assert limiter.acquire(BACKGROUND)
+    limiter.record_response(200, {"RateLimit-Remaining": "15"})
+
+    assert not limiter.acquire(BACKGROUND)
+    assert limiter.acquire(INTERACTIVE)
+    assert limiter.stats()["rejected"][BACKGROUND] == 1
+
+
+def test_interactive_calls_wait_a_little_for_a_token():
+    limiter = build_limiter(FakeDatastoreClient(), max_qps=50, burst=1, max_wait_seconds=1)
+
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire(BACKGROUND)
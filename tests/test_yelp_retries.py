@@ -0,0 +1,52 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from aiohttp import ClientSession
+
+from http_sessions import build_session
+
+
+class FailingHandler(BaseHTTPRequestHandler):
+    hits = 0
+
+    def do_GET(self):
+        FailingHandler.hits += 1
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def failing_url():
+    FailingHandler.hits = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FailingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:"+str(server.server_address[1])+"/v3/businesses/search"
+    server.shutdown()
+
+
+@pytest.mark.parametrize("retry_sent, hits", [(True, 3), (False, 1)])
+def test_session_retries_5xx_only_when_sent_requests_may_be_retried(failing_url, retry_sent, hits):
+    session = build_session(pool_size=1, connect_timeout=1, read_timeout=1, retries=2, backoff_factor=0, retry_sent=retry_sent)
+
+    assert session.get(failing_url).status_code == 503
+    assert FailingHandler.hits == hits
+
+
+@pytest.mark.parametrize("retry_sent, hits", [(True, 3), (False, 1)])
+def test_async_request_retries_5xx_only_when_sent_requests_may_be_retried(load_service, monkeypatch, failing_url, retry_sent, hits):
+    findtaps = load_service("HappyTaps-FindTaps/happytaps-findtaps-async.py")
+    monkeypatch.setattr(findtaps, "HTTP_BACKOFF_FACTOR", 0)
+
+    async def request():
+        async with ClientSession() as session:
+            return await findtaps.request_with_retries(session, 'GET', failing_url, with_response=True, retry_sent=retry_sent)
+
+    status, _, _ = asyncio.run(request())
+    assert status == 503
+    assert FailingHandler.hits == hits